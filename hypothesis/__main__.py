@@ -1,9 +1,11 @@
 import logging
 import argparse
 import os
-import json
-from .fetching.hypothesis_api import get_annotations_by_group, get_annotations_from_json
+from .fetching.hypothesis_api import get_annotations_by_group, get_annotations_from_json, sync_annotations, \
+    backfill_annotations, record_full_fetch
 from .features.summary import get_all_statistics
+from .annotations.Annotation import parse_annotations
+from .annotations.AnnotationStore import AnnotationStore
 from . import config
 
 if __name__ == '__main__':
@@ -15,20 +17,50 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-c', '--cached', help="Load data from local cache", action="store_true")
+    # --sync only fetches annotations that are new or were edited since the last run, and merges them into the cache
+    parser.add_argument('-s', '--sync', help="Update the local cache with new and edited annotations",
+                        action="store_true")
+    # --backfill downloads the whole group by paging through windows of its history concurrently
+    parser.add_argument('-b', '--backfill', help="Fetch all annotations concurrently by time window",
+                        action="store_true")
+    # --processes parses the tags of the annotations on a pool of this many processes; it only pays off for large
+    # groups on several cores
+    parser.add_argument('-p', '--processes', help="Number of processes to parse annotations on", type=int, default=1)
 
     args = parser.parse_args()
 
     config.USE_CACHE = args.cached
+    store = AnnotationStore(os.path.join(config.OUTPUT_DIR, config.ANNOTATION_STORE))
+    sync_state_path = os.path.join(config.OUTPUT_DIR, config.SYNC_STATE)
+    legacy_path = os.path.join(config.OUTPUT_DIR, config.ANNOTATION_OUTPUT)
+    if len(store) == 0 and os.path.isfile(legacy_path):
+        # annotations saved by older versions as one json file are moved into the store once
+        store.write(get_annotations_from_json(legacy_path))
 
     if config.USE_CACHE:
-        # load the stored annotation json file
-        annotations = get_annotations_from_json(os.path.join(config.OUTPUT_DIR, config.ANNOTATION_OUTPUT))
+        # load the stored annotations
+        annotations = parse_annotations(store.iter_dicts(), args.processes)
+
+    elif args.sync:
+        annotations = sync_annotations(config.GROUP_ID, config.GROUP_EPOCH, store, sync_state_path, args.processes)
+
+    elif args.backfill:
+        # every window is appended to a staging store as it arrives, which replaces the stored annotations at the end
+        staged = store.staging()
+        annotations = backfill_annotations(config.GROUP_ID, config.GROUP_EPOCH, store=staged,
+                                           processes=args.processes)
+        store.replace_with(staged)
+        # a full fetch is also a reconciliation, so the next --sync only fetches what changed since
+        record_full_fetch(sync_state_path, annotations, config.GROUP_EPOCH)
 
     else:
-        # dump the raw annotations to a json file
-        annotations = get_annotations_by_group(config.GROUP_ID, config.GROUP_EPOCH)
-        with open(os.path.join(config.OUTPUT_DIR, config.ANNOTATION_OUTPUT), "w") as file:
-            json.dump([a.as_dict() for a in annotations], file, indent=4)
+        # the raw annotations are written to a staging store page by page while they are fetched, which only replaces
+        # the stored annotations once the whole group was fetched
+        staged = store.staging()
+        annotations = get_annotations_by_group(config.GROUP_ID, config.GROUP_EPOCH, store=staged,
+                                               processes=args.processes)
+        store.replace_with(staged)
+        record_full_fetch(sync_state_path, annotations, config.GROUP_EPOCH)
 
 
     # converting to csv and computing summary
@@ -1,12 +1,14 @@
 # the 'annotations' import (used for type-hinting in static methods)
 # should not be confused with our custom Annotation class
 from __future__ import annotations
-from dataclasses import dataclass, field, asdict
 from typing import Dict, List
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import re
-import copy
 import enum
 
 
@@ -72,134 +74,292 @@ def _fix_df_nan(df: pd.DataFrame):
         out_df = out_df.replace(term, np.NaN)
     return out_df
 
-@dataclass
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _copy_tag_list(values):
+    # tag values are strings, flags, or one-level dictionaries for double tags
+    return [dict(v) if isinstance(v, dict) else v for v in values]
+
+
+def _raw_field(name):
+    """Creates a property for a bulky field, which keeps a reference to the object it was given without copying or
+    converting it. A json string, i.e. the field as it was read from a file, is only decoded when it is accessed"""
+    slot = f"_{name}"
+
+    def getter(self):
+        value = getattr(self, slot)
+        if isinstance(value, str):
+            value = json.loads(value)
+            setattr(self, slot, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, slot, value)
+
+    return property(getter, setter)
+
+
+def get_tags_from_text(text, text_tags):
+    """Adds the 'TagName: value' lines of an annotation's text to the text_tags dictionary"""
+    tag_match = re.finditer(BODY_TAG_REGEX, text)
+    if tag_match:
+        # TODO: some assertion/error checking on tag_dict
+        for match in tag_match:
+            tag_dict = match.groupdict()
+            tag_name = tag_dict["name"]
+            tag_value = tag_dict["body"].strip()
+
+            # if the tag name is already in the tag_dict, fetch its corresponding list; else, return an empty list
+            new_list = text_tags.get(tag_name, [])
+
+            # if the value is already in the tag_dict, ignore it (removes tags that get duplicated in body
+            # and tag list)
+            if tag_value not in new_list:
+                new_list.append(tag_value)
+            text_tags[_intern(tag_name)] = new_list
+    else:  # error or log something here
+        pass
+    return text_tags
+
+
+def get_tags_from_tags_list(tags, body_tags):
+    """Adds an annotation's list of hypothes.is tags to the body_tags dictionary"""
+    for tag in tags:
+        tag_split = tag.split(":")
+        tag_name = ""
+        tag_value = ""
+
+        # double tags, in the format TagName1:TagName2:TagValue i.e., AgeOfPresentation
+        if len(tag_split) == 3:
+            tag_name = tag_split[0].strip()
+            tag_name2 = tag_split[1].strip()
+            tag_value = {tag_name2: tag_split[2].strip()}
+
+        # normal tags in the format TagName:TagValue
+        elif len(tag_split) == 2:
+            tag_name = tag_split[0].strip()
+            tag_value = tag_split[1].strip()
+
+        # flag tags, in the format TagName
+        elif len(tag_split) == 1:
+            tag_name = tag_split[0].strip()
+            tag_value = True
+
+        # if the tag name is already in the tag_dict, fetch its corresponding list; else, return an empty list
+        new_list = body_tags.get(tag_name, [])
+
+        # if the value is already in the tag_dict, ignore it (removes tags that get duplicated in body
+        # and tag list)
+        if tag_value not in new_list:
+            new_list.append(tag_value)
+        body_tags[_intern(tag_name)] = new_list
+    return body_tags
+
+
+def get_annotation_type(references, text_tags, body_tags, default=AnnotationType.INVALID.name):
+    """Returns the AnnotationType name of an annotation from its references and parsed tags"""
+    if len(references) > 0:
+        return AnnotationType.REPLY.name
+    # checking for evidence statement annotation
+    elif any([key in body_tags for key in EVIDENCE_TAGS]):
+        return AnnotationType.EVIDENCE.name
+
+    # checking for article info annotation
+    elif any([key in text_tags for key in INFORMATION_TAGS]):
+        return AnnotationType.INFORMATION.name
+
+    # checking for methodology annotation
+    elif any([key in text_tags for key in METHODOLOGY_TAGS]):
+        return AnnotationType.METHODOLOGY.name
+
+    # checking for case annotation
+    elif any([key in text_tags for key in CASE_TAGS]):
+        return AnnotationType.CASE.name
+
+    # checking for COHORT annotation
+    elif any([key in text_tags for key in COHORT_TAGS]):
+        return AnnotationType.COHORT.name
+
+    # checking for experiment assay annotation
+    elif any([key in body_tags for key in ASSAY_TAGS]):
+        return AnnotationType.ASSAY.name
+
+    return default
+
+
+def parse_tags(d):
+    """
+    Parses the tags and type of a raw annotation dictionary without creating an annotation
+    @param d: raw annotation dictionary
+    @return: tuple of its text_tags, body_tags and type
+    """
+    text_tags = {k: _copy_tag_list(v) for k, v in (d.get("text_tags") or {}).items()}
+    body_tags = {k: _copy_tag_list(v) for k, v in (d.get("body_tags") or {}).items()}
+    get_tags_from_text(d["text"], text_tags)
+    get_tags_from_tags_list(d["tags"], body_tags)
+    type_ = get_annotation_type(d.get("references") or [], text_tags, body_tags,
+                                d.get("type", AnnotationType.INVALID.name))
+    return text_tags, body_tags, type_
+
+
+# only the fields that parse_tags reads are sent to the worker processes
+_PARSE_FIELDS = ("text", "tags", "references", "text_tags", "body_tags", "type")
+
+# annotations are sent to the worker processes in chunks of this size; smaller batches are parsed serially
+PARSE_CHUNK_SIZE = 500
+
+
+def _parse_chunk(chunk):
+    return [parse_tags(d) for d in chunk]
+
+
+def parse_annotations(rows, processes=1, chunk_size=PARSE_CHUNK_SIZE, executor=None):
+    """
+    Creates AugmentedAnnotations from many raw annotation dictionaries, optionally parsing their tags on a process
+    pool. Only the parsing is spread over the pool; the annotations are built in this process, which takes almost as
+    long, so the pool only pays off for large groups on several cores and is off by default
+    @param rows: iterable of raw annotation dictionaries
+    @param processes: number of worker processes of a pool started for this call; None uses one per cpu, and 1 parses
+        in this process
+    @param chunk_size: number of annotations sent to a worker at once
+    @param executor: ProcessPoolExecutor to parse on instead of starting a pool, for callers that parse many batches
+    @return: list of AugmentedAnnotations, in the same order as rows
+    """
+    rows = list(rows)
+    processes = processes or os.cpu_count() or 1
+    if (executor is None and processes == 1) or len(rows) < 2 * chunk_size:
+        return [AugmentedAnnotation.from_dict(d) for d in rows]
+
+    chunks = [[{k: d[k] for k in _PARSE_FIELDS if k in d} for d in rows[i:i + chunk_size]]
+              for i in range(0, len(rows), chunk_size)]
+    if executor is not None:
+        parsed = [result for chunk in executor.map(_parse_chunk, chunks) for result in chunk]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parsed = [result for chunk in pool.map(_parse_chunk, chunks) for result in chunk]
+
+    return [AugmentedAnnotation.from_parsed(d, p) for d, p in zip(rows, parsed)]
+
+
 class HypothesisAnnotation:
     """The base class for a hypothesis annotation
 
-    This class only holds the data that a hypothesis annotation holds, with no additional functionality
+    This class only holds the data that a hypothesis annotation holds, with no additional functionality. Strings that
+    repeat across annotations (users, groups and tags) are interned. The bulky permissions, target, document and
+    user_info fields are kept as the objects of the raw record, which are shared rather than copied; permissions,
+    document and user_info given as json strings are only decoded when they are accessed. The source uri of the target is kept as the plain
+    'source' attribute, since it is used often
     """
-    id: str
-    created: str
-    updated: str
-    user: str
-    uri: str
-    text: str
-    tags: List[str]
-    group: str
-    permissions: Dict[str, List[str]]
-    target: List[Dict[str, List]]
-    document: Dict[str, List[str]]
-    links: Dict[str, str]
-    flagged: bool
-    hidden: bool
-    user_info: Dict[str, str]
-    references: List[str] = field(default_factory=list)
+    __slots__ = ("id", "created", "updated", "user", "uri", "text", "tags", "group", "_permissions", "_target",
+                 "source", "_document", "links", "flagged", "hidden", "_user_info", "references")
+
+    permissions = _raw_field("permissions")
+    document = _raw_field("document")
+    user_info = _raw_field("user_info")
+
+    def __init__(self, id: str, created: str, updated: str, user: str, uri: str, text: str, tags: List[str],
+                 group: str, permissions: Dict[str, List[str]], target: List[Dict[str, List]],
+                 document: Dict[str, List[str]], links: Dict[str, str], flagged: bool, hidden: bool,
+                 user_info: Dict[str, str], references: List[str] = None):
+        self.id = id
+        self.created = created
+        self.updated = updated
+        self.user = _intern(user)
+        self.uri = uri
+        self.text = text
+        self.tags = [_intern(tag) for tag in tags]
+        self.group = _intern(group)
+        self.permissions = permissions
+        self.target = target
+        self.document = document
+        self.links = dict(links)
+        self.flagged = flagged
+        self.hidden = hidden
+        self.user_info = user_info
+        self.references = list(references) if references else []
+
+    @property
+    def target(self):
+        return self._target
+
+    @target.setter
+    def target(self, value):
+        # the source uri is read for nearly every annotation, so a json string target is decoded right away
+        if isinstance(value, str):
+            value = json.loads(value)
+        self._target = value
+        self.source = value[0].get("source") if value else None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(id={self.id!r}, user={self.user!r}, uri={self.uri!r})"
 
     @staticmethod
     def from_dict(d):
-        new_annotation = HypothesisAnnotation(**copy.deepcopy(d))
+        new_annotation = HypothesisAnnotation(**d)
         return new_annotation
 
 
-@dataclass
 class AugmentedAnnotation(HypothesisAnnotation):
     """Augmented Hypothesis Annotation class
 
     This class contains additional properties and methods for parsing and storing tags embedded into the annotation
     body, along with converting all tags to a dictionary (rather than a string)
     """
-    text_tags: Dict[str, str] = field(default_factory=dict)
-    body_tags: Dict[str, str] = field(default_factory=dict)
-    type: str = AnnotationType.INVALID.name
+    __slots__ = ("text_tags", "body_tags", "type")
+
+    def __init__(self, *args, text_tags: Dict[str, str] = None, body_tags: Dict[str, str] = None,
+                 type: str = AnnotationType.INVALID.name, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the tag lists are used as they are; from_dict and parse_tags copy them before parsing adds to them
+        self.text_tags = {_intern(k): v for k, v in (text_tags or {}).items()}
+        self.body_tags = {_intern(k): v for k, v in (body_tags or {}).items()}
+        self.type = type
 
     def _get_tags_from_text(self):
-        tag_match = re.finditer(BODY_TAG_REGEX, self.text)
-        if tag_match:
-            # TODO: some assertion/error checking on tag_dict
-            for match in tag_match:
-                tag_dict = match.groupdict()
-                tag_name = tag_dict["name"]
-                tag_value = tag_dict["body"].strip()
-
-                # if the tag name is already in the tag_dict, fetch its corresponding list; else, return an empty list
-                new_list = self.text_tags.get(tag_name, [])
-
-                # if the value is already in the tag_dict, ignore it (removes tags that get duplicated in body
-                # and tag list)
-                if tag_value not in new_list:
-                    new_list.append(tag_value)
-                self.text_tags[tag_name] = new_list
-        else:  # error or log something here
-            pass
+        get_tags_from_text(self.text, self.text_tags)
 
     def _get_tags_from_tags_list(self):
-        for tag in self.tags:
-            tag_split = tag.split(":")
-            tag_name = ""
-            tag_value = ""
-
-            # double tags, in the format TagName1:TagName2:TagValue i.e., AgeOfPresentation
-            if len(tag_split) == 3:
-                tag_name = tag_split[0].strip()
-                tag_name2 = tag_split[1].strip()
-                tag_value = {tag_name2: tag_split[2].strip()}
-
-            # normal tags in the format TagName:TagValue
-            elif len(tag_split) == 2:
-                tag_name = tag_split[0].strip()
-                tag_value = tag_split[1].strip()
-
-            # flag tags, in the format TagName
-            elif len(tag_split) == 1:
-                tag_name = tag_split[0].strip()
-                tag_value = True
-
-            # if the tag name is already in the tag_dict, fetch its corresponding list; else, return an empty list
-            new_list = self.body_tags.get(tag_name, [])
-
-            # if the value is already in the tag_dict, ignore it (removes tags that get duplicated in body
-            # and tag list)
-            if tag_value not in new_list:
-                new_list.append(tag_value)
-            self.body_tags[tag_name] = new_list
+        get_tags_from_tags_list(self.tags, self.body_tags)
 
     def _assign_type(self):
-        if len(self.references) > 0:
-            self.type = AnnotationType.REPLY.name
-        # checking for evidence statement annotation
-        elif any([key in self.body_tags for key in EVIDENCE_TAGS]):
-            self.type = AnnotationType.EVIDENCE.name
-
-        # checking for article info annotation
-        elif any([key in self.text_tags for key in INFORMATION_TAGS]):
-            self.type = AnnotationType.INFORMATION.name
-
-        # checking for methodology annotation
-        elif any([key in self.text_tags for key in METHODOLOGY_TAGS]):
-            self.type = AnnotationType.METHODOLOGY.name
-
-        # checking for case annotation
-        elif any([key in self.text_tags for key in CASE_TAGS]):
-            self.type = AnnotationType.CASE.name
-
-        # checking for COHORT annotation
-        elif any([key in self.text_tags for key in COHORT_TAGS]):
-            self.type = AnnotationType.COHORT.name
-
-        # checking for experiment assay annotation
-        elif any([key in self.body_tags for key in ASSAY_TAGS]):
-            self.type = AnnotationType.ASSAY.name
+        self.type = get_annotation_type(self.references, self.text_tags, self.body_tags, self.type)
 
     def as_dict(self):
-        return asdict(self)
+        return {
+            "id": self.id,
+            "created": self.created,
+            "updated": self.updated,
+            "user": self.user,
+            "uri": self.uri,
+            "text": self.text,
+            "tags": list(self.tags),
+            "group": self.group,
+            "permissions": self.permissions,
+            "target": self.target,
+            "document": self.document,
+            "links": dict(self.links),
+            "flagged": self.flagged,
+            "hidden": self.hidden,
+            "user_info": self.user_info,
+            "references": list(self.references),
+            "text_tags": {k: _copy_tag_list(v) for k, v in self.text_tags.items()},
+            "body_tags": {k: _copy_tag_list(v) for k, v in self.body_tags.items()},
+            "type": self.type
+        }
+
+    @staticmethod
+    def from_parsed(d, parsed):
+        """Creates an annotation from a raw dictionary and the (text_tags, body_tags, type) parse_tags returned for
+        it, without parsing it again"""
+        text_tags, body_tags, type_ = parsed
+        return AugmentedAnnotation(**{**d, "text_tags": text_tags, "body_tags": body_tags, "type": type_})
 
     @staticmethod
     def from_dict(d):
-        new_annotation = AugmentedAnnotation(**copy.deepcopy(d))
-        new_annotation._get_tags_from_text()
-        new_annotation._get_tags_from_tags_list()
-        new_annotation._assign_type()
-        return new_annotation
+        # parse_tags copies the tag lists of d, so parsing doesn't change the caller's dictionary
+        return AugmentedAnnotation.from_parsed(d, parse_tags(d))
 
     # this function returns a dataframe with a couple of caveats:
     # 1.    if the tag came from the body, it will be prepended with the BODY_TAGS_NAME constant, otherwise if it comes from
@@ -214,7 +374,7 @@ class AugmentedAnnotation(HypothesisAnnotation):
             record = {
                 "type": annotation.type,
                 'uri': annotation.links['html'],
-                "source": annotation.target[0]['source'],
+                "source": annotation.source,
                 "text": annotation.text
             }
             record.update({f'{TEXT_TAGS_NAME}.{k}': v for k, v in annotation.text_tags.items()})
@@ -227,3 +387,79 @@ class AugmentedAnnotation(HypothesisAnnotation):
         df = pd.DataFrame.from_records(record_list)
         df = df.pipe(_fix_df_nan)
         return df
+
+    # this function returns the tags of the annotations in long format, with one row per tag value:
+    #   annotation_id: the id of the annotation; its category codes are the positions of the annotations in the list,
+    #                  which match the index of df_from_annotations
+    #   source: TEXT_TAGS_NAME or BODY_TAGS_NAME, depending on where the tag came from
+    #   tag: the name of the tag
+    #   column: source.tag, the name of the tag's column in df_from_annotations
+    #   value: the value as a string. Flag tags have the value 'True', and double tags 'TagName2:TagValue'
+    #   ordinal: the position of the value in the tag's list of values
+    # all columns but ordinal are categorical, so repeated ids, tag names and values are only stored once
+    @staticmethod
+    def tag_table_from_annotations(annotations: List[AugmentedAnnotation]):
+        ids = []
+        sources = []
+        tags = []
+        values = []
+        ordinals = []
+        for position, annotation in enumerate(annotations):
+            for source, tag_dict in ((TEXT_TAGS_NAME, annotation.text_tags), (BODY_TAGS_NAME, annotation.body_tags)):
+                for tag, tag_values in tag_dict.items():
+                    for ordinal, value in enumerate(tag_values):
+                        ids.append(position)
+                        sources.append(source)
+                        tags.append(tag)
+                        values.append(_tag_value_to_str(value))
+                        ordinals.append(ordinal)
+
+        annotation_ids = [annotation.id for annotation in annotations]
+        df = pd.DataFrame({
+            "annotation_id": pd.Categorical.from_codes(np.asarray(ids, dtype=np.int32),
+                                                       categories=pd.Index(annotation_ids, dtype=object)),
+            "source": pd.Categorical(sources, categories=[TEXT_TAGS_NAME, BODY_TAGS_NAME]),
+            "tag": pd.Categorical(tags),
+            "value": pd.Categorical(values),
+            "ordinal": np.asarray(ordinals, dtype=np.int16)
+        })
+        df.insert(3, "column", pd.Categorical(df["source"].astype(str) + "." + df["tag"].astype(str)))
+        return df
+
+
+def _tag_value_to_str(value):
+    if isinstance(value, dict):
+        return ":".join(f"{k}:{v}" for k, v in value.items())
+    return str(value)
+
+
+def tag_values(tag_df: pd.DataFrame, column: str):
+    """
+    Returns every value of one tag column of a tag table, in order
+    @param tag_df: tag table from AugmentedAnnotation.tag_table_from_annotations
+    @param column: tag column, i.e. BODY.MutationType
+    @return: series of string values, indexed by the position of their annotation
+    """
+    rows = tag_df[tag_df["column"] == column]
+    return pd.Series(rows["value"].astype(object).to_numpy(), index=rows["annotation_id"].cat.codes.to_numpy(),
+                     name=column)
+
+
+def first_tag_values(tag_df: pd.DataFrame, columns: List[str]):
+    """
+    Pivots the first value of some tag columns of a tag table into a wide dataframe
+    @param tag_df: tag table from AugmentedAnnotation.tag_table_from_annotations
+    @param columns: tag columns to pivot, i.e. BODY.MutationType
+    @return: dataframe with one row per annotation (in the same order as df_from_annotations) and one column per tag
+        column; annotations without the tag are NaN
+    """
+    rows = tag_df[(tag_df["ordinal"] == 0) & tag_df["column"].isin(columns)]
+    wide = pd.DataFrame({
+        "annotation": rows["annotation_id"].cat.codes.to_numpy(),
+        "column": rows["column"].astype(object).to_numpy(),
+        "value": rows["value"].astype(object).to_numpy()
+    }).pivot(index="annotation", columns="column", values="value")
+    wide = wide.reindex(index=pd.RangeIndex(len(tag_df["annotation_id"].cat.categories)), columns=list(columns))
+    wide.columns.name = None
+    return wide
+
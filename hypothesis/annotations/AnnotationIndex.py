@@ -0,0 +1,171 @@
+from __future__ import annotations
+import re
+from collections import defaultdict
+from typing import List
+
+import numpy as np
+
+from .Annotation import AugmentedAnnotation, TEXT_TAGS_NAME, BODY_TAGS_NAME
+
+# matches the pubmed id in both https://pubmed.ncbi.nlm.nih.gov/<pmid> and https://www.ncbi.nlm.nih.gov/pubmed/<pmid>
+PMID_URI_REGEX = re.compile(r"pubmed(?:\.ncbi\.nlm\.nih\.gov)?/(\d+)")
+TOKEN_REGEX = re.compile(r"\w+")
+
+_EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def _intersect(a: np.ndarray, b: np.ndarray):
+    """Intersection of two sorted arrays of unique positions, found by binary searching the smaller in the larger"""
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    found = np.searchsorted(b, a)
+    found[found == len(b)] = 0
+    return a[b[found] == a]
+
+
+class AnnotationQuery:
+    """A set of annotations of an AnnotationIndex, stored as a sorted array of their positions
+
+    Queries are combined with & (and), | (or) and - (and not), which work on the sorted arrays directly. A chain of &
+    is only evaluated when its positions are needed, starting from its smallest operand, so a selective query costs
+    about the size of its most selective term rather than the number of annotations.
+    """
+    __slots__ = ("index", "_positions", "_terms")
+
+    def __init__(self, index: AnnotationIndex, positions: np.ndarray = None, terms: List[np.ndarray] = None):
+        self.index = index
+        self._positions = positions
+        self._terms = terms
+
+    @property
+    def positions(self) -> np.ndarray:
+        if self._positions is None:
+            terms = sorted(self._terms, key=len)
+            positions = terms[0]
+            for term in terms[1:]:
+                positions = _intersect(positions, term)
+            self._positions = positions
+        return self._positions
+
+    def __and__(self, other: AnnotationQuery):
+        return AnnotationQuery(self.index, terms=self._and_terms() + other._and_terms())
+
+    def _and_terms(self):
+        return self._terms if self._positions is None else [self._positions]
+
+    def __or__(self, other: AnnotationQuery):
+        return AnnotationQuery(self.index, np.union1d(self.positions, other.positions))
+
+    def __sub__(self, other: AnnotationQuery):
+        return AnnotationQuery(self.index, np.setdiff1d(self.positions, other.positions, assume_unique=True))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return f"AnnotationQuery({len(self)} annotations)"
+
+    @property
+    def ids(self):
+        return self.index.ids[self.positions]
+
+    @property
+    def annotations(self) -> List[AugmentedAnnotation]:
+        return [self.index.annotations[p] for p in self.positions]
+
+
+class AnnotationIndex:
+    """In-memory inverted index over a list of parsed annotations
+
+    Each key maps to the sorted positions of the annotations that have it. The keys are the annotation type, tag names,
+    tag values, PMIDs, source uris and lowercase word tokens of the text. Annotations are indexed under a PMID if they
+    have it as a PMID tag, if their source uri is a pubmed page for it, or if another annotation on their source uri
+    has it as a PMID tag; that way, case and cohort annotations are found by the PMID of their paper's information
+    annotation. Positions are the same as the row positions of AugmentedAnnotation.df_from_annotations.
+
+    The index is for repeated, selective lookups, such as the annotations of one paper or the cases with a given tag
+    value. Building it takes about a second per 20k annotations, much longer than one pass of a boolean filter over
+    the annotation frame, so the statistics of hypothesis.features.summary, which each scan every annotation of a type
+    once, filter the frame instead. Queries are built from the index and combined, and their positions select rows
+    of the frame:
+
+        index = AnnotationIndex(annotations)
+        query = index.type(AnnotationType.CASE.name) & index.tag("FamilyPedigree", BODY_TAGS_NAME) & index.pmid(pmid)
+        cases = query.annotations
+        case_df = AugmentedAnnotation.df_from_annotations(annotations).iloc[query.positions]
+    """
+
+    def __init__(self, annotations: List[AugmentedAnnotation]):
+        self.annotations = annotations
+        self.ids = np.asarray([annotation.id for annotation in annotations], dtype=object)
+
+        postings = {name: defaultdict(list) for name in ("type", "tag", "value", "source", "token")}
+        uri_pmids = defaultdict(set)
+        for position, annotation in enumerate(annotations):
+            postings["type"][annotation.type].append(position)
+            postings["source"][annotation.source].append(position)
+
+            for source, tag_dict in ((TEXT_TAGS_NAME, annotation.text_tags), (BODY_TAGS_NAME, annotation.body_tags)):
+                for tag, values in tag_dict.items():
+                    postings["tag"][(source, tag)].append(position)
+                    postings["tag"][(None, tag)].append(position)
+                    for value in {str(v) for v in values}:
+                        postings["value"][(source, tag, value)].append(position)
+                        postings["value"][(None, tag, value)].append(position)
+
+            for token in {token.casefold() for token in TOKEN_REGEX.findall(annotation.text)}:
+                postings["token"][token].append(position)
+
+            uri_match = PMID_URI_REGEX.search(annotation.source or "")
+            if uri_match:
+                uri_pmids[annotation.source].add(uri_match.group(1))
+            for pmid in annotation.text_tags.get("PMID", []):
+                uri_pmids[annotation.source].add(str(pmid).strip())
+
+        # an annotation can be listed twice for the same key, i.e. a tag in both its text and its tags
+        self._postings = {name: {key: np.unique(np.asarray(positions, dtype=np.int32))
+                                 for key, positions in keyed.items()}
+                          for name, keyed in postings.items()}
+
+        pmid_postings = defaultdict(list)
+        for uri, pmids in uri_pmids.items():
+            for pmid in pmids:
+                pmid_postings[pmid].append(self._postings["source"][uri])
+        self._postings["pmid"] = {pmid: np.unique(np.concatenate(arrays)) for pmid, arrays in pmid_postings.items()}
+
+    def _query(self, name, key):
+        return AnnotationQuery(self, self._postings[name].get(key, _EMPTY))
+
+    def all(self):
+        return AnnotationQuery(self, np.arange(len(self.annotations), dtype=np.int32))
+
+    def type(self, *annotation_types):
+        """Annotations of any of the given AnnotationType names"""
+        queries = [self._query("type", annotation_type) for annotation_type in annotation_types]
+        query = queries[0] if queries else AnnotationQuery(self, _EMPTY)
+        for other in queries[1:]:
+            query = query | other
+        return query
+
+    def tag(self, tag, source=None):
+        """Annotations that have a tag, from the text or body tags (source), or either if source is None"""
+        return self._query("tag", (source, tag))
+
+    def value(self, tag, value, source=None):
+        """Annotations that have a tag with the given value"""
+        return self._query("value", (source, tag, str(value)))
+
+    def pmid(self, pmid):
+        """Annotations on the paper with the given PMID"""
+        return self._query("pmid", str(pmid))
+
+    def source(self, uri):
+        """Annotations on the given source uri"""
+        return self._query("source", uri)
+
+    def text(self, words):
+        """Annotations whose text contains every word of words, ignoring case"""
+        terms = [self._postings["token"].get(token.casefold(), _EMPTY) for token in TOKEN_REGEX.findall(words)]
+        return AnnotationQuery(self, terms=terms) if terms else self.all()
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, Iterator, Optional
+
+from .Annotation import AugmentedAnnotation
+
+# number of annotations written to each shard before a new one is started
+ANNOTATION_SHARD_SIZE = 1000
+
+STORE_INDEX_FILENAME = "index.json"
+# suffixes of the sibling directories a store's replacement is written to, and its old contents are moved to
+STAGING_SUFFIX = ".staging"
+BACKUP_SUFFIX = ".old"
+
+
+class AnnotationStore:
+    """Sharded, append-only JSON-lines store of hypothes.is annotations
+
+    Annotations are appended one per line to numbered shard files, and a sidecar index maps each annotation id to the
+    shard, byte offset and length of its newest line. When compressed, every line is its own gzip member, so a shard
+    can still be streamed as a whole while a single annotation is read by seeking straight to it. Appending an
+    annotation with an id that is already stored replaces it, without rewriting anything else.
+    """
+
+    def __init__(self, directory: str, shard_size: int = ANNOTATION_SHARD_SIZE, compress: bool = True):
+        self.directory = directory
+        self.shard_size = shard_size
+        self._restore_backup()
+        os.makedirs(directory, exist_ok=True)
+
+        self.index_path = os.path.join(directory, STORE_INDEX_FILENAME)
+        self.compress = compress
+        self.shard_counts = []
+        self.ids: Dict[str, list] = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            # an existing store keeps the compression it was written with
+            self.compress = index["compress"]
+            self.shard_counts = index["shards"]
+            self.ids = index["ids"]
+
+    def _restore_backup(self):
+        """Moves the old contents back in place when replace_with was interrupted after moving them aside"""
+        backup_directory = self.directory.rstrip(os.sep) + BACKUP_SUFFIX
+        if not os.path.isdir(self.directory) and os.path.isdir(backup_directory):
+            os.replace(backup_directory, self.directory)
+
+    def _shard_path(self, shard: int):
+        extension = ".jsonl.gz" if self.compress else ".jsonl"
+        return os.path.join(self.directory, f"{shard:05d}{extension}")
+
+    def _save_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"compress": self.compress, "shards": self.shard_counts, "ids": self.ids}, file)
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, annotation_id):
+        return annotation_id in self.ids
+
+    def clear(self):
+        """Removes all shards and the index"""
+        for shard in range(len(self.shard_counts)):
+            if os.path.isfile(self._shard_path(shard)):
+                os.remove(self._shard_path(shard))
+        self.shard_counts = []
+        self.ids = {}
+        self._save_index()
+
+    def staging(self) -> AnnotationStore:
+        """
+        Creates an empty store in a sibling directory, for fetching a replacement of this store into. Anything left
+        there by an earlier, failed fetch is removed first
+        @return: the staging store, to be passed to replace_with once it is complete
+        """
+        self._restore_backup()
+        staging_directory = self.directory.rstrip(os.sep) + STAGING_SUFFIX
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        return AnnotationStore(staging_directory, self.shard_size, self.compress)
+
+    def replace_with(self, staged: AnnotationStore):
+        """Replaces the contents of this store with a complete staging store, whose directory is moved in its place"""
+        backup_directory = self.directory.rstrip(os.sep) + BACKUP_SUFFIX
+        shutil.rmtree(backup_directory, ignore_errors=True)
+        os.replace(self.directory, backup_directory)
+        os.replace(staged.directory, self.directory)
+        shutil.rmtree(backup_directory, ignore_errors=True)
+
+        self.compress = staged.compress
+        self.shard_counts = staged.shard_counts
+        self.ids = staged.ids
+
+    def append(self, annotations):
+        """
+        Appends annotations to the store, replacing stored annotations that have the same id
+        @param annotations: iterable of raw annotation dictionaries or AugmentedAnnotations
+        """
+        file = None
+        try:
+            for annotation in annotations:
+                row = annotation if isinstance(annotation, dict) else annotation.as_dict()
+                if not self.shard_counts or self.shard_counts[-1] >= self.shard_size:
+                    if file is not None:
+                        file.close()
+                    self.shard_counts.append(0)
+                    file = None
+                if file is None:
+                    file = open(self._shard_path(len(self.shard_counts) - 1), "ab")
+
+                line = (json.dumps(row) + "\n").encode("utf-8")
+                data = gzip.compress(line) if self.compress else line
+                offset = file.tell()
+                file.write(data)
+                self.ids[row["id"]] = [len(self.shard_counts) - 1, offset, len(data)]
+                self.shard_counts[-1] += 1
+        finally:
+            if file is not None:
+                file.close()
+            self._save_index()
+
+    def write(self, annotations):
+        """Replaces the whole contents of the store with annotations"""
+        self.clear()
+        self.append(annotations)
+
+    def _read_line(self, data: bytes):
+        return json.loads(gzip.decompress(data) if self.compress else data)
+
+    def get_dict(self, annotation_id: str) -> Optional[dict]:
+        """Reads the raw dictionary of a single annotation, without parsing any other line"""
+        location = self.ids.get(annotation_id)
+        if location is None:
+            return None
+        shard, offset, length = location
+        with open(self._shard_path(shard), "rb") as file:
+            file.seek(offset)
+            return self._read_line(file.read(length))
+
+    def get(self, annotation_id: str) -> Optional[AugmentedAnnotation]:
+        row = self.get_dict(annotation_id)
+        return AugmentedAnnotation.from_dict(row) if row is not None else None
+
+    def iter_dicts(self) -> Iterator[dict]:
+        """Lazily yields the raw dictionary of every stored annotation, shard by shard, in the order they were added"""
+        # only the newest line of each id is in the index, so superseded versions of replaced annotations are skipped
+        locations = sorted(self.ids.values())
+        shard = None
+        file = None
+        try:
+            for line_shard, offset, length in locations:
+                if line_shard != shard:
+                    if file is not None:
+                        file.close()
+                    shard = line_shard
+                    file = open(self._shard_path(shard), "rb")
+                file.seek(offset)
+                yield self._read_line(file.read(length))
+        finally:
+            if file is not None:
+                file.close()
+
+    def __iter__(self) -> Iterator[AugmentedAnnotation]:
+        return (AugmentedAnnotation.from_dict(row) for row in self.iter_dicts())
@@ -0,0 +1,100 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from .Annotation import AugmentedAnnotation
+from .AnnotationStore import AnnotationStore
+
+# Measures how fast raw annotation dictionaries are turned into AugmentedAnnotations, and how much memory each one
+# takes. By default it uses synthetic annotations shaped like the ones the hypothes.is api returns; --store uses the
+# annotations of an AnnotationStore instead. Run from the root of the repository with:
+#   py -m hypothesis.annotations.benchmark
+
+USERS = [f"acct:annotator{i}@hypothes.is" for i in range(12)]
+GROUP = "dKymJJpZ"
+TEXT_TEMPLATES = [
+    "PMID: {pmid}\nGene: VHL\nStandardizedReferenceSequence: NM_000551.3",
+    "CasePresentingHPOs: HP:0002666; HP:0000505\nAgeOfPresentation: {age}\nSex: {sex}",
+    "GroupPresentingHPOs: HP:0001737\nCohortSize: {age}",
+    "ArticleReferenceSequence: NM_000551.2\nGenotypingMethod: Sanger\nSamplingMethod: blood",
+]
+TAGS = [["Variant:c.{pos}C>T", "MutationType:missense_variant", "CAID:CA{pos}", "ClinVarID:{pos}"],
+        ["EvidenceStatement", "ExperimentalAssay:western blot"],
+        ["FamilyPedigree", "Variant:c.{pos}del", "MutationType:frameshift_variant", "AgeOfPresentation:Years:{age}"]]
+
+
+def synthetic_annotations(count, seed=0):
+    """Creates count raw annotation dictionaries with the shape of hypothes.is api search results"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        user = rng.choice(USERS)
+        pmid = rng.randint(10000000, 30000000)
+        pos = rng.randint(1, 642)
+        fill = {"pmid": pmid, "pos": pos, "age": rng.randint(1, 80), "sex": rng.choice(["M", "F"])}
+        uri = f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
+        rows.append({
+            "id": f"{i:022x}",
+            "created": f"2020-01-01T00:00:{i % 60:02d}.{i:06d}+00:00",
+            "updated": f"2020-01-02T00:00:{i % 60:02d}.{i:06d}+00:00",
+            "user": user,
+            "uri": uri,
+            "text": rng.choice(TEXT_TEMPLATES).format(**fill),
+            "tags": [tag.format(**fill) for tag in rng.choice(TAGS)],
+            "group": GROUP,
+            "permissions": {"read": [f"group:{GROUP}"], "admin": [user], "update": [user], "delete": [user]},
+            "target": [{"source": uri, "selector": [
+                {"type": "RangeSelector", "endOffset": 120, "startOffset": 0, "endContainer": "/div[1]/p[2]",
+                 "startContainer": "/div[1]/p[1]"},
+                {"end": 5120, "type": "TextPositionSelector", "start": 5000},
+                {"type": "TextQuoteSelector", "exact": "a germline VHL variant was identified in the proband " * 2,
+                 "prefix": "In this family, ", "suffix": " and segregated with disease"}]}],
+            "document": {"title": [f"Von Hippel-Lindau disease in kindred {pmid}"],
+                         "dc": {"identifier": [f"doi:10.1000/{pmid}"]},
+                         "highwire": {"pmid": [str(pmid)], "doi": [f"10.1000/{pmid}"]}},
+            "links": {"html": f"https://hypothes.is/a/{i:022x}", "incontext": f"https://hyp.is/{i:022x}/{uri}",
+                      "json": f"https://hypothes.is/api/annotations/{i:022x}"},
+            "flagged": False,
+            "hidden": False,
+            "user_info": {"display_name": user.split(":")[1].split("@")[0]},
+            "references": [],
+        })
+    return rows
+
+
+def run_benchmark(rows, repeat=3):
+    """
+    Parses rows into AugmentedAnnotations
+    @param rows: raw annotation dictionaries
+    @param repeat: the fastest of this many runs is reported
+    @return: tuple of annotations parsed per second and bytes allocated per annotation
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        annotations = [AugmentedAnnotation.from_dict(row) for row in rows]
+        best = min(best, time.perf_counter() - start)
+        del annotations
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    annotations = [AugmentedAnnotation.from_dict(row) for row in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return len(rows) / best, (after - before) / len(annotations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', help="Number of synthetic annotations", type=int, default=5000)
+    parser.add_argument('-s', '--store', help="Benchmark the annotations of an AnnotationStore directory instead")
+    args = parser.parse_args()
+
+    rows = list(AnnotationStore(args.store).iter_dicts()) if args.store else synthetic_annotations(args.count)
+    per_second, per_annotation = run_benchmark(rows)
+    print(f"{len(rows)} annotations: {per_second:,.0f} annotations/s, {per_annotation:,.0f} bytes/annotation")
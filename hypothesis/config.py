@@ -6,6 +6,10 @@ INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files", "i
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files", "output")
 LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'lib')
 ANNOTATION_OUTPUT = "hypothesis_annotations.json"
+# directory of the sharded json-lines annotation store, which replaces ANNOTATION_OUTPUT
+ANNOTATION_STORE = "hypothesis_annotations"
+# time of the last incremental sync and full reconciliation of ANNOTATION_STORE
+SYNC_STATE = "sync_state.json"
 
 PROBLEM_ANNOTATIONS = "problem_annotations.csv"
 ANNOTATION_SUMMARY = "annotation_summary.csv"
@@ -13,6 +17,8 @@ ANNOTATION_SUMMARY = "annotation_summary.csv"
 # constants relating to the hypothesis 'VHL Annotations' group
 GROUP_ID = "dKymJJpZ" # VHL annotations group
 GROUP_EPOCH = "2019-08-27T00:00:00" # timestamp before all annotations
+# incremental syncs can't see deleted annotations, so the whole group is fetched again at least this often
+SYNC_RECONCILE_DAYS = 7
 
 # constants relating to VHL annotation processing
 NULL_TERMS = ['n/a', 'N/A', 'NA']
@@ -1,7 +1,8 @@
 from typing import List
-from ..annotations.Annotation import BODY_TAGS_NAME, TEXT_TAGS_NAME, AugmentedAnnotation, AnnotationType
-from ..fetching.clinvar_variants import clinvarid_to_variant_dict
-from ..fetching.caid_variants import get_variant_by_caid
+from ..annotations.Annotation import BODY_TAGS_NAME, TEXT_TAGS_NAME, AugmentedAnnotation, AnnotationType, \
+    first_tag_values, tag_values
+from ..fetching.clinvar_variants import get_clinvar_store
+from ..fetching.caid_variants import resolve_caids
 from ..variant_functions import DISEASE_ENTITY_TO_HPO
 from .. import config
 import pandas as pd
@@ -11,24 +12,26 @@ def _fix_na(df):
     return_df = df.replace(config.NULL_TERMS, [np.nan]*len(config.NULL_TERMS))
     return return_df
 
-def _fix_clinvar(clinvar_list):
-    clinvar_id = None
-    if isinstance(clinvar_list, list):
-        for item in clinvar_list:
-            if str.isdigit(item):
-                clinvar_id = int(item)
-    return clinvar_id
+def _first_values(tag_df, index, columns):
+    # the first value of each tag column, for the annotations in index
+    return first_tag_values(tag_df, columns).reindex(index)
 
-def _caid_to_variant(caid):
+def _clinvar_ids(tag_df, index):
+    # the last numeric ClinVarID tag of each annotation in index
+    clinvar_col = f"{BODY_TAGS_NAME}.ClinVarID"
+    values = tag_values(tag_df, clinvar_col)
+    values = values[values.str.isdigit()].astype(int)
+    return values.groupby(level=0).last().reindex(index).rename(clinvar_col)
+
+def _caid_response_to_variant(variant):
     variant_name = None
-    variant = get_variant_by_caid(caid)
     if variant is not None:
         variant_name = variant['communityStandardTitle'][0]
     return variant_name
 
 
 # paper stats
-def get_unique_clinvar_variants(annotation_df: pd.DataFrame):
+def get_unique_clinvar_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     clinvar_col = f"{BODY_TAGS_NAME}.ClinVarID"
     caid_col = f'{BODY_TAGS_NAME}.CAID'
     civic_col = f'{BODY_TAGS_NAME}.CivicName'
@@ -36,16 +39,14 @@ def get_unique_clinvar_variants(annotation_df: pd.DataFrame):
 
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
-    clinvar_id_series = valid_df[clinvar_col].apply(_fix_clinvar)
+    clinvar_id_series = _clinvar_ids(tag_df, valid_df.index)
 
-    variants_df = pd.concat([valid_df[["type", caid_col, civic_col]], clinvar_id_series], axis=1)
+    variants_df = pd.concat([valid_df[["type"]], _first_values(tag_df, valid_df.index, [caid_col, civic_col]),
+                             clinvar_id_series], axis=1)
 
-
-    variants_df.loc[:, caid_col] = variants_df[caid_col].map(lambda x: x[0] if isinstance(x, list) else np.nan)
-    variants_df.loc[:, civic_col] = variants_df[civic_col].map(lambda x: x[0] if isinstance(x, list) else np.nan)
     variants_df = variants_df.dropna(subset=[clinvar_col, caid_col, civic_col], how='all')
 
-    clinvar_mapped_series = variants_df[clinvar_col].map(clinvarid_to_variant_dict())
+    clinvar_mapped_series = get_clinvar_store().lookup(variants_df[clinvar_col])
     clinvar_mapped_series.name = "Variant"
 
     variants_df = pd.concat([variants_df, clinvar_mapped_series], axis=1)
@@ -55,14 +56,18 @@ def get_unique_clinvar_variants(annotation_df: pd.DataFrame):
     return variants_df
 
 
-def get_unique_caid_variants(annotation_df: pd.DataFrame):
+def get_unique_caid_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     caid_col = f'{BODY_TAGS_NAME}.CAID'
     clinvar_col = f"{BODY_TAGS_NAME}.ClinVarID"
 
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
-    clinvar_id_series = valid_df[clinvar_col].apply(_fix_clinvar)
-    caid_series = valid_df[caid_col].apply(_caid_to_variant)
+    clinvar_id_series = _clinvar_ids(tag_df, valid_df.index)
+    # each unique CAID is resolved once, from the cache if it was resolved on an earlier run
+    caid_series = _first_values(tag_df, valid_df.index, [caid_col])[caid_col]
+    caid_responses = resolve_caids(caid_series)
+    caid_series = caid_series.map({caid: _caid_response_to_variant(response)
+                                   for caid, response in caid_responses.items()})
 
     variants_df = pd.concat([valid_df["type"], clinvar_id_series, caid_series], axis=1)
     variants_df = variants_df.dropna(subset=[caid_col])
@@ -71,7 +76,7 @@ def get_unique_caid_variants(annotation_df: pd.DataFrame):
     counts_df = variants_df
     return counts_df
 
-def get_unique_variants(annotation_df: pd.DataFrame):
+def get_unique_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
     variants_df = valid_df.dropna(subset=["Variant"])
     counts_df = variants_df.groupby('Variant', as_index=False).count()
@@ -79,14 +84,14 @@ def get_unique_variants(annotation_df: pd.DataFrame):
     return counts_df
 
 
-def get_papers(annotation_df: pd.DataFrame):
+def get_papers(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     pmid_col = f'{TEXT_TAGS_NAME}.PMID'
     type_col = "type"
 
     information_df = annotation_df[annotation_df["type"] == AnnotationType.INFORMATION.name]
+    information_df = pd.concat([_first_values(tag_df, information_df.index, [pmid_col]), information_df[type_col]],
+                               axis=1)
     information_df = information_df.dropna(subset=[pmid_col])
-    information_df.loc[:, pmid_col] = information_df[pmid_col].map(lambda x: x[0])
-    information_df = information_df[[pmid_col, type_col]]
     counts_df = information_df.groupby(pmid_col, as_index=False).count()
     return counts_df
 
@@ -101,20 +106,19 @@ def get_papers(annotation_df: pd.DataFrame):
 
 # Questions:
 # Do we count just the evidence / assay tags, or count all instances of ExperimentalAssay?
-def get_experimental_assays(annotation_df: pd.DataFrame):
+def get_experimental_assays(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     assay_col = f'{BODY_TAGS_NAME}.ExperimentalAssay'
     assay_df = annotation_df[annotation_df["type"].isin([AnnotationType.ASSAY.name])]
-    assay_df = assay_df.dropna(subset=[assay_col])
+    assay_df = assay_df[_first_values(tag_df, assay_df.index, [assay_col])[assay_col].notna()]
     return assay_df
 
-def get_unregistered_variants(annotation_df: pd.DataFrame):
+def get_unregistered_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     unreg_col = f'{BODY_TAGS_NAME}.UnregisteredVariant'
     var_col = f'{TEXT_TAGS_NAME}.Variant'
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
+    valid_df = pd.concat([valid_df["type"], _first_values(tag_df, valid_df.index, [unreg_col, var_col])], axis=1)
     valid_df = valid_df.dropna(subset=[unreg_col])
-    valid_df.loc[:, unreg_col] = valid_df[unreg_col].map(lambda x: x[0])
-    valid_df.loc[:, var_col] = valid_df[var_col].map(lambda x: x[0])
 
 
     counts_df = valid_df[[var_col, unreg_col, "type"]]
@@ -123,12 +127,13 @@ def get_unregistered_variants(annotation_df: pd.DataFrame):
 #Questions:
 # right now this is only using the refseq column, which includes refseqs that have been assumed to be standard, but
 # not outrighted stated
-def get_nonstandard_refseq(annotation_df: pd.DataFrame):
+def get_nonstandard_refseq(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     refseq_col = f'{TEXT_TAGS_NAME}.ArticleReferenceSequence'
 
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.METHODOLOGY.name])]
-    refseq_df = valid_df.dropna(subset=[refseq_col])
-    refseq_df.loc[:, refseq_col] = refseq_df[refseq_col].map(lambda x: x[0])
+    refseqs = _first_values(tag_df, valid_df.index, [refseq_col])[refseq_col]
+    refseq_df = valid_df[refseqs.notna()].copy()
+    refseq_df.loc[:, refseq_col] = refseqs.dropna()
 
     refseq_df.loc[:, "StandardRef"] = False
     refseq_df.loc[:, "NonStandardRef"] = False
@@ -140,26 +145,24 @@ def get_nonstandard_refseq(annotation_df: pd.DataFrame):
     return nonstandard_df
 
 
-def get_family_pedigree_variants(annotation_df: pd.DataFrame):
+def get_family_pedigree_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     ped_col = f'{BODY_TAGS_NAME}.FamilyPedigree'
     var_col = f'{TEXT_TAGS_NAME}.Variant'
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
+    valid_df = pd.concat([valid_df["type"], _first_values(tag_df, valid_df.index, [ped_col, var_col])], axis=1)
     valid_df = valid_df.dropna(subset=[ped_col])
-    valid_df.loc[:, ped_col] = valid_df[ped_col].map(lambda x: x[0])
-    valid_df.loc[:, var_col] = valid_df[var_col].map(lambda x: x[0])
 
     counts_df = valid_df[[var_col, ped_col, "type"]]
     return counts_df
 
-def get_previously_published_variants(annotation_df: pd.DataFrame):
+def get_previously_published_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     pub_col = f'{TEXT_TAGS_NAME}.PreviouslyPublished'
     var_col = f'{TEXT_TAGS_NAME}.Variant'
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
+    valid_df = pd.concat([valid_df["type"], _first_values(tag_df, valid_df.index, [pub_col, var_col])], axis=1)
     valid_df = valid_df.dropna(subset=[pub_col])
-    valid_df.loc[:, pub_col] = valid_df[pub_col].map(lambda x: x[0])
-    valid_df.loc[:, var_col] = valid_df[var_col].map(lambda x: x[0])
     valid_df = valid_df.pipe(_fix_na)
     valid_df = valid_df.dropna(subset=[pub_col])
 
@@ -185,7 +188,7 @@ def get_case_tumors(annotation_df: pd.DataFrame):
 def get_penetrance(annotation_df: pd.DataFrame):
     pass
 
-def get_missense_variants(annotation_df: pd.DataFrame):
+def get_missense_variants(annotation_df: pd.DataFrame, tag_df: pd.DataFrame):
     x_labels = ['from_aa', 'to_aa', 'pos']
     y_labels = list(set(DISEASE_ENTITY_TO_HPO.values()))
 
@@ -201,7 +204,7 @@ def get_missense_variants(annotation_df: pd.DataFrame):
     valid_df = annotation_df[annotation_df["type"].isin([AnnotationType.COHORT.name, AnnotationType.CASE.name])]
 
     # clean up the features
-    feature_df = valid_df[[muttype_col, aa_change_col, codon_col]].dropna().applymap(lambda x: x[0]).apply(_fix_na)
+    feature_df = _first_values(tag_df, valid_df.index, [muttype_col, aa_change_col, codon_col]).dropna().pipe(_fix_na)
     feature_df = feature_df.dropna(how='any')
     feature_df = feature_df[feature_df[muttype_col].str.contains('missense_variant')]
 
@@ -209,25 +212,13 @@ def get_missense_variants(annotation_df: pd.DataFrame):
     feature_df[feature_df['to_aa'] == '*'] = 'TER'
     feature_df = feature_df.rename(columns={codon_col: 'pos'})
 
-    # clean up the labels
-    pheno_df = valid_df.loc[feature_df.index, [pheno_col]]
-
-    def _fix_pheno(cell):
-        to_return = []
-        if isinstance(cell, list):
-            for ele in cell:
-                if isinstance(ele, str):
-                    if ele.casefold() in DISEASE_ENTITY_TO_HPO:
-                        to_return.append(DISEASE_ENTITY_TO_HPO[ele.casefold()])
-        else:
-            to_return = []
-
-        if not to_return:
-            to_return.append('asymptomatic')
-
-        return to_return
-
-    pheno_s = pheno_df[pheno_col].map(_fix_pheno)
+    # clean up the labels; annotations without a known disease entity are asymptomatic
+    entities = tag_values(tag_df, pheno_col)
+    entities = entities[entities.index.isin(feature_df.index)]
+    pheno_s = entities.str.casefold().map(DISEASE_ENTITY_TO_HPO).dropna()
+    asymptomatic = feature_df.index.difference(pheno_s.index.unique())
+    pheno_s = pd.concat([pheno_s, pd.Series('asymptomatic', index=asymptomatic, dtype=object)])
+    pheno_s = pheno_s.groupby(level=0).agg(list).reindex(feature_df.index)
     pheno_s = pheno_s.rename('phenotype')
     # s = pheno_s.explode()
 
@@ -278,8 +269,9 @@ def get_all_statistics(annotations: List[AugmentedAnnotation]):
         get_family_pedigree_variants
     ]
     raw_df = AugmentedAnnotation.df_from_annotations(annotations)
+    tag_df = AugmentedAnnotation.tag_table_from_annotations(annotations)
     for fn in statistic_fns:
-        df = raw_df.pipe(fn)
+        df = raw_df.pipe(fn, tag_df)
         df = df.dropna(axis="columns", how="all")
 
         #df = df.reindex(sorted(df.columns), axis=1)
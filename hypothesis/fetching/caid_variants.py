@@ -1,9 +1,41 @@
-import urllib
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
 import json
+from concurrent.futures import ThreadPoolExecutor
+from .. import config
+
 CAID_URL = "https://reg.genome.network/allele/"
 
-def get_variant_by_caid(caid: str):
-    url = f"{CAID_URL}{caid}"
+# responses of the allele registry are cached here, so known alleles are never requested twice
+CAID_CACHE_FILE = os.path.join(config.LIB_DIR, "caid_variants.json")
+
+CAID_MAX_WORKERS = 4
+# the allele registry is a shared public service, so requests are spread out to at most this many per second
+CAID_MAX_REQUESTS_PER_SECOND = 5
+
+
+class RateLimiter(object):
+    """Spaces out calls to wait() across threads so that at most `rate` of them return per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_variant_by_caid(caid: str, base_url=CAID_URL):
+    url = f"{base_url}{caid}"
     request = urllib.request.Request(url, method="GET")
     response_dict = None
     try:
@@ -12,4 +44,71 @@ def get_variant_by_caid(caid: str):
     except urllib.error.HTTPError:
         pass
 
-    return response_dict
\ No newline at end of file
+    return response_dict
+
+
+def _fetch_caid(caid, base_url):
+    """
+    Requests an allele, returning (found, response). Only a 404 counts as a definitive 'not found'; any other
+    failure is returned as (False, None)
+    """
+    request = urllib.request.Request(f"{base_url}{caid}", method="GET")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return True, json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return True, None
+        return False, None
+    except (urllib.error.URLError, OSError):
+        # unreachable registry, timeouts and dropped connections are misses, which are requested again next time
+        return False, None
+
+
+def _save_cache(cache, cache_file):
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(cache, file)
+    os.replace(tmp_file, cache_file)
+
+
+def resolve_caids(caids, base_url=CAID_URL, cache_file=CAID_CACHE_FILE, max_workers=CAID_MAX_WORKERS,
+                  rate=CAID_MAX_REQUESTS_PER_SECOND):
+    """
+    Resolves many CAIDs at once. Duplicates are requested only once, alleles in the cache aren't requested at all,
+    and the rest are requested concurrently under a rate limit and added to the cache
+    @param caids: iterable of CAIDs; missing values are skipped
+    @param base_url: url of the allele registry the CAIDs are appended to
+    @param cache_file: json file the responses are cached in. None disables the cache
+    @param max_workers: number of requests in flight at the same time
+    @param rate: maximum number of requests started per second. 0 disables the limit
+    @return: dictionary of each CAID to its registry response, or None if the registry doesn't have it
+    """
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, "r", encoding="utf-8") as file:
+            cache = json.load(file)
+
+    unique_caids = {caid for caid in caids if isinstance(caid, str) and caid}
+    misses = sorted(unique_caids.difference(cache))
+
+    if misses:
+        limiter = RateLimiter(rate)
+
+        def fetch(caid):
+            limiter.wait()
+            return _fetch_caid(caid, base_url)
+
+        resolved = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for caid, (found, response) in zip(misses, executor.map(fetch, misses)):
+                    if found:
+                        cache[caid] = response
+                        resolved += 1
+        finally:
+            # whatever was resolved is kept even if the batch was interrupted
+            if resolved and cache_file is not None:
+                _save_cache(cache, cache_file)
+
+    return {caid: cache.get(caid) for caid in unique_caids}
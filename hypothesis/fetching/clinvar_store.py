@@ -0,0 +1,146 @@
+import csv
+import hashlib
+import os
+import sqlite3
+
+import pandas as pd
+
+# largest number of parameters bound in a single sqlite statement; older sqlite versions cap this at 999
+MAX_SQL_PARAMETERS = 900
+
+STORE_ASSEMBLY = 'GRCh38'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS variants (variation_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS positions (variation_id INTEGER, chromosome TEXT, start INTEGER, stop INTEGER);
+CREATE INDEX IF NOT EXISTS variants_name ON variants (name);
+CREATE INDEX IF NOT EXISTS positions_location ON positions (chromosome, start, stop);
+"""
+
+
+def _file_checksum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _int_or_none(value):
+    value = (value or '').strip()
+    return int(value) if value.lstrip('-').isdigit() else None
+
+
+class ClinVarStore(object):
+    """Persistent, indexed SQLite copy of the ClinVar variants extracted by fetch_clinvar_vhl_variants.
+
+    Variants are keyed by VariationID, with secondary indexes on their HGVS name and their GRCh38 location. The store
+    remembers the checksum of the tsv it was built from, and is only rebuilt when that file changes.
+
+    Attributes:
+        filename: path of the sqlite database
+        source: path of the tsv file the store is built from
+        connection: the open sqlite connection
+    """
+
+    def __init__(self, filename, source):
+        self.filename = filename
+        self.source = source
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_SCHEMA)
+        self.sync()
+
+    def _get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self):
+        """Rebuilds the store if its source file changed since the last build
+
+        The size and modification time of the source are checked first, so the source is only hashed when they
+        differ from those of the last build.
+
+        Returns:
+            True if the store was rebuilt
+        """
+        stat = os.stat(self.source)
+        signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+        if signature == self._get_meta('signature'):
+            return False
+
+        checksum = _file_checksum(self.source)
+        rebuilt = checksum != self._get_meta('checksum')
+        if rebuilt:
+            self._build()
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                        [('checksum', checksum), ('signature', signature)])
+        return rebuilt
+
+    def _build(self):
+        with self.connection, open(self.source, newline='') as csvfile:
+            self.connection.execute("DELETE FROM variants")
+            self.connection.execute("DELETE FROM positions")
+            reader = csv.DictReader(csvfile, delimiter='\t')
+            variants = []
+            positions = []
+            for row in reader:
+                variation_id = int(row["VariationID"])
+                variants.append((variation_id, row["Name"]))
+                if row.get("Assembly") == STORE_ASSEMBLY:
+                    positions.append((variation_id, row.get("Chromosome"), _int_or_none(row.get("Start")),
+                                      _int_or_none(row.get("Stop"))))
+            # later rows of the same VariationID replace earlier ones, the same as building a dict from the file
+            self.connection.executemany("INSERT OR REPLACE INTO variants VALUES (?, ?)", variants)
+            self.connection.executemany("INSERT INTO positions VALUES (?, ?, ?, ?)", positions)
+
+    def get(self, variation_id, default=None):
+        """Returns the HGVS name of a VariationID"""
+        row = self.connection.execute("SELECT name FROM variants WHERE variation_id = ?",
+                                      (int(variation_id),)).fetchone()
+        return row[0] if row else default
+
+    def ids_by_name(self, name):
+        """Returns the VariationIDs with the given HGVS name"""
+        rows = self.connection.execute("SELECT variation_id FROM variants WHERE name = ?", (name,))
+        return [row[0] for row in rows]
+
+    def ids_by_position(self, chromosome, start, stop=None):
+        """Returns the VariationIDs whose GRCh38 location overlaps [start, stop] on a chromosome"""
+        stop = start if stop is None else stop
+        rows = self.connection.execute(
+            "SELECT DISTINCT variation_id FROM positions WHERE chromosome = ? AND start <= ? AND stop >= ?",
+            (str(chromosome), stop, start))
+        return [row[0] for row in rows]
+
+    def names(self, variation_ids):
+        """
+        Returns a dictionary of the HGVS names of many VariationIDs, looked up in batches
+        @param variation_ids: iterable of VariationIDs; missing values are skipped
+        """
+        ids = sorted({int(v) for v in variation_ids if not pd.isna(v)})
+        names = {}
+        for i in range(0, len(ids), MAX_SQL_PARAMETERS):
+            batch = ids[i:i + MAX_SQL_PARAMETERS]
+            rows = self.connection.execute(
+                f"SELECT variation_id, name FROM variants WHERE variation_id IN ({','.join('?' * len(batch))})",
+                batch)
+            names.update(rows)
+        return names
+
+    def lookup(self, series):
+        """
+        Maps a series of VariationIDs to their HGVS names
+        @param series: series of VariationIDs
+        @return: series of names with the same index; ids that aren't in the store are NaN
+        """
+        return series.map(self.names(series.unique()))
+
+    def as_dict(self):
+        """Returns all VariationIDs and their names as a dictionary"""
+        return dict(self.connection.execute("SELECT variation_id, name FROM variants"))
+
+    def close(self):
+        self.connection.close()
@@ -1,42 +1,152 @@
 import os
 import io
 import gzip
+import logging
+import time
 import urllib.request
 import urllib.parse
 import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from .. import config
+from .clinvar_store import ClinVarStore
+
+try:
+    import resource
+except ImportError:
+    # resource is only available on unix; peak memory just isn't reported elsewhere
+    resource = None
 
 csv.field_size_limit(1310720)
 
 CLINVAR_SUMMARY_URI = 'https://ftp.ncbi.nlm.nih.gov/pub/clinvar/tab_delimited/variant_summary.txt.gz'
 
 CLINVAR_FILE = os.path.join(config.LIB_DIR, "clinvar_vhl.tsv")
+CLINVAR_STORE = os.path.join(config.LIB_DIR, "clinvar_vhl.sqlite")
+
+CLINVAR_GENE = 'VHL'
+CLINVAR_GENE_COLUMN = 'GeneSymbol'
+
+# size of the decompressed blocks the summary is scanned in
+CLINVAR_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# the store is opened once per run; ClinVar is only downloaded the first time it is needed, unless USE_CACHE is set
+_clinvar_store = None
+
+
+def get_clinvar_store():
+    """
+    Returns the indexed store of the VHL ClinVar variants, fetching them first if needed
+    @return: ClinVarStore built from CLINVAR_FILE
+    """
+    global _clinvar_store
+    if _clinvar_store is None:
+        if not config.USE_CACHE or not os.path.isfile(CLINVAR_FILE):
+            fetch_clinvar_vhl_variants(CLINVAR_FILE)
+        _clinvar_store = ClinVarStore(CLINVAR_STORE, CLINVAR_FILE)
+    return _clinvar_store
 
 
 def clinvarid_to_variant_dict():
-    id_dict = {}
-    if not config.USE_CACHE:
-        fetch_clinvar_vhl_variants(CLINVAR_FILE)
-    with open(CLINVAR_FILE, newline='\n') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter='\t')
-        for row in reader:
-            id_dict[int(row["VariationID"])] = row["Name"]
+    return get_clinvar_store().as_dict()
+
+
+def _iter_chunks(stream, chunk_size=CLINVAR_CHUNK_SIZE):
+    """Reads a binary stream in blocks that always end on a line boundary"""
+    remainder = b''
+    for block in iter(lambda: stream.read(chunk_size), b''):
+        block = remainder + block
+        end = block.rfind(b'\n') + 1
+        remainder = block[end:]
+        if end:
+            yield block[:end]
+        else:
+            remainder = block
+    if remainder:
+        yield remainder + b'\n'
+
+
+def _filter_chunk(chunk, gene_index, field_count, gene=CLINVAR_GENE):
+    """
+    Parses only the lines of a chunk that contain the gene symbol anywhere in their bytes, and keeps those whose gene
+    column contains it
+    @param chunk: bytes of whole tab-delimited lines
+    @param gene_index: index of the gene symbol column
+    @param field_count: number of columns in the header; rows are padded or cut to this length
+    @return: list of the matching rows, as lists of fields
+    """
+    rows = []
+    needle = gene.encode('utf-8')
+    position = chunk.find(needle)
+    while position != -1:
+        start = chunk.rfind(b'\n', 0, position) + 1
+        end = chunk.find(b'\n', position)
+        line = chunk[start:end].rstrip(b'\r').decode('utf-8')
+        row = next(csv.reader([line], delimiter='\t', quoting=csv.QUOTE_NONE), [])
+        if len(row) > gene_index and gene in row[gene_index]:
+            rows.append((row + [''] * field_count)[:field_count])
+        position = chunk.find(needle, end)
+    return rows
+
 
-    return id_dict
+def _open_summary(source):
+    """Opens the raw bytes of the ClinVar variant summary, from a local file or from its uri if source is None"""
+    if source is None:
+        response = urllib.request.urlopen(urllib.request.Request(CLINVAR_SUMMARY_URI, method="GET"))
+        return gzip.open(response, mode='rb')
+    if source.endswith('.gz'):
+        return gzip.open(source, mode='rb')
+    return open(source, mode='rb')
 
 
-def fetch_clinvar_vhl_variants(fileout):
+def fetch_clinvar_vhl_variants(fileout, source=None, processes=1):
+    """
+    Extracts the VHL rows of the ClinVar variant summary into a tab-delimited file. Decompressed lines are scanned
+    for the gene symbol as raw bytes, so only the lines that contain it are ever parsed
+    @param fileout: path of the tsv file to write
+    @param source: path to an already-downloaded variant_summary.txt(.gz). If None, it is streamed from
+        CLINVAR_SUMMARY_URI
+    @param processes: number of worker processes that scan the decompressed chunks. 1 scans them in this process,
+        None uses one per cpu
+    """
+    logger = logging.getLogger("fetch_clinvar_vhl_variants")
+    start = time.perf_counter()
+    scanned = 0
+    matched = 0
 
-    h_request = urllib.request.Request(CLINVAR_SUMMARY_URI, method="GET")
+    with _open_summary(source) as clinvar_tsv, open(fileout, 'w', newline='') as fout:
+        header = next(csv.reader([clinvar_tsv.readline().decode('utf-8').rstrip('\r\n')], delimiter='\t',
+                                 quoting=csv.QUOTE_NONE))
+        gene_index = header.index(CLINVAR_GENE_COLUMN)
+        writer = csv.writer(fout, delimiter='\t')
+        writer.writerow(header)
 
-    with urllib.request.urlopen(h_request) as response:
-        with gzip.open(response, mode='rt') as clinvar_tsv:
-            reader = csv.DictReader(clinvar_tsv, delimiter='\t', quoting=csv.QUOTE_NONE)
-            with open(fileout, 'w', newline='') as fout:
-                writer = csv.DictWriter(fout, fieldnames=reader.fieldnames, delimiter='\t')
-                writer.writeheader()
-                for row in reader:
+        def write_rows(rows):
+            nonlocal matched
+            writer.writerows(rows)
+            matched += len(rows)
 
-                    if 'VHL' in row['GeneSymbol']:
-                        writer.writerow(row)
+        if processes == 1:
+            for chunk in _iter_chunks(clinvar_tsv):
+                scanned += len(chunk)
+                write_rows(_filter_chunk(chunk, gene_index, len(header)))
+        else:
+            # decompression is sequential, so it stays here while the scanning and parsing is spread across the
+            # workers. At most two chunks per worker are in flight, which bounds memory use
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                pending = deque()
+                max_pending = 2 * (processes or os.cpu_count())
+                for chunk in _iter_chunks(clinvar_tsv):
+                    scanned += len(chunk)
+                    pending.append(executor.submit(_filter_chunk, chunk, gene_index, len(header)))
+                    if len(pending) >= max_pending:
+                        write_rows(pending.popleft().result())
+                while pending:
+                    write_rows(pending.popleft().result())
 
+    report = f"Extracted {matched} {CLINVAR_GENE} rows from {scanned / 1e6:.1f}MB in {time.perf_counter() - start:.2f}s"
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux
+        report += f", peak memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB"
+    logger.info(report)
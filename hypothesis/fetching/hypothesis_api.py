@@ -1,11 +1,14 @@
 import os
+import logging
 import urllib.request
 import urllib.parse
+from datetime import datetime, timezone, timedelta
 
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from ..annotations.Annotation import AugmentedAnnotation
-from ..config import INPUT_DIR
+from ..annotations.Annotation import parse_annotations
+from ..config import INPUT_DIR, SYNC_RECONCILE_DAYS
 
 TOKEN_FILE = os.path.join(INPUT_DIR, "secret_token.txt")
 SECRET_TOKEN = ""
@@ -24,10 +27,32 @@ BASE_HEADER = {
 }
 
 ANNOTATION_LIMIT = 200
+API_URL = "https://api.hypothes.is/api/search"
 
+# a backfill splits the group's history into this many time windows, and pages BACKFILL_MAX_WORKERS of them at once.
+# There are more windows than workers since annotations aren't spread evenly over time
+BACKFILL_WINDOWS = 32
+BACKFILL_MAX_WORKERS = 8
 
-def get_annotations_by_group(group_id, search_after):
-    annotations = []
+
+def _search(params):
+    h_header = dict(BASE_HEADER)
+    h_url = f"{API_URL}?{urllib.parse.urlencode(params)}"
+    h_request = urllib.request.Request(h_url, headers=h_header, method="GET")
+    with urllib.request.urlopen(h_request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def get_annotations_by_group(group_id, search_after, store=None, processes=1):
+    """
+    Fetches all annotations of a group created after search_after, one page at a time
+    @param group_id: id of the hypothes.is group
+    @param search_after: timestamp to start paging from
+    @param store: optional AnnotationStore every page is appended to as soon as it arrives
+    @param processes: number of processes the tags are parsed on, see parse_annotations
+    @return: list of the annotations
+    """
+    rows = []
     reached_end = False
     next_checkpoint = search_after
     total_annotations = 0
@@ -39,25 +64,207 @@ def get_annotations_by_group(group_id, search_after):
             "search_after": next_checkpoint,
             "group": group_id
         }
-        h_header = dict(BASE_HEADER)
-        h_url = f"https://api.hypothes.is/api/search?{urllib.parse.urlencode(h_data)}"
-        h_request = urllib.request.Request(h_url, headers=h_header, method="GET")
-        with urllib.request.urlopen(h_request) as response:
-            response_dict = json.loads(response.read().decode('utf-8'))
+        response_dict = _search(h_data)
+        if store is not None:
+            store.append(response_dict['rows'])
+
+        rows.extend(response_dict['rows'])
+
+        total_annotations = response_dict['total']
+        if len(rows) == total_annotations:
+            reached_end = True
+        next_checkpoint = response_dict['rows'][-1]['created']
+
+    # the tags of all pages are parsed together
+    return parse_annotations(rows, processes)
 
-            for row in response_dict['rows']:
-                new_annotation = AugmentedAnnotation.from_dict(row)
-                annotations.append(new_annotation)
 
-            total_annotations = response_dict['total']
-            if len(annotations) == total_annotations:
-                reached_end = True
-            next_checkpoint = response_dict['rows'][-1]['created']
+def _parse_timestamp(timestamp):
+    parsed = datetime.fromisoformat(timestamp)
+    # GROUP_EPOCH has no timezone; the api's timestamps are all utc
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def get_annotations_by_window(group_id, start, end):
+    """
+    Fetches the raw annotations of a group created in the window [start, end)
+    @param group_id: id of the hypothes.is group
+    @param start: timezone-aware datetime the window starts at
+    @param end: timezone-aware datetime the window ends before
+    @return: tuple of the list of raw annotation dictionaries and the total the api reported on the first page
+    """
+    window_rows = []
+    total = None
+    # search_after is exclusive, so the search starts just before the window to include annotations created at start
+    next_checkpoint = (start - timedelta(milliseconds=1)).isoformat()
+    while True:
+        h_data = {
+            "limit": ANNOTATION_LIMIT,
+            "sort": "created",
+            "order": "asc",
+            "search_after": next_checkpoint,
+            "group": group_id
+        }
+        response_dict = _search(h_data)
+        if total is None:
+            total = response_dict['total']
+        rows = response_dict['rows']
+        in_window = [row for row in rows if start <= _parse_timestamp(row['created']) < end]
+        window_rows.extend(in_window)
+        # the window is done once a page runs past its end, or the group has no more annotations
+        if len(rows) < ANNOTATION_LIMIT or len(in_window) < len(rows):
+            break
+        next_checkpoint = rows[-1]['created']
+
+    return window_rows, total
+
+
+def backfill_annotations(group_id, epoch, windows=BACKFILL_WINDOWS, max_workers=BACKFILL_MAX_WORKERS, store=None,
+                         processes=1):
+    """
+    Fetches all annotations of a group, paging through separate time windows of its history concurrently
+    @param group_id: id of the hypothes.is group
+    @param epoch: timestamp before all annotations of the group
+    @param windows: number of time windows the history from epoch until now is split into
+    @param max_workers: number of windows paged at the same time
+    @param store: optional AnnotationStore every window is appended to as soon as it and the windows before it arrived
+    @param processes: number of processes the tags are parsed on, see parse_annotations. All windows share one pool
+    @return: list of all annotations, sorted by creation time
+    """
+    logger = logging.getLogger("backfill_annotations")
+    start = _parse_timestamp(epoch)
+    # the last window is left open-ended, so annotations created during the backfill aren't lost
+    end = datetime.now(timezone.utc) + timedelta(days=1)
+    step = (end - start) / windows
+    bounds = [(start + i * step, start + (i + 1) * step) for i in range(windows)]
+
+    # the windows don't overlap, but annotations are deduplicated by id in case one was edited mid-backfill
+    by_id = {}
+    total = None
+    processes = processes or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map yields the windows in order, so the store is written oldest first, like a paged fetch
+            for window_rows, window_total in executor.map(lambda bound: get_annotations_by_window(group_id, *bound),
+                                                          bounds):
+                # the first window searches from the epoch, so its total is the size of the whole group
+                total = window_total if total is None else total
+                if store is not None:
+                    store.append(window_rows)
+                by_id.update((a.id, a) for a in parse_annotations(window_rows, executor=pool))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    annotations = sorted(by_id.values(), key=lambda a: a.created)
+
+    if len(annotations) != total:
+        logger.warning(f"Backfilled {len(annotations)} annotations, but the group has {total}")
+    else:
+        logger.info(f"Backfilled {len(annotations)} annotations in {windows} windows")
 
     return annotations
 
 
+def get_annotations_updated_after(group_id, updated_after):
+    """
+    Fetches all annotations of a group that were created or edited after a timestamp, oldest edit first
+    @param group_id: id of the hypothes.is group
+    @param updated_after: 'updated' timestamp of the newest annotation already stored
+    @return: list of the raw dictionaries of the new or updated annotations
+    """
+    changed = []
+    next_checkpoint = updated_after
+    while True:
+        h_data = {
+            "limit": ANNOTATION_LIMIT,
+            "sort": "updated",
+            "order": "asc",
+            "search_after": next_checkpoint,
+            "group": group_id
+        }
+        rows = _search(h_data)['rows']
+        changed.extend(rows)
+        # a short page is the last one
+        if len(rows) < ANNOTATION_LIMIT:
+            break
+        next_checkpoint = rows[-1]['updated']
+
+    return changed
+
+
+def _read_sync_state(path):
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    return {}
+
+
+def _write_sync_state(path, state):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=4)
+
+
+def record_full_fetch(state_path, annotations, epoch):
+    """
+    Records a fetch of the whole group in the sync state, so that the next sync only fetches what changed since
+    @param state_path: json file the sync state is kept in
+    @param annotations: all annotations of the group, as they were fetched
+    @param epoch: timestamp before all annotations of the group
+    """
+    state = _read_sync_state(state_path)
+    state["reconciled"] = state["synced"] = datetime.now(timezone.utc).isoformat()
+    state["updated"] = max((a.updated for a in annotations), default=epoch)
+    _write_sync_state(state_path, state)
+
+
+def sync_annotations(group_id, epoch, store, state_path, processes=1):
+    """
+    Brings an AnnotationStore up to date with the group. Only annotations created or edited since the newest stored
+    'updated' timestamp are fetched, and they are upserted into the store by id.
+    Deleted annotations never show up in a search, so every SYNC_RECONCILE_DAYS the whole group is backfilled into a
+    staging store instead, which replaces the stored annotations and so drops them
+    @param group_id: id of the hypothes.is group
+    @param epoch: timestamp before all annotations of the group
+    @param store: the AnnotationStore to update
+    @param state_path: json file the time of the last full fetch and the newest 'updated' timestamp are kept in
+    @param processes: number of processes the tags are parsed on, see parse_annotations
+    @return: the up-to-date list of annotations, sorted by creation time
+    """
+    logger = logging.getLogger("sync_annotations")
+    state = _read_sync_state(state_path)
+    now = datetime.now(timezone.utc)
+
+    last_reconciled = state.get("reconciled")
+    if len(store) == 0 or last_reconciled is None or \
+            now - datetime.fromisoformat(last_reconciled) >= timedelta(days=SYNC_RECONCILE_DAYS):
+        staged = store.staging()
+        synced = backfill_annotations(group_id, epoch, store=staged, processes=processes)
+        deleted = len(set(store.ids) - set(staged.ids))
+        store.replace_with(staged)
+        logger.info(f"Reconciled all {len(synced)} annotations ({deleted} deleted)")
+        state["reconciled"] = now.isoformat()
+        state["updated"] = max((a.updated for a in synced), default=epoch)
+    else:
+        # stores synced by older versions don't have the timestamp in their state, so it is read from the store once
+        updated_after = state.get("updated") or max(d['updated'] for d in store.iter_dicts())
+        changed = get_annotations_updated_after(group_id, updated_after)
+
+        # only the changed annotations are written; the store upserts them by id
+        new_count = sum(row['id'] not in store for row in changed)
+        store.append(changed)
+        synced = sorted(parse_annotations(store.iter_dicts(), processes), key=lambda a: a.created)
+        logger.info(f"Synced annotations updated after {updated_after}- new: {new_count}, "
+                    f"edited: {len(changed) - new_count}")
+        state["updated"] = max([updated_after] + [row['updated'] for row in changed])
+
+    state["synced"] = now.isoformat()
+    _write_sync_state(state_path, state)
+
+    return synced
+
+
 def get_annotations_from_json(path):
     with open(path, "r") as file:
-        annotations = [AugmentedAnnotation.from_dict(a) for a in json.load(file)]
+        annotations = parse_annotations(json.load(file))
     return annotations
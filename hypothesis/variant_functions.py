@@ -1,7 +1,6 @@
-import networkx as nx
 import os
-import obonet
-import urllib
+
+from kim_masterlist.ontology import SHARED_OBO_DIR, load_ontology, load_ontology_graph, provision_obo
 from . import config
 DISEASE_ENTITY_TO_HPO = {
         'asymptomatic': 'asymptomatic',
@@ -53,52 +52,70 @@ HPO_ABBREVIATIONS.update(_abbrv)
 ## Phenotype and Sequency Ontology Utilities
 SO_NAME = 'SequenceOntology'
 SO_FILENAME = 'so.obo'
-SO_HREF = 'https://raw.githubusercontent.com/The-Sequence-Ontology/SO-Ontologies/master/Ontology_Files/so.obo'
+SO_HREF = 'http://purl.obolibrary.org/obo/so/2020-08-20/so.obo'
 SO_DIR = os.path.join(config.LIB_DIR, 'so.obo.txt')
 
 HPO_NAME = 'HumanPhenotypeOntology'
 HPO_FILENAME = 'hp.obo'
-HPO_HREF = 'https://raw.githubusercontent.com/obophenotype/human-phenotype-ontology/master/hp.obo'
+HPO_HREF = 'http://purl.obolibrary.org/obo/hp/releases/2025-01-16/hp.obo'
 HPO_DIR = os.path.join(config.LIB_DIR, 'hp.obo.txt')
 
-if not config.USE_CACHE:
-    h_request = urllib.request.Request(SO_HREF, method="GET")
-    with urllib.request.urlopen(h_request) as response:
-        with open(SO_DIR, 'wb') as file:
-            file.write(response.read())
-    h_request = urllib.request.Request(HPO_HREF, method="GET")
-    with urllib.request.urlopen(h_request) as response:
-        with open(HPO_DIR, 'wb') as file:
-            file.write(response.read())
+# data-version each ontology is pinned to, the same releases kim_masterlist uses, and downloaded from their versioned
+# purls. A copy of the pinned version here or in kim_masterlist's lib directory is used without going to the network
+SO_VERSION = '2020-08-20'
+HPO_VERSION = 'hp/releases/2025-01-16'
+
+OBO_FILES = [SO_DIR, HPO_DIR]
+OBO_SOURCES = [(SO_DIR, SO_HREF, SO_VERSION), (HPO_DIR, HPO_HREF, HPO_VERSION)]
+
+# the ontology is loaded by get_obo_graph and get_obonet the first time it is needed, rather than on import, so that
+# nothing waits on the graph unless an ontology function is actually used
+OBO_GRAPH = None
+# the networkx form of the ontology, its undirected view and the node key -> id map
+OBONET = None
+OBONET_UD = None
+OBO_ALIASES = None
 
-# gather HPO and SO into a network- node keys: id
-_g = nx.compose(obonet.read_obo(SO_HREF), obonet.read_obo(HPO_HREF))
 
-# add the id to the node attributes
-for n, d in _g.nodes(data=True):
-    d['id'] = n.casefold().strip()
-    d['name'] = d['name'].casefold().strip()
+def provision_obo_files():
+    '''Makes sure the pinned obo files are in the lib directory, without going to the network when running from the cache
+    '''
+    for path, href, version in OBO_SOURCES:
+        provision_obo(path, href, version=version, offline=config.USE_CACHE,
+                      shared=[os.path.join(SHARED_OBO_DIR, os.path.basename(path))])
 
-# make a copy of merged network- node keys: term
-_h = nx.relabel_nodes(_g, {n: d['name'] for n, d in _g.nodes(data=True)})
-# combine together OBO network so that node keys: id or term
-_f = nx.compose(_g, _h)
-# casefold and strip the keys, so the result is an agglomeration of nodes:
-# SO(term) + SO(id) + HPO(term) + HPO(id), all lowercase and stripped
 
+def get_obo_graph():
+    '''HPO and SO merged into one ontology, where every term can be looked up by its id or its name, both lowercase and
+    stripped. The obo files are provisioned and the graph is loaded the first time this is called
+    @return: the OntologyGraph
+    '''
+    global OBO_GRAPH
+    if OBO_GRAPH is None:
+        provision_obo_files()
+        OBO_GRAPH = load_ontology_graph(OBO_FILES)
+    return OBO_GRAPH
 
-OBONET = nx.DiGraph(nx.relabel_nodes(_f, {n: n.casefold().strip() for n in _f.nodes()}))
-OBONET_UD = OBONET.to_undirected()
+
+def get_obonet():
+    '''The merged ontology as a networkx graph, for code that still needs networkx. Loading it also sets OBONET_UD and
+    OBO_ALIASES
+    @return: OBONET
+    '''
+    global OBONET, OBONET_UD, OBO_ALIASES
+    if OBONET is None:
+        provision_obo_files()
+        OBONET, OBONET_UD, OBO_ALIASES = load_ontology(OBO_FILES)
+    return OBONET
 
 
 def get_valid_obo(term_or_id, obo_type='name'):
     # this function will take either a term (e.g., HP:0010797) or name (e.g., Hemangioblastoma) and return
     # a matching HPO term or name to verify it exists
+    obo_graph = get_obo_graph()
     tid = term_or_id.strip().casefold()
-    if tid in OBONET:
-        node_data = OBONET.nodes[tid][obo_type]
-        return node_data
+    if tid in obo_graph:
+        term = obo_graph.index(tid)
+        return obo_graph.id(term) if obo_type == 'id' else obo_graph.name(term)
     else:
         raise ValueError(f"Could not find an OBO node for {tid}")
-
-
@@ -1,12 +1,16 @@
 import argparse
 import logging
-from .constants import INPUT_DIR, OUTPUT_DIR, SUMMARY_DIR, VALIDATION_DIR
+import glob
+from .constants import INPUT_DIR, OUTPUT_DIR, SUMMARY_DIR, VALIDATION_DIR, MASTERLIST_SNAPSHOT, \
+    PREPROCESSED_SNAPSHOT
 from .features.kimstudents_dataframe_stats import run_stats
 from .features.kimstudents_dataframe_views import *
 from .features.kimstudents_dataframe_summaries import *
-from .features.kimstudents_dataframe_preprocessing import kimstudents_preprocessing
+from .features.kimstudents_dataframe_incremental import incremental_preprocessing
 from .validation.core import create_litvar_validation_table, create_umd_validation_table
-from .fetching.KimStudents import KimStudents
+from .fetching.Fetcher import DEFAULT_MAX_WORKERS
+from .fetching.KimStudents import KimStudents, STUDENTS_CATEGORICAL_COLUMNS
+from .fetching.snapshot import load_snapshot, save_snapshot
 
 # this is the entry-point script for running all functional scripts and tests. Analysis is run as a python module with
 # the -m argument, which runs the following code in this file
@@ -60,11 +64,25 @@ if __name__ == '__main__':
     # by default, the fetcher will save all input datafiles into the INPUT_DIR. if --cached is used, this main script
     # will load dataframes from those, rather than fetching them from their external source
     parser.add_argument('-c', '--cached', help="Load data from local cache", action="store_true")
+    # --nofetchcache downloads every sheet in full instead of revalidating the copies in the fetch cache
+    parser.add_argument('-nfc', '--nofetchcache', help="Don't use the conditional fetch cache", action="store_true")
+    # --fetchmaxage reuses sheets fetched less than this many seconds ago without any request, which can be stale
+    parser.add_argument('-fma', '--fetchmaxage', help="Seconds a fetched sheet is reused without revalidating it",
+                        type=int, default=0)
+    # --stream parses the sheets while they are downloaded instead of buffering each of them in memory first
+    parser.add_argument('-s', '--stream', help="Stream the sheets straight into rows", action="store_true")
     # --skipfigs will create all the raw figures of the analysis.
     parser.add_argument('-figs', '--skipfigs', help="Skip the creation of all figures", action="store_true")
+    # --fullpreprocess recomputes the clean columns of every row, instead of only the rows that are new or were edited
+    parser.add_argument('-fp', '--fullpreprocess', help="Preprocess all rows of the masterlist", action="store_true")
     parser.add_argument('-cl', '--skipcluster', help="Skip clustering and creation of cluster figures",
                         action="store_true")
     parser.add_argument('-va', '--skipvalidation', help="Skip the validation scripts", action="store_true")
+    # --refreshvalidation scrapes the external validation sources again instead of reusing their saved tables
+    parser.add_argument('-rva', '--refreshvalidation', help="Refresh the validation sources", action="store_true")
+    # --workers sets how many sheets of the masterlist are downloaded at the same time
+    parser.add_argument('-w', '--workers', help="Number of sheets to download concurrently", type=int,
+                        default=DEFAULT_MAX_WORKERS)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -74,18 +92,28 @@ if __name__ == '__main__':
 
 
     # fetching all sheets and combining into a masterlist
-    fetcher = KimStudents()
-
-    if args.cached:
-        fetcher.load_from_dsv((os.path.join(INPUT_DIR, "data*.csv")))
+    fetcher = KimStudents(use_cache=not args.nofetchcache, cache_max_age=args.fetchmaxage)
+    fetcher.max_workers = args.workers
+
+    raw_files = glob.glob(os.path.join(INPUT_DIR, "data*.csv"))
+    if args.cached and os.path.isfile(MASTERLIST_SNAPSHOT) and \
+            all(os.path.getmtime(MASTERLIST_SNAPSHOT) >= os.path.getmtime(f) for f in raw_files):
+        # the snapshot is only used if it is newer than all of the raw input files
+        raw_table = load_snapshot(MASTERLIST_SNAPSHOT)
     else:
-        fetcher.process()
-        fetcher.save_raw_file(os.path.join(INPUT_DIR, "data.csv"))
+        if args.cached:
+            fetcher.load_from_dsv((os.path.join(INPUT_DIR, "data*.csv")))
+        elif args.stream:
+            fetcher.process_streaming(os.path.join(INPUT_DIR, "data.csv"))
+        else:
+            fetcher.process()
+            fetcher.save_raw_file(os.path.join(INPUT_DIR, "data.csv"))
 
+        raw_table = pd.DataFrame(fetcher.rows)
+        save_snapshot(raw_table, MASTERLIST_SNAPSHOT, STUDENTS_CATEGORICAL_COLUMNS)
 
     # generate all clean columns needed for further anaysis
-    out_table = pd.DataFrame(fetcher.rows)
-    out_table = out_table.pipe(kimstudents_preprocessing)
+    out_table = incremental_preprocessing(raw_table, PREPROCESSED_SNAPSHOT, full=args.fullpreprocess)
     # generating all pre-drop summaries
     raw_out_df = {
         "patient": out_table.pipe(groupby_patient),
@@ -101,7 +129,7 @@ if __name__ == '__main__':
     create_filtered_table(SUMMARY_DIR, out_table)
     create_postdropsupplementary_table(SUMMARY_DIR, out_table)
     if not args.skipvalidation:
-        create_umd_validation_table(VALIDATION_DIR, out_table)
+        create_umd_validation_table(VALIDATION_DIR, out_table, refresh=args.refreshvalidation)
         create_litvar_validation_table(VALIDATION_DIR, out_table)
 
     filtered_out_df = {
@@ -7,6 +7,18 @@ OUTPUT_DIR = os.path.join(BASE_DIR, 'files', 'output')
 SUMMARY_DIR = os.path.join(OUTPUT_DIR, "summary")
 VALIDATION_DIR = os.path.join(OUTPUT_DIR, "validation")
 
+# typed, columnar snapshot of the raw masterlist
+MASTERLIST_SNAPSHOT = os.path.join(INPUT_DIR, 'masterlist.npz')
+
+# preprocessed masterlist, keyed by row so that only new or edited rows are preprocessed again
+PREPROCESSED_SNAPSHOT = os.path.join(INPUT_DIR, 'preprocessed.npz')
+
+# conditionally-fetched files from all Fetchers are cached here
+FETCH_CACHE_DIR = os.path.join(INPUT_DIR, 'cache')
+
+# html of scraped UMD variant pages is cached here
+UMD_CACHE_DIR = os.path.join(INPUT_DIR, 'umd')
+
 # make directories if they don't exist
 for dirname in [INPUT_DIR, OUTPUT_DIR, SUMMARY_DIR, VALIDATION_DIR]:
     if not os.path.isdir(dirname):
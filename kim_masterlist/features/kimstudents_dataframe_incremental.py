@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from kim_masterlist import ontology, variant_functions as vf
+from ..fetching.KimStudents import STUDENTS_CATEGORICAL_COLUMNS, STUDENTS_SHEET_COLUMN
+from ..fetching.snapshot import load_snapshot, read_snapshot_metadata, save_snapshot
+from . import kimstudents_dataframe_preprocessing as preprocessing
+from .kimstudents_dataframe_preprocessing import COMPUTED_COLUMNS, kimstudents_preprocessing
+
+# this file contains the incremental version of kimstudents_preprocessing. The preprocessed masterlist is persisted
+# as a snapshot, with each row keyed by the sheet it came from and a hash of its raw values. On the next run, only rows
+# whose key isn't in the persisted table are preprocessed, and the result is merged with the rows that are unchanged
+
+ROW_KEY_COLUMN = "row_key"
+
+# computed column groups that are one-hot encoded with pd.get_dummies, and are therefore 0 rather than missing for
+# rows that don't have the value
+DUMMY_COLUMN_GROUPS = ["denovo", "aa_change"]
+
+# any change to these files invalidates the persisted table, since it could change every computed column
+PREPROCESSING_SOURCES = [preprocessing.__file__, vf.__file__, ontology.__file__, vf.SO_HREF, vf.HPO_HREF]
+
+
+def _preprocessing_hash():
+    digest = hashlib.sha1()
+    for filename in PREPROCESSING_SOURCES:
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def row_keys(df, sheet_column=STUDENTS_SHEET_COLUMN):
+    """
+    Creates a stable key for each row of the raw masterlist, made from its sheet, a hash of its raw values, and a
+    counter that tells identical rows of the same sheet apart
+    @param df: raw masterlist dataframe
+    @param sheet_column: column holding the sheet each row came from
+    @return: series of string keys with the same index as df
+    """
+    sheets = df[sheet_column].astype(str) if sheet_column in df else pd.Series("", index=df.index)
+    value_columns = [col for col in df.columns if col != sheet_column]
+    hashes = pd.util.hash_pandas_object(df[value_columns].astype(object), index=False)
+    hashes = pd.Series([f"{h:016x}" for h in hashes.to_numpy()], index=df.index)
+    occurrence = hashes.groupby([sheets, hashes]).cumcount().astype(str)
+    return sheets + ":" + hashes + ":" + occurrence
+
+
+def _count_changes(current_keys, previous_keys):
+    """
+    Counts the added, removed and changed rows between two sets of row keys. An edited row gets a new hash, so it
+    shows up as one removed and one added row of the same sheet; those pairs are counted as changed rows instead
+    """
+    def per_sheet(keys):
+        return keys.str.split(":", n=1).str[0].value_counts()
+
+    added = per_sheet(current_keys[~current_keys.isin(previous_keys)])
+    removed = per_sheet(previous_keys[~previous_keys.isin(current_keys)])
+    added, removed = added.align(removed, fill_value=0)
+    changed = np.minimum(added, removed)
+    return {
+        "added": int((added - changed).sum()),
+        "removed": int((removed - changed).sum()),
+        "changed": int(changed.sum())
+    }
+
+
+def _with_columns(part, dummy_cols):
+    missing = [col for col in dummy_cols if col not in part]
+    if missing:
+        part = pd.concat([part, pd.DataFrame(0, index=part.index, columns=missing, dtype=np.uint8)], axis=1)
+    mismatched = [col for col in dummy_cols if part[col].dtype != np.uint8]
+    if mismatched:
+        part = part.astype({col: np.uint8 for col in mismatched})
+    return part
+
+
+def _merge_computed_columns(previous, batch):
+    for col_type in COMPUTED_COLUMNS:
+        merged = list(previous.get(col_type, []))
+        merged.extend(col for col in batch.get(col_type, []) if col not in merged)
+        COMPUTED_COLUMNS[col_type][:] = merged
+
+
+def incremental_preprocessing(df, filename, full=False):
+    """
+    Preprocesses the raw masterlist like kimstudents_preprocessing, but only re-featurizes rows that are new or were
+    edited since the preprocessed table was last saved to filename. The merged table is saved back to filename
+    @param df: raw masterlist dataframe
+    @param filename: path of the persisted preprocessed snapshot
+    @param full: if True, every row is preprocessed again
+    @return: the preprocessed dataframe
+    """
+    logger = logging.getLogger("incremental_preprocessing")
+    keys = row_keys(df)
+    source_hash = _preprocessing_hash()
+
+    previous = None
+    if not full and os.path.isfile(filename):
+        metadata = read_snapshot_metadata(filename)
+        if metadata.get("source_hash") == source_hash and metadata.get("raw_columns") == list(map(str, df.columns)):
+            previous = load_snapshot(filename)
+        else:
+            logger.info("Raw columns or preprocessing code changed, preprocessing all rows")
+
+    if previous is None:
+        counts = {"added": len(keys), "removed": 0, "changed": 0}
+        for col_list in COMPUTED_COLUMNS.values():
+            col_list.clear()
+        out_df = df.reset_index(drop=True).pipe(kimstudents_preprocessing)
+        out_df[ROW_KEY_COLUMN] = keys.to_numpy()
+    else:
+        previous_keys = previous[ROW_KEY_COLUMN]
+        counts = _count_changes(keys, previous_keys)
+
+        if not any(counts.values()):
+            # nothing was added, removed or edited, so the saved table is already the result and isn't saved again
+            logger.info(f"Preprocessed rows- unchanged: {len(keys)}, using the saved table")
+            _merge_computed_columns(metadata["computed_columns"], {})
+            if not (previous_keys.to_numpy() == keys.to_numpy()).all():
+                previous = previous.set_index(ROW_KEY_COLUMN).loc[keys.to_numpy()].reset_index()
+            return previous.drop(columns=[ROW_KEY_COLUMN])
+
+        previous_computed = metadata["computed_columns"]
+        new_rows = df[~keys.isin(previous_keys).to_numpy()].reset_index(drop=True)
+        parts = [previous[previous_keys.isin(keys).to_numpy()]]
+        batch_computed = {}
+        if len(new_rows.index) > 0:
+            for col_list in COMPUTED_COLUMNS.values():
+                col_list.clear()
+            batch = new_rows.pipe(kimstudents_preprocessing)
+            batch[ROW_KEY_COLUMN] = keys[~keys.isin(previous_keys)].to_numpy()
+            batch_computed = {col_type: list(cols) for col_type, cols in COMPUTED_COLUMNS.items()}
+            parts.append(batch)
+        _merge_computed_columns(previous_computed, batch_computed)
+
+        # one-hot columns that a part doesn't have are 0, just like in a full preprocessing run. They are added to the
+        # parts before these are joined, so that the joined one-hot columns keep their uint8 dtype
+        dummy_cols = [col for col_type in DUMMY_COLUMN_GROUPS for col in COMPUTED_COLUMNS[col_type]]
+        parts = [_with_columns(part, dummy_cols) for part in parts]
+
+        out_df = pd.concat(parts, ignore_index=True)
+        out_df = out_df.set_index(ROW_KEY_COLUMN).loc[keys.to_numpy()].reset_index()
+
+    logger.info(f"Preprocessed rows- added: {counts['added']}, removed: {counts['removed']}, "
+                f"changed: {counts['changed']}, unchanged: {len(keys) - counts['added'] - counts['changed']}")
+
+    metadata = {
+        "source_hash": source_hash,
+        "raw_columns": list(map(str, df.columns)),
+        "computed_columns": {col_type: list(cols) for col_type, cols in COMPUTED_COLUMNS.items()}
+    }
+    # the snapshot is rewritten on every run with changes, so it is saved uncompressed to keep those runs short
+    save_snapshot(out_df, filename, [*STUDENTS_CATEGORICAL_COLUMNS, ROW_KEY_COLUMN], metadata=metadata,
+                  compress=False)
+
+    return out_df.drop(columns=[ROW_KEY_COLUMN])
@@ -49,6 +49,41 @@ COMPUTED_COLUMNS = {
 }
 
 
+def _apply_unique(series, func, **kwargs):
+    """
+    Applies a function once per distinct value of a series and maps the results back onto every row. This gives the
+    same result as series.apply, but also works for categorical columns whose function returns lists or dicts
+    @param series: series of values to apply the function to
+    @param func: function to apply
+    @param kwargs: keyword arguments passed to func
+    @return: series of the function's results with the same index as the inputted series
+    """
+    codes, uniques = pd.factorize(series)
+    results = np.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        results[i] = func(value, **kwargs)
+    # missing values are given the code -1, which picks out the last result
+    if (codes == -1).any():
+        results[-1] = func(np.nan, **kwargs)
+    return pd.Series(results[codes], index=series.index)
+
+
+def _parse_unique_cdna(series):
+    """
+    Parses the distinct values of a series of hgvs cdna strings with vf.parse_cdna
+    @param series: series of cdna strings
+    @return: tuple of the position of each row's value among the distinct values (-1 if missing), and the parsed
+        table of the distinct values, indexed by their position
+    """
+    codes, uniques = pd.factorize(series)
+    return codes, vf.parse_cdna(pd.Series(np.asarray(uniques, dtype=object)))
+
+
+def _expand_unique(featurized, codes, index):
+    """Spreads features computed per distinct value back onto every row, with missing values for rows without one"""
+    return featurized.reindex(codes).set_axis(index)
+
+
 def _phenotype_string_to_list(x, generalize=True):
     """
     Converts a string of phenotype hpo terms separated by a comma or semicolon into a list
@@ -89,7 +124,7 @@ def add_generalized_phenotype_columns(df):
     @param df:
     @return:
     """
-    hpo_series = df['Phenotype'].apply(_phenotype_string_to_list, generalize=True)
+    hpo_series = _apply_unique(df['Phenotype'], _phenotype_string_to_list, generalize=True)
 
     pheno_counts = hpo_series.apply(collections.Counter)
     pheno_featurized = pd.DataFrame.from_records(pheno_counts)
@@ -104,7 +139,7 @@ def add_phenotype_columns(df):
     @param df:
     @return:
     """
-    hpo_series = df['Phenotype'].apply(_phenotype_string_to_list, generalize=False)
+    hpo_series = _apply_unique(df['Phenotype'], _phenotype_string_to_list, generalize=False)
 
     pheno_counts = hpo_series.apply(collections.Counter)
     pheno_featurized = pd.DataFrame.from_records(pheno_counts)
@@ -148,7 +183,7 @@ def add_generalized_mutant_type_columns(df):
     @param df:
     @return:
     """
-    variant_series = df['Mutation Type'].apply(_mutant_string_to_list, generalize=True)
+    variant_series = _apply_unique(df['Mutation Type'], _mutant_string_to_list, generalize=True)
 
     mutant_type_counts = variant_series.apply(collections.Counter)
     mutants_featurized = pd.DataFrame.from_records(mutant_type_counts)
@@ -205,7 +240,7 @@ def add_age_columns(df):
     @return:
     """
 
-    age_series = df['Age'].apply(_age_to_records)
+    age_series = _apply_unique(df['Age'], _age_to_records)
 
     age_featurized = pd.DataFrame(age_series.to_list())
     COMPUTED_COLUMNS["age"].extend(age_featurized.columns.to_list())
@@ -213,30 +248,23 @@ def add_age_columns(df):
     return df
 
 
-def _start_cdna_change(x):
-    cdna_list = re.split('[;,]', x)
-    output = {}
-    for cdna in cdna_list:
-
-        match = vf.get_cdna_start(cdna)
-
-        if match is not None:
-            output["cdna_start"] = match
-
-    return output
-
 def add_cdna_start_columns(df):
+    codes, parsed = _parse_unique_cdna(df['Mutation Event c.DNA.'])
+    # the start of the last variant of a cell that isn't utr or intronic
+    starts = parsed.loc[parsed['coding'] & parsed['start'].notna(), 'start']
 
-    cdna_series = df['Mutation Event c.DNA.'].apply(_start_cdna_change)
-
-    cdna_featurized = pd.DataFrame(cdna_series.to_list())
+    cdna_featurized = pd.DataFrame(index=df.index)
+    if len(starts):
+        cdna_featurized['cdna_start'] = _expand_unique(starts.groupby(level=0).last().astype(float), codes, df.index)
     COMPUTED_COLUMNS["cdna"].extend(cdna_featurized.columns.to_list())
     df = df.join(cdna_featurized)
     return df
 
 def add_codon_columns(df):
 
-    codon_series = np.ceil(df['cdna_start']/3)
+    # a subset of rows (e.g., during incremental preprocessing) might not have any cdna start at all
+    cdna_start = df['cdna_start'] if 'cdna_start' in df else pd.Series(np.nan, index=df.index)
+    codon_series = np.ceil(cdna_start/3)
     df["codon_start"] = codon_series[(codon_series >= 0) & (codon_series <= 213)]
     COMPUTED_COLUMNS["codon"].append("codon_start")
     return df
@@ -250,7 +278,7 @@ def _sex_to_list(x):
     return output_categories
 
 def add_sex_columns(df):
-    sex_series = df['Sex'].apply(_sex_to_list)
+    sex_series = _apply_unique(df['Sex'], _sex_to_list)
 
     sexcounts = sex_series.apply(collections.Counter)
     sex_featurized = pd.DataFrame.from_records(sexcounts)
@@ -259,7 +287,7 @@ def add_sex_columns(df):
     return df
 
 def add_resolution_columns(df):
-    series = df['Resolution'].apply(lambda x: [f"resolution.{x.casefold()}"])
+    series = _apply_unique(df['Resolution'], lambda x: [f"resolution.{x.casefold()}"])
 
     counts = series.apply(collections.Counter)
     featurized = pd.DataFrame.from_records(counts)
@@ -267,24 +295,18 @@ def add_resolution_columns(df):
     df = df.join(featurized)
     return df
 
-def _functional_regions_from_cdna(x):
-    mutlist = re.split('[;]', x)
-
-    domain_val = {}
-    for term in mutlist:
-        term = term.strip()
-        if term not in NULL_TERMS:
-            for domain in vf.affected_domains(term):
-                col_name = f"region.{domain}"
-                domain_val[col_name] = domain_val.get(col_name, 0) + 1
-
-    return domain_val
-
-
 def add_region_columns(df):
-    series = df['Mutation Event c.DNA.'].apply(_functional_regions_from_cdna)
-
-    featurized = pd.DataFrame(series.to_list())
+    codes, parsed = _parse_unique_cdna(df['Mutation Event c.DNA.'])
+    mask = vf.parsed_region_mask(parsed)
+
+    # number of variants of each row that affect each region, missing for none
+    counts = pd.DataFrame(mask.astype(float), index=parsed.index, columns=vf.VHL_REGION_NAMES).groupby(level=0).sum()
+    counts = counts.replace(0, np.nan)
+    # regions are in the order they are first seen in the rows; distinct values are numbered in the order they are
+    # first seen, so that is the order of the first set bits of the mask
+    hits = np.flatnonzero(mask.ravel()) % len(vf.VHL_REGION_NAMES)
+    regions = [vf.VHL_REGION_NAMES[r] for r in pd.unique(hits)]
+    featurized = _expand_unique(counts[regions], codes, df.index).add_prefix("region.")
     COMPUTED_COLUMNS["region"].extend(featurized.columns.to_list())
     COMPUTED_COLUMNS["domain"].extend([f'region.{dom}' for dom in vf.VHL_DOMAIN_NAMES])
     df = df.join(featurized)
@@ -296,7 +318,8 @@ def add_grouped_mutation_type_columns(df):
         groupcol = f'grouped_mutation_type.{grouptype}'
         df[groupcol] = 0
         for mtype in muttype_list:
-            df[groupcol] = df[groupcol] + df[f'generalized_mutant_type.{mtype}'].fillna(0)
+            if f'generalized_mutant_type.{mtype}' in df:
+                df[groupcol] = df[groupcol] + df[f'generalized_mutant_type.{mtype}'].fillna(0)
 
     colnames = [f'grouped_mutation_type.{sotype}' for sotype in vf.SO_TERM_TYPES.keys()]
     COMPUTED_COLUMNS["grouped_mutation_type"].extend(colnames)
@@ -307,9 +330,9 @@ def add_grouped_mutation_type_columns(df):
 
 
 def add_aa_change_columns(df):
-    series = df['Predicted Consequence Protein Change'].apply(vf.get_aa_from_predicted_consequence)
+    series = _apply_unique(df['Predicted Consequence Protein Change'], vf.get_aa_from_predicted_consequence)
     series = series.apply(lambda x: f"aa_change.{x}")
-    featurized = pd.get_dummies(series).drop(columns=['aa_change.None'])
+    featurized = pd.get_dummies(series).drop(columns=['aa_change.None'], errors='ignore')
 
     COMPUTED_COLUMNS["aa_change"].extend(featurized.columns.to_list())
     df = df.join(featurized)
@@ -346,7 +369,8 @@ def _pam30_score(aa_tuple):
 
 def add_blosum_column(df):
 
-    series = df['Predicted Consequence Protein Change'].apply(vf.get_aa_from_predicted_consequence, return_tuple=True)
+    series = _apply_unique(df['Predicted Consequence Protein Change'], vf.get_aa_from_predicted_consequence,
+                           return_tuple=True)
     series62 = series.apply(_blossum62_score).rename("blosum62_score")
     series80 = series.apply(_blossum90_score).rename("blosum90_score")
 
@@ -357,7 +381,8 @@ def add_blosum_column(df):
 
 def add_pam_column(df):
 
-    series = df['Predicted Consequence Protein Change'].apply(vf.get_aa_from_predicted_consequence, return_tuple=True)
+    series = _apply_unique(df['Predicted Consequence Protein Change'], vf.get_aa_from_predicted_consequence,
+                           return_tuple=True)
     series30 = series.apply(_blossum62_score).rename("pam30_score")
 
     COMPUTED_COLUMNS["pam_score"].extend(["pam30_score"])
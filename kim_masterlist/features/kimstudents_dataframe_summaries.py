@@ -99,7 +99,8 @@ def create_filtered_table(directory, df):
     df.to_csv(os.path.join(directory, "filtered_out.csv"))
 
 def create_refs_table(directory, df):
-    refs = df[["PMID", "Reference"]]
+    # categorical columns are converted back to objects, so that only observed pairs are grouped
+    refs = df[["PMID", "Reference"]].astype(object)
     refs = refs.groupby(["Reference", "PMID"])
     refs.first().to_csv(os.path.join(directory, "all_refs.csv"))
 
@@ -136,7 +137,7 @@ def create_postdrop_summary_table(directory, out_df):
     create_summary_table(directory, out_df, "postdrop")
 
 def create_supplementary_table(directory, df, prefix):
-    df_trimmed = df[list(SUPPLEMENTARY_HEADERS.keys())]
+    df_trimmed = df[list(SUPPLEMENTARY_HEADERS.keys())].astype(object)
     df_trimmed = df_trimmed.rename(columns=SUPPLEMENTARY_HEADERS)
     df_sorted = df_trimmed.sort_values(by=["Reference"])
     df_sorted = df_sorted.replace(r'^\s*$', np.nan, regex=True)
@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+import certifi
+
+# size of the blocks that response bodies are copied to disk in
+COPY_CHUNK_SIZE = 1024 * 1024
+
+CACHE_INDEX_FILENAME = 'index.json'
+CACHE_OBJECTS_DIRNAME = 'objects'
+
+
+class FetchCache(object):
+    """Content-addressed, on-disk cache for files fetched over http(s).
+
+    Response bodies are stored gzip-compressed under the sha256 of their content, and an index maps each
+    request (href + post data) to the body it last returned along with its ETag and Last-Modified validators.
+    Cached requests are revalidated with a conditional request, so an unchanged file only costs a 304 response.
+
+    Attributes:
+        directory: the directory the index and bodies are stored in
+        max_age: number of seconds a cached body is served without revalidating it. 0 always revalidates
+        index: dictionary of request keys to their cached response metadata
+        stats: counts of hit (served without a request), revalidated (304) and miss (downloaded) responses
+    """
+
+    def __init__(self, directory, max_age=0):
+        self.directory = directory
+        self.max_age = max_age
+        self.stats = Counter(hit=0, revalidated=0, miss=0)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(self.directory, CACHE_OBJECTS_DIRNAME), exist_ok=True)
+        self.index_path = os.path.join(self.directory, CACHE_INDEX_FILENAME)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                self.index = json.load(file)
+
+    @staticmethod
+    def _request_key(href, data=None):
+        key = hashlib.sha1(href.encode('utf-8'))
+        if data is not None:
+            key.update(data if isinstance(data, bytes) else repr(data).encode('utf-8'))
+        return key.hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, CACHE_OBJECTS_DIRNAME, f'{digest}.gz')
+
+    def _save_index(self):
+        # the index is replaced atomically so an interrupted run can't leave it half-written
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(self.index, file, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def _store(self, response):
+        """Copies a response body into the object store, returning its sha256 digest and size"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, CACHE_OBJECTS_DIRNAME), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw_file, gzip.GzipFile(fileobj=raw_file, mode='wb') as file:
+                for chunk in iter(lambda: response.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+
+            object_path = self._object_path(digest.hexdigest())
+            # identical content is only ever stored once
+            if os.path.isfile(object_path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return digest.hexdigest(), size
+
+    def _prune(self, digest):
+        """Removes a stored body if no request in the index refers to it anymore"""
+        if not any(entry['sha256'] == digest for entry in self.index.values()):
+            object_path = self._object_path(digest)
+            if os.path.isfile(object_path):
+                os.remove(object_path)
+
+    def open(self, href, data=None):
+        """Opens a binary stream of the body at href, fetching or revalidating it first if needed
+
+        Args:
+            href: the url to fetch
+            data: optional body of a post request
+
+        Returns:
+            a decompressed binary file object of the cached body
+        """
+        key = self._request_key(href, data)
+        with self._lock:
+            entry = self.index.get(key)
+        if entry is not None and not os.path.isfile(self._object_path(entry['sha256'])):
+            entry = None
+
+        if entry is not None and time.time() - entry['fetched'] < self.max_age:
+            with self._lock:
+                self.stats['hit'] += 1
+            return gzip.open(self._object_path(entry['sha256']), 'rb')
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        request = urllib.request.Request(href, data=data, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, cafile=certifi.where())
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+            with self._lock:
+                self.stats['revalidated'] += 1
+                entry['fetched'] = time.time()
+                self.index[key] = entry
+                self._save_index()
+            return gzip.open(self._object_path(entry['sha256']), 'rb')
+
+        with response:
+            digest, size = self._store(response)
+            new_entry = {
+                'href': href,
+                'sha256': digest,
+                'size': size,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time()
+            }
+
+        with self._lock:
+            self.stats['miss'] += 1
+            self.index[key] = new_entry
+            if entry is not None and entry['sha256'] != digest:
+                self._prune(entry['sha256'])
+            self._save_index()
+
+        return gzip.open(self._object_path(digest), 'rb')
+
+    def report(self):
+        """Returns a one-line summary of the cache statistics"""
+        return ", ".join(f"{name}: {self.stats[name]}" for name in ['hit', 'revalidated', 'miss'])
@@ -2,12 +2,25 @@ import csv
 import glob
 import gzip
 import io
+import logging
+import os
+import re
+import time
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
 import certifi
 
+from .FetchCache import FetchCache
+from ..constants import FETCH_CACHE_DIR
+
+# number of hrefs a Fetcher downloads at the same time, unless overridden by the instance
+DEFAULT_MAX_WORKERS = 4
+
+ROW_DELIMITER = ','
+
 
 class Fetcher(object):
     """Base class for fetching data from external sources.
@@ -26,10 +39,20 @@ class Fetcher(object):
         data: the final stream of data that gets written to a file.
             Used to fix files, if needed
         request_data: dictionary of the data to be used in the body of the post request
+        max_workers: maximum number of hrefs downloaded at the same time. 1 fetches serially
+        fetch_times: seconds spent downloading each href, keyed by href
+        cache: the FetchCache used to conditionally fetch hrefs. If None, every href is downloaded in full
+        source_column: if set, every row gets this extra column holding the source_id of the href it came from
     """
 
-    def __init__(self):
-        """Inits the Fetcher class and Attributes."""
+    def __init__(self, use_cache=True, cache_max_age=0):
+        """Inits the Fetcher class and Attributes.
+
+        Args:
+            use_cache: if False, no FetchCache is created and every href is downloaded in full
+            cache_max_age: seconds a cached file is used without asking its server whether it changed. The default of
+                0 revalidates every href, so an unchanged file costs a 304 and a changed one is always downloaded
+        """
         self.name = None
         self.filename = None
         self.href = None
@@ -54,22 +77,145 @@ class Fetcher(object):
         # flags if the file needs to be extracted
         self.needs_extraction = False
 
+        # number of hrefs that are downloaded concurrently, and the time each download took
+        self.max_workers = DEFAULT_MAX_WORKERS
+        self.fetch_times = {}
+
+        # all fetchers share the on-disk cache, so unchanged files are only revalidated
+        self.cache = FetchCache(FETCH_CACHE_DIR, max_age=cache_max_age) if use_cache else None
+
+        # column that rows are tagged with their source in, if any
+        self.source_column = None
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def _open_href(self, href):
+        """Opens a binary stream to the given href
+
+        Args:
+            href: the url to open
+
+        Returns:
+            a file-like object that can be used as a context manager
+        """
+        if self.cache is not None:
+            return self.cache.open(href, self.request_data)
+        return urllib.request.urlopen(href, data=self.request_data, cafile=certifi.where())
+
+    def _fetch_href(self, href):
+        """Downloads a single href into a bytestream
+
+        Args:
+            href: the url to download
+
+        Returns:
+            tuple of the bytestream and the number of seconds the download took
+        """
+        start = time.perf_counter()
+        with self._open_href(href) as response:
+            compressed_bytes = io.BytesIO()
+            compressed_bytes.write(response.read())
+            compressed_bytes.seek(0)
+        return compressed_bytes, time.perf_counter() - start
+
     def fetch(self):
-        """Reads data from instance's href attribute."""
+        """Reads data from instance's href attribute.
+
+        Up to max_workers hrefs are downloaded at the same time; compressed is always
+        filled in the same order as href.
+        """
 
         # href is converted to list of 1 element if it's a string
-        print(self.name)
+        self.logger.info(self.name)
         if isinstance(self.href, str):
             self.href = [self.href]
 
         if isinstance(self.href, list):
-            for href in self.href:
-                print(href)
-                with urllib.request.urlopen(href, data=self.request_data, cafile=certifi.where()) as response:
-                    compressed_bytes = io.BytesIO()
-                    compressed_bytes.write(response.read())
-                    compressed_bytes.seek(0)
-                    self.compressed[href] = compressed_bytes
+            workers = max(1, min(self.max_workers, len(self.href)))
+            start = time.perf_counter()
+            if workers == 1:
+                results = [self._fetch_href(href) for href in self.href]
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(self._fetch_href, self.href))
+
+            for href, (compressed_bytes, elapsed) in zip(self.href, results):
+                self.logger.info(f"{href} ({elapsed:.2f}s)")
+                self.compressed[href] = compressed_bytes
+                self.fetch_times[href] = elapsed
+
+            self.logger.info(f"Fetched {len(self.href)} file(s) with {workers} worker(s) in "
+                             f"{time.perf_counter() - start:.2f}s")
+            if self.cache is not None:
+                self.logger.info(f"Fetch cache: {self.cache.report()}")
+
+    def _iter_lines(self, href, raw_file=None):
+        """Lazily yields the decoded, non-comment lines of a single href
+
+        The response (or its gzip stream, if the file needs extraction) is decoded as it is read, so only one
+        buffered chunk of the file is held in memory at a time.
+
+        Args:
+            href: the url to read
+            raw_file: optional text file that every line (including comments) is copied into as it is read
+        """
+        with self._open_href(href) as response:
+            stream = gzip.GzipFile(fileobj=response) if self.needs_extraction else response
+            for line in io.TextIOWrapper(stream, encoding='utf-8', newline=''):
+                if raw_file is not None:
+                    raw_file.write(line)
+                if not line.startswith('#'):
+                    yield line
+
+    def iter_rows(self, raw_filename=None):
+        """Lazily yields the rows of every href as dictionaries, in href order
+
+        Rows are parsed as the response is read and are passed through keep_row before being yielded. Unlike
+        fetch, hrefs are read one after another.
+
+        Args:
+            raw_filename: if given, the raw data of each href is saved as it streams past, using the same
+                numbered filenames as save_raw_file
+        """
+        if isinstance(self.href, str):
+            self.href = [self.href]
+
+        for i, href in enumerate(self.href):
+            self.logger.info(href)
+            raw_file = None
+            if raw_filename is not None:
+                raw_file = open(f'{raw_filename[0:-4]}{i}{raw_filename[-4:]}', 'w', newline='', encoding='utf-8')
+            try:
+                reader = csv.DictReader(self._iter_lines(href, raw_file), delimiter=ROW_DELIMITER)
+                yield from self.tag_rows(filter(self.keep_row, reader), href)
+            finally:
+                if raw_file is not None:
+                    raw_file.close()
+
+        if self.cache is not None:
+            self.logger.info(f"Fetch cache: {self.cache.report()}")
+
+    def source_id(self, href):
+        """Returns a short, stable identifier of the source an href points to
+        Overridden by child classes, if needed
+        """
+        return href
+
+    def tag_rows(self, rows, href):
+        """Lazily adds the source_id of href to each row, if the fetcher has a source_column"""
+        if self.source_column is None:
+            yield from rows
+        else:
+            source = self.source_id(href)
+            for row in rows:
+                row[self.source_column] = source
+                yield row
+
+    def keep_row(self, row):
+        """Returns whether a parsed row should be kept while streaming
+        Overridden by child classes, if needed
+        """
+        return True
 
     def extract(self):
         """Extracts data in compressed attribute to decompressed using gzip.
@@ -117,7 +263,7 @@ class Fetcher(object):
         for href in self.data.keys():
             all_rows = chain(all_rows, filter(lambda row: not row.startswith('#'), self.data[href].read().splitlines()))
 
-        self.rows = csv.DictReader(all_rows, delimiter=ROW_DELIMITER())
+        self.rows = csv.DictReader(all_rows, delimiter=ROW_DELIMITER)
         self.dsv_header = list(self.rows.fieldnames)
 
     def fix_file(self):
@@ -144,6 +290,16 @@ class Fetcher(object):
         self.fix_file()
         self.to_dict_list()
 
+    def process_streaming(self, raw_filename=None):
+        """Sets the rows to a generator that streams every href straight into parsed rows
+
+        Nothing is downloaded until the rows are consumed, and no href is ever held in memory as a whole.
+
+        Args:
+            raw_filename: if given, the raw data of each href is saved while it is streamed
+        """
+        self.rows = self.iter_rows(raw_filename)
+
     def load_from_dsv(self, file_glob):
         """Loads multiple csv files with identical headers and adds them to the fetcher row list
 
@@ -151,6 +307,12 @@ class Fetcher(object):
         self.rows = []
         self.dsv_header = []
         for filename in glob.iglob(file_glob):
+            # files saved by save_raw_file are numbered by the position of their href
+            source = os.path.basename(filename)
+            match = re.search(r'(\d+)\.\w+$', filename)
+            if isinstance(self.href, list) and match is not None and int(match.group(1)) < len(self.href):
+                source = self.href[int(match.group(1))]
+
             with open(filename, 'r', encoding='utf-8') as file:
-                self.rows.extend(list(csv.DictReader(file, delimiter=ROW_DELIMITER)))
+                self.rows.extend(list(self.tag_rows(csv.DictReader(file, delimiter=ROW_DELIMITER), source)))
             # self.dsv_header.extend(list(self.rows.fieldnames))
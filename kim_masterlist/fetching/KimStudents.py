@@ -1,5 +1,6 @@
 import csv
 import logging
+import urllib.parse
 from itertools import chain
 
 from .Fetcher import Fetcher
@@ -7,6 +8,8 @@ from .Fetcher import Fetcher
 STUDENTS_NAME = 'KimStudents'
 STUDENTS_FILENAME = 'Final Masterlist of VHL Papers.csv'
 ROW_DELIMITER = ','
+# each row is tagged with the id (gid) of the sheet it was read from
+STUDENTS_SHEET_COLUMN = 'Sheet ID'
 
 # Garrett (2016): 1607707061
 # Liam: 1618569887
@@ -53,6 +56,20 @@ STUDENTS_HEADER_NAMES = [
     "HGVS_Predicted_Protein"
 ]
 
+# low-cardinality columns that are stored and loaded as categoricals in the masterlist snapshot
+STUDENTS_CATEGORICAL_COLUMNS = [
+    "Checked on CIViC",
+    "PMID",
+    "Multiple Mutants in Case",
+    "Transcript Reference",
+    "Mutation Type",
+    "Confirmed De Novo",
+    "Reference",
+    "Sex",
+    "Resolution",
+    STUDENTS_SHEET_COLUMN
+]
+
 
 class KimStudents(Fetcher):
     """Fetcher for Raymond's custom student-procured database.
@@ -60,14 +77,15 @@ class KimStudents(Fetcher):
     csv files from external sources. The KimStudents class fetches and cleans VHL variants from the students master list
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, use_cache=True, cache_max_age=0):
+        super().__init__(use_cache, cache_max_age)
         self.name = STUDENTS_NAME
         self.filename = STUDENTS_FILENAME
         self.href = STUDENTS_HREF
         self.needs_extraction = False
         self.logger = logging.getLogger(self.name)
         self.dsv_header = STUDENTS_HEADER_NAMES
+        self.source_column = STUDENTS_SHEET_COLUMN
 
     def to_dict_list(self):
         # a generator is used here so not all rows have to be loaded into memory as a list at once
@@ -78,11 +96,19 @@ class KimStudents(Fetcher):
         for href in self.data.keys():
             new_rows = filter(lambda row: not row.startswith('#'), self.data[href].read().splitlines())
 
-            self.rows = chain(self.rows, csv.DictReader(new_rows, delimiter=ROW_DELIMITER))
+            self.rows = chain(self.rows, self.tag_rows(csv.DictReader(new_rows, delimiter=ROW_DELIMITER), href))
 
         # since multiple sheets are being combined, the header row gets repeated; remove the row if it had PMID in
         #its pmid column
-        self.filter_rows(lambda row: row['PMID'].strip() != "PMID")
+        self.filter_rows(self.keep_row)
+
+    def keep_row(self, row):
+        return row['PMID'].strip() != "PMID"
+
+    def source_id(self, href):
+        # each sheet of the masterlist is exported by its gid
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(href).query)
+        return query.get('gid', [href])[0]
 
     def filter_rows(self, filt_fun):
         out_rows = []
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+# Typed, compressed columnar snapshots of dataframes, stored as a single numpy .npz archive.
+# Numeric and boolean columns are saved as native arrays. Text columns are dictionary-encoded into an integer
+# code array plus an array of their unique values, so each distinct string is stored (and loaded) only once.
+# Low-cardinality text columns are loaded back as pandas categoricals; the rest are expanded back to objects.
+
+SNAPSHOT_VERSION = 1
+
+# text columns whose unique values make up at most this fraction of their rows are loaded as categoricals
+CATEGORICAL_MAX_RATIO = 0.5
+
+_COLUMNS_KEY = '__columns__'
+_SCHEMA_KEY = '__schema__'
+
+
+def _encode_text(series):
+    """Dictionary-encodes a text series into int32 codes and unicode categories. Missing values get code -1"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # series.array is the Categorical itself; series.cat would return another Series
+        categorical = series.array.rename_categories(series.cat.categories.astype(str))
+    else:
+        categorical = pd.Categorical(series.where(series.isna(), series.astype(str)))
+    categories = np.asarray(categorical.categories, dtype=str)
+    return np.asarray(categorical.codes, dtype=np.int32), categories
+
+
+def save_snapshot(df, filename, categorical_columns=None, metadata=None, compress=True):
+    """
+    Saves a dataframe as a columnar snapshot. The index of the dataframe is not saved
+    @param df: dataframe to save
+    @param filename: path of the .npz file to write
+    @param categorical_columns: text columns to load back as categoricals. If None, text columns with a unique-value
+        ratio of at most CATEGORICAL_MAX_RATIO are used
+    @param metadata: optional json-serializable dictionary saved alongside the data
+    @param compress: if False, the archive is written uncompressed, which is several times faster but larger
+    """
+    arrays = {}
+    schema = {"version": SNAPSHOT_VERSION, "kinds": [], "metadata": metadata or {}}
+
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype):
+            kind = "numeric"
+            arrays[f"c{i}"] = series.to_numpy()
+        else:
+            codes, categories = _encode_text(series)
+            if categorical_columns is None:
+                is_categorical = len(categories) <= CATEGORICAL_MAX_RATIO * max(len(codes), 1)
+            else:
+                is_categorical = col in categorical_columns
+            kind = "category" if is_categorical else "text"
+            arrays[f"c{i}.codes"] = codes
+            arrays[f"c{i}.categories"] = categories
+        schema["kinds"].append(kind)
+
+    arrays[_COLUMNS_KEY] = np.asarray([str(col) for col in df.columns], dtype=str)
+    arrays[_SCHEMA_KEY] = np.asarray(json.dumps(schema))
+    if compress:
+        np.savez_compressed(filename, **arrays)
+    else:
+        np.savez(filename, **arrays)
+
+
+def read_snapshot_metadata(filename):
+    """
+    Reads only the metadata dictionary stored with a snapshot
+    @param filename: path of the .npz snapshot
+    @return: the metadata dictionary
+    """
+    with np.load(filename, allow_pickle=False) as archive:
+        return json.loads(str(archive[_SCHEMA_KEY]))["metadata"]
+
+
+def load_snapshot(filename, columns=None):
+    """
+    Loads a snapshot saved by save_snapshot straight into a dataframe, column by column
+    @param filename: path of the .npz snapshot
+    @param columns: optional list of the columns to load; all columns are loaded if None
+    @return: dataframe with a default RangeIndex
+    """
+    data = {}
+    with np.load(filename, allow_pickle=False) as archive:
+        schema = json.loads(str(archive[_SCHEMA_KEY]))
+        if schema["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {schema['version']} in {filename}")
+
+        all_columns = archive[_COLUMNS_KEY].tolist()
+        for i, (col, kind) in enumerate(zip(all_columns, schema["kinds"])):
+            if columns is not None and col not in columns:
+                continue
+
+            if kind == "numeric":
+                data[col] = archive[f"c{i}"]
+            else:
+                categorical = pd.Categorical.from_codes(archive[f"c{i}.codes"],
+                                                        categories=archive[f"c{i}.categories"].astype(object))
+                data[col] = categorical if kind == "category" else np.asarray(categorical, dtype=object)
+
+    return pd.DataFrame(data, columns=[col for col in all_columns if col in data])
@@ -0,0 +1,861 @@
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import urllib.error
+from collections import namedtuple
+from contextlib import contextmanager
+
+import networkx as nx
+import numpy as np
+
+### Compiled HPO/SO ontology
+# Parsing the obo files and merging them into one graph takes several seconds, so the result is compiled once and
+# reused until the content of the obo files changes. Both kim_masterlist and hypothesis load their ontology from here.
+# There are two compiled forms:
+#   OntologyGraph - integer terms with CSR parent/child arrays, saved as .npy files in ONTOLOGY_GRAPH_DIRNAME and
+#                   memory mapped on load. This is what the analysis code traverses.
+#   Ontology      - the merged networkx graph, pickled to SNAPSHOT_FILENAME, for code that still needs networkx
+# Tables derived from an OntologyGraph, such as its AncestorClosure, are saved with its arrays.
+# Packages that download their own obo files get them through provision_obo, which only goes to the network when
+# there is no local copy of the pinned version.
+
+# bumped whenever the way the graph is built changes, so that older snapshots are rebuilt
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILENAME = 'ontology.pickle'
+ONTOLOGY_GRAPH_DIRNAME = 'ontology'
+ONTOLOGY_GRAPH_HEADER = 'header.json'
+# tables derived from an OntologyGraph are saved with its arrays, as <prefix><name>-<key>.npy, and are removed when
+# the graph is rebuilt
+DERIVED_PREFIX = 'derived-'
+
+# number of terms whose distances to every other term are computed at once by TermDistances
+DISTANCE_CHUNK_SIZE = 256
+# levels of a breadth first search with at most this many terms are expanded term by term rather than with numpy
+SMALL_FRONTIER = 32
+
+# obo files that ship with kim_masterlist; other packages copy them from here instead of downloading them when they can
+SHARED_OBO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'lib')
+# downloaded obo files are kept in a FetchCache in this directory next to them, with their ETag and Last-Modified
+OBO_CACHE_DIRNAME = 'obo_cache'
+# seconds a downloaded obo file is used before its server is asked whether it changed
+OBO_MAX_AGE = 7 * 24 * 60 * 60
+# a lock file older than this many seconds was left by a process that died while fetching, and is taken over
+OBO_LOCK_TIMEOUT = 10 * 60
+
+Ontology = namedtuple('Ontology', ['graph', 'undirected', 'aliases'])
+
+
+def _files_signature(obo_files):
+    """Size and modification time of each obo file; cheap to compute, and changes whenever a file is replaced"""
+    signature = []
+    for obo_file in obo_files:
+        stat = os.stat(obo_file)
+        signature.append([os.path.abspath(obo_file), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _files_checksum(obo_files):
+    digest = hashlib.sha256()
+    for obo_file in obo_files:
+        with open(obo_file, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _check_header(header, obo_files):
+    '''Checks whether a snapshot header was written for the current content of obo_files
+    @return: tuple of (valid, signature, checksum). checksum is None if the files didn't have to be hashed
+    '''
+    signature = _files_signature(obo_files)
+    if header is None or header.get('version') != SNAPSHOT_VERSION:
+        return False, signature, None
+    if header['signature'] == signature:
+        return True, signature, None
+    checksum = _files_checksum(obo_files)
+    return header['checksum'] == checksum, signature, checksum
+
+
+def _default_path(obo_files, filename):
+    return os.path.join(os.path.dirname(os.path.abspath(obo_files[0])), filename)
+
+
+def build_ontology(obo_files):
+    '''Parses and merges obo files into an Ontology
+    graph: DiGraph where every term is a node twice, keyed by its id and by its name, both casefolded and stripped.
+        Edges point from a term to its parents, and every node has the 'id' and 'name' of its term; the other obo
+        fields aren't used anywhere, and are dropped to keep the snapshot small
+    undirected: undirected view of graph, used for distances between terms
+    aliases: dictionary of every node key (id or name) to the id of its term
+    '''
+    import obonet
+
+    # gather the ontologies into a network- node keys: id
+    _g = nx.compose_all([obonet.read_obo(obo_file) for obo_file in obo_files])
+
+    # add the id to the node attributes
+    for n, d in _g.nodes(data=True):
+        d['id'] = n.casefold().strip()
+        d['name'] = d['name'].casefold().strip()
+
+    # make a copy of merged network- node keys: term
+    _h = nx.relabel_nodes(_g, {n: d['name'] for n, d in _g.nodes(data=True)})
+    # combine together OBO network so that node keys: id or term
+    _f = nx.compose(_g, _h)
+    # casefold and strip the keys, so the result is an agglomeration of nodes:
+    # SO(term) + SO(id) + HPO(term) + HPO(id), all lowercase and stripped
+    merged = nx.DiGraph(nx.relabel_nodes(_f, {n: n.casefold().strip() for n in _f.nodes()}))
+
+    graph = nx.DiGraph()
+    graph.add_nodes_from((n, {'id': d['id'], 'name': d['name']}) for n, d in merged.nodes(data=True))
+    graph.add_edges_from(merged.edges())
+    aliases = {n: d['id'] for n, d in graph.nodes(data=True)}
+    return _ontology(graph, aliases)
+
+
+def _ontology(graph, aliases):
+    # the undirected graph is a view, so it costs nothing to create and isn't stored in the snapshot
+    return Ontology(graph, graph.to_undirected(as_view=True), aliases)
+
+
+def _read_header(snapshot):
+    try:
+        with open(snapshot, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def load_ontology(obo_files, snapshot=None):
+    '''Loads the Ontology of obo_files from its snapshot, building and saving the snapshot first if it is missing or
+    was built from different files
+
+    The snapshot starts with a small header holding the size, modification time and sha256 of the obo files it was
+    built from. If the sizes and times still match, the ontology is loaded without reading the obo files at all;
+    otherwise they are hashed, and only parsed again if their content actually changed.
+    @param obo_files: list of obo file paths, in the order they are merged
+    @param snapshot: path of the snapshot. By default, SNAPSHOT_FILENAME next to the first obo file
+    @return: Ontology
+    '''
+    snapshot = snapshot or _default_path(obo_files, SNAPSHOT_FILENAME)
+
+    header = _read_header(snapshot)
+    valid, signature, checksum = _check_header(header, obo_files)
+    if valid:
+        with open(snapshot, 'rb') as file:
+            pickle.load(file)
+            ontology = _ontology(*pickle.load(file))
+        if checksum is not None:
+            # same content under a new mtime; refresh the header so the next load takes the fast path again
+            _save_snapshot(snapshot, ontology, signature, checksum)
+        return ontology
+
+    ontology = build_ontology(obo_files)
+    _save_snapshot(snapshot, ontology, signature, checksum or _files_checksum(obo_files))
+    return ontology
+
+
+def _save_snapshot(snapshot, ontology, signature, checksum):
+    header = {'version': SNAPSHOT_VERSION, 'signature': signature, 'checksum': checksum}
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(header, file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump((ontology.graph, ontology.aliases), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot)
+    except OSError:
+        # a read-only library directory only costs the rebuild next time
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _pack_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _csr(lists, count):
+    indptr = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum([len(l) for l in lists], out=indptr[1:])
+    indices = np.fromiter((i for l in lists for i in l), dtype=np.int32, count=int(indptr[-1]))
+    return indptr, indices
+
+
+def _gather(indptr, indices, frontier):
+    """Concatenated CSR rows of every node in frontier, and the position in frontier each entry came from"""
+    starts = indptr[frontier]
+    counts = indptr[frontier + 1] - starts
+    owners = np.repeat(np.arange(len(frontier)), counts)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    return indices[offsets], owners
+
+
+class OntologyGraph(object):
+    """Compact, array-backed form of the merged ontology.
+
+    Every term is a single integer, numbered in the order of its id node in the networkx ontology, and both its id and
+    its name resolve to it through the alias table. Edges are stored twice as CSR arrays: term -> parents (in the same
+    order networkx keeps them, so traversals visit terms in the same order) and term -> children. All arrays are
+    plain .npy files, so loading with mmap_mode shares one copy of them between processes.
+
+    Attributes:
+        parent_indptr, parent_indices: CSR adjacency of each term to its parents
+        child_indptr, child_indices: CSR adjacency of each term to its children
+        aliases: dictionary of every id and name to its term, built on first use
+        directory: directory the arrays are saved in, if any
+        checksum: sha256 of the obo files the graph was built from, if known
+    """
+
+    ARRAYS = ['id_bytes', 'id_offsets', 'name_bytes', 'name_offsets',
+              'parent_indptr', 'parent_indices', 'child_indptr', 'child_indices']
+
+    def __init__(self, id_bytes, id_offsets, name_bytes, name_offsets, parent_indptr, parent_indices, child_indptr,
+                 child_indices):
+        self.id_bytes = id_bytes
+        self.id_offsets = id_offsets
+        self.name_bytes = name_bytes
+        self.name_offsets = name_offsets
+        self.parent_indptr = parent_indptr
+        self.parent_indices = parent_indices
+        self.child_indptr = child_indptr
+        self.child_indices = child_indices
+        self._aliases = None
+        self.directory = None
+        self.checksum = None
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """Builds an OntologyGraph from the graph of an Ontology"""
+        ids = [n for n, d in graph.nodes(data=True) if n == d['id']]
+        terms = {n: i for i, n in enumerate(ids)}
+        names = [graph.nodes[n]['name'] for n in ids]
+
+        parents = [[terms[p] for p in graph.succ[n]] for n in ids]
+        children = [[] for _ in ids]
+        for child, term_parents in enumerate(parents):
+            for parent in term_parents:
+                children[parent].append(child)
+
+        return cls(*_pack_strings(ids), *_pack_strings(names), *_csr(parents, len(ids)), *_csr(children, len(ids)))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, getattr(self, name))
+            os.replace(tmp_path, os.path.join(directory, f'{name}.npy'))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        # plain ndarray views of the maps skip the per-operation overhead of np.memmap, and share the same pages
+        return cls(*[np.asarray(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode))
+                     for name in cls.ARRAYS])
+
+    def __len__(self):
+        return len(self.parent_indptr) - 1
+
+    @staticmethod
+    def _string(data, offsets, term):
+        return bytes(data[offsets[term]:offsets[term + 1]]).decode('utf-8')
+
+    def id(self, term):
+        return self._string(self.id_bytes, self.id_offsets, term)
+
+    def name(self, term):
+        return self._string(self.name_bytes, self.name_offsets, term)
+
+    def _strings(self, data, offsets):
+        text = bytes(data)
+        return [text[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))]
+
+    def ids(self):
+        return self._strings(self.id_bytes, self.id_offsets)
+
+    def names(self):
+        return self._strings(self.name_bytes, self.name_offsets)
+
+    @property
+    def aliases(self):
+        if self._aliases is None:
+            aliases = {name: term for term, name in enumerate(self.names())}
+            aliases.update((term_id, term) for term, term_id in enumerate(self.ids()))
+            self._aliases = aliases
+        return self._aliases
+
+    def __contains__(self, key):
+        return key in self.aliases
+
+    def index(self, key):
+        """Returns the term of an id or name, which must already be casefolded and stripped"""
+        return self.aliases[key]
+
+    def indices(self, keys, missing=-1):
+        """Returns an array of the terms of many ids or names, with missing for keys that aren't in the ontology"""
+        aliases = self.aliases
+        return np.fromiter((aliases.get(key, missing) for key in keys), dtype=np.int64, count=len(keys))
+
+    def parents(self, term):
+        return self.parent_indices[self.parent_indptr[term]:self.parent_indptr[term + 1]]
+
+    def children(self, term):
+        return self.child_indices[self.child_indptr[term]:self.child_indptr[term + 1]]
+
+    def _neighbors(self, frontier, direction):
+        if direction == 'parents':
+            return _gather(self.parent_indptr, self.parent_indices, frontier)
+        if direction == 'children':
+            return _gather(self.child_indptr, self.child_indices, frontier)
+        if direction == 'both':
+            parents, parent_owners = _gather(self.parent_indptr, self.parent_indices, frontier)
+            children, child_owners = _gather(self.child_indptr, self.child_indices, frontier)
+            owners = np.concatenate([parent_owners, child_owners])
+            order = np.argsort(owners, kind='stable')
+            return np.concatenate([parents, children])[order], owners[order]
+        raise ValueError(f"Unknown direction {direction}")
+
+    def _csr_arrays(self, direction):
+        if direction == 'parents':
+            return [(self.parent_indptr, self.parent_indices)]
+        if direction == 'children':
+            return [(self.child_indptr, self.child_indices)]
+        if direction == 'both':
+            return [(self.parent_indptr, self.parent_indices), (self.child_indptr, self.child_indices)]
+        raise ValueError(f"Unknown direction {direction}")
+
+    def bfs(self, source, direction='parents'):
+        '''Breadth first search from a term, one whole level at a time
+        Following parents or children, terms are visited in exactly the order of a queue based search such as
+        nx.bfs_edges over the networkx ontology.
+        @param source: term to start from
+        @param direction: 'parents', 'children', or 'both' to ignore the direction of edges. With 'both', the parents
+            of each term are visited before its children
+        @return: tuple of (terms in the order they were visited, the term each was reached from, -1 for the source)
+        '''
+        csr_arrays = self._csr_arrays(direction)
+        # the bytearray and the array share memory, so both ways of expanding a level see the same visited terms
+        visited_bytes = bytearray(len(self))
+        visited = np.frombuffer(visited_bytes, dtype=np.bool_)
+        visited_bytes[source] = 1
+        frontier = [source]
+        order = [frontier]
+        predecessors = [[-1]]
+        while len(frontier):
+            if len(frontier) <= SMALL_FRONTIER:
+                # on a small level, the fixed cost of each numpy call is more than the work it saves
+                level, level_predecessors = [], []
+                for term in frontier:
+                    for indptr, indices in csr_arrays:
+                        for neighbor in indices[indptr[term]:indptr[term + 1]].tolist():
+                            if not visited_bytes[neighbor]:
+                                visited_bytes[neighbor] = 1
+                                level.append(neighbor)
+                                level_predecessors.append(term)
+                predecessors.append(level_predecessors)
+                frontier = level if len(level) <= SMALL_FRONTIER else np.array(level, dtype=np.int64)
+            else:
+                neighbors, owners = self._neighbors(frontier, direction)
+                unvisited = ~visited[neighbors]
+                neighbors, owners = neighbors[unvisited], owners[unvisited]
+                # a term reached from several terms of the level is visited from the first of them
+                _, first = np.unique(neighbors, return_index=True)
+                first.sort()
+                predecessors.append(frontier[owners[first]])
+                frontier = neighbors[first].astype(np.int64)
+                visited[frontier] = True
+                if len(frontier) <= SMALL_FRONTIER:
+                    frontier = frontier.tolist()
+            order.append(frontier)
+        return (np.concatenate([np.asarray(level, dtype=np.int64) for level in order]),
+                np.concatenate([np.asarray(level, dtype=np.int64) for level in predecessors]))
+
+    def distances(self, source, direction='both'):
+        '''Number of edges on the shortest path from a term to every term
+        @return: int32 array with a distance for each term, -1 where there is no path
+        '''
+        distances = np.full(len(self), -1, dtype=np.int32)
+        distances[source] = 0
+        frontier = np.array([source], dtype=np.int64)
+        depth = 0
+        while len(frontier):
+            depth += 1
+            neighbors, _ = self._neighbors(frontier, direction)
+            frontier = np.unique(neighbors[distances[neighbors] < 0])
+            distances[frontier] = depth
+        return distances
+
+    def shortest_path_length(self, source, target, direction='both'):
+        """Number of edges on the shortest path between two terms, or None if there is no path
+
+        Searches from both ends at once, always growing the smaller frontier, and stops as soon as they meet.
+        """
+        if source == target:
+            return 0
+        backward = {'parents': 'children', 'children': 'parents', 'both': 'both'}[direction]
+        distances = [np.full(len(self), -1, dtype=np.int32), np.full(len(self), -1, dtype=np.int32)]
+        distances[0][source] = 0
+        distances[1][target] = 0
+        frontiers = [np.array([source], dtype=np.int64), np.array([target], dtype=np.int64)]
+        directions = [direction, backward]
+        depths = [0, 0]
+        while len(frontiers[0]) and len(frontiers[1]):
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            depths[side] += 1
+            neighbors, _ = self._neighbors(frontiers[side], directions[side])
+            met = neighbors[distances[1 - side][neighbors] >= 0]
+            if len(met):
+                return depths[side] + int(distances[1 - side][met].min())
+            frontier = np.unique(neighbors[distances[side][neighbors] < 0])
+            distances[side][frontier] = depths[side]
+            frontiers[side] = frontier
+        return None
+
+    def ancestors(self, term):
+        """Sorted array of every term reachable through parent edges, not including term itself"""
+        return np.sort(self.bfs(term, 'parents')[0][1:])
+
+    def descendants(self, term):
+        """Sorted array of every term reachable through child edges, not including term itself"""
+        return np.sort(self.bfs(term, 'children')[0][1:])
+
+    def generalization(self, general_keys):
+        '''Generalizes every term to one of a list of general terms
+        The generalization of a term is the first general term that nx.bfs_successors yields when searching the
+        parents of the term in the networkx ontology: the term itself, or else the first term in breadth first order
+        that reaches at least one parent that wasn't visited yet. General terms that are only reached after all of
+        their parents have already been visited are skipped, the same as they always have been.
+        @param general_keys: list of ids or names of the general terms; keys that aren't in the ontology are ignored
+        @return: int16 array with, for each term, the position in general_keys of its generalization, or -1
+        '''
+        targets = {}
+        for position, term in enumerate(self.indices(general_keys).tolist()):
+            if term >= 0:
+                targets.setdefault(term, position)
+
+        indptr = self.parent_indptr.tolist()
+        indices = self.parent_indices.tolist()
+        table = np.full(len(self), -1, dtype=np.int16)
+        # a term is visited in the search from source if visited_from[term] == source, so it is never reset
+        visited_from = [-1] * len(self)
+        for source in range(len(self)):
+            if source in targets:
+                table[source] = targets[source]
+                continue
+            visited_from[source] = source
+            queue = [source]
+            # the queue grows while it is iterated, which is a plain breadth first search
+            for term in queue:
+                reached = False
+                for parent in indices[indptr[term]:indptr[term + 1]]:
+                    if visited_from[parent] != source:
+                        visited_from[parent] = source
+                        queue.append(parent)
+                        reached = True
+                if reached and term in targets:
+                    table[source] = targets[term]
+                    break
+        return table
+
+
+def load_ontology_graph(obo_files, directory=None, mmap_mode='r'):
+    '''Loads the OntologyGraph of obo_files from its arrays, building and saving them first if they are missing or
+    were built from different files. The arrays are checked against the obo files the same way as load_ontology
+    @param obo_files: list of obo file paths, in the order they are merged
+    @param directory: directory of the arrays. By default, ONTOLOGY_GRAPH_DIRNAME next to the first obo file
+    @param mmap_mode: passed to np.load; None reads the arrays into memory instead of mapping them
+    @return: OntologyGraph, with the directory it is saved in and the checksum of the obo files it was built from
+    '''
+    directory = directory or _default_path(obo_files, ONTOLOGY_GRAPH_DIRNAME)
+    header_path = os.path.join(directory, ONTOLOGY_GRAPH_HEADER)
+
+    header = None
+    if os.path.isfile(header_path):
+        with open(header_path, 'r', encoding='utf-8') as file:
+            header = json.load(file)
+    valid, signature, checksum = _check_header(header, obo_files)
+
+    if not valid:
+        graph = OntologyGraph.from_networkx(load_ontology(obo_files).graph)
+        checksum = checksum or _files_checksum(obo_files)
+        graph.checksum = checksum
+        try:
+            if os.path.isfile(header_path):
+                os.remove(header_path)
+            # tables derived from the previous build are stale
+            for filename in glob.glob(os.path.join(directory, f'{DERIVED_PREFIX}*.npy')):
+                os.remove(filename)
+            graph.save(directory)
+        except OSError:
+            return graph
+
+    if checksum is not None:
+        # the header is written last, so the arrays are never used with the header of a different build
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'version': SNAPSHOT_VERSION, 'signature': signature, 'checksum': checksum}, file)
+            os.replace(tmp_path, header_path)
+        except OSError:
+            pass
+
+    graph = OntologyGraph.load(directory, mmap_mode)
+    graph.directory = directory
+    graph.checksum = checksum or header['checksum']
+    return graph
+
+
+def _load_derived(graph, name, key_parts, arrays, compute):
+    '''Loads arrays derived from graph, or computes them and saves them next to the arrays of the graph
+    @param name: name of the derived table
+    @param key_parts: strings that the table depends on besides the ontology itself
+    @param arrays: names of the arrays compute returns
+    @param compute: function that returns a dictionary of each name in arrays to its array
+    @return: dictionary of each name in arrays to its array
+    '''
+    key = hashlib.sha1('\n'.join([graph.checksum or ''] + list(key_parts)).encode('utf-8')).hexdigest()[:16]
+    filenames = {array: os.path.join(graph.directory, f'{DERIVED_PREFIX}{name}-{key}-{array}.npy')
+                 for array in arrays} if graph.directory else None
+    if filenames is not None and all(os.path.isfile(filename) for filename in filenames.values()):
+        return {array: np.load(filename) for array, filename in filenames.items()}
+
+    result = compute()
+    if filenames is not None:
+        try:
+            for array, filename in filenames.items():
+                fd, tmp_path = tempfile.mkstemp(dir=graph.directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as file:
+                    np.save(file, result[array])
+                os.replace(tmp_path, filename)
+        except OSError:
+            pass
+    return result
+
+
+def load_generalization(graph, general_keys):
+    '''Loads the generalization table of graph for general_keys, computing and saving it next to the arrays of the
+    graph first if it doesn't exist yet. Tables are keyed by the checksum of the ontology and the general keys, so
+    they are computed once per ontology version and list of general terms
+    @param graph: OntologyGraph returned by load_ontology_graph
+    @param general_keys: list of ids or names of the general terms
+    @return: array, see OntologyGraph.generalization
+    '''
+    return _load_derived(graph, 'generalization', general_keys, ['table'],
+                         lambda: {'table': graph.generalization(general_keys)})['table']
+
+
+class AncestorClosure(object):
+    """Transitive closure of the parent edges of an OntologyGraph.
+
+    Row t of the ancestor CSR arrays is the sorted array of t and all of its ancestors, so checking whether a term is
+    under another is a binary search in a row of a few dozen terms. The descendant CSR arrays are their transpose,
+    where row t holds t and all of its descendants, so every term under an ancestor is a single row slice. For a fixed
+    list of anchor terms, anchor_masks packs the same information into one uint64 bitmask per term.
+
+    Attributes:
+        indptr, indices: CSR rows of each term and its ancestors
+        descendant_indptr, descendant_indices: CSR rows of each term and its descendants
+        depth: length of the longest chain of parents from each term up to a root, so that the common ancestors of two
+            terms with the greatest depth are their lowest ones
+    """
+
+    ARRAYS = ['indptr', 'indices', 'depth', 'descendant_indptr', 'descendant_indices']
+
+    def __init__(self, indptr, indices, depth, descendant_indptr, descendant_indices):
+        self.indptr = indptr
+        self.indices = indices
+        self.depth = depth
+        self.descendant_indptr = descendant_indptr
+        self.descendant_indices = descendant_indices
+        self._lists = None
+
+    @staticmethod
+    def compute(graph):
+        """Computes the arrays of the closure of graph, visiting every term after all of its parents"""
+        count = len(graph)
+        indptr = graph.parent_indptr.tolist()
+        parents = graph.parent_indices.tolist()
+        child_indptr = graph.child_indptr.tolist()
+        children = graph.child_indices.tolist()
+
+        remaining = [indptr[t + 1] - indptr[t] for t in range(count)]
+        queue = [t for t in range(count) if remaining[t] == 0]
+        for term in queue:
+            for child in children[child_indptr[term]:child_indptr[term + 1]]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    queue.append(child)
+
+        closures = [None] * count
+        depth = [0] * count
+        for term in queue:
+            closure = {term}
+            for parent in parents[indptr[term]:indptr[term + 1]]:
+                closure.update(closures[parent])
+                depth[term] = max(depth[term], depth[parent] + 1)
+            closures[term] = closure
+        # a cycle of relationships would leave its terms out of the queue; they are closed by searching instead
+        for term in range(count):
+            if closures[term] is None:
+                closures[term] = {term, *graph.ancestors(term).tolist()}
+
+        rows = [sorted(closure) for closure in closures]
+        closure_indptr, closure_indices = _csr(rows, count)
+
+        # the transpose: a stable sort of the entries by ancestor keeps the terms of each row in order
+        owners = np.repeat(np.arange(count, dtype=np.int32), np.diff(closure_indptr))
+        descendant_indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(closure_indices, minlength=count), out=descendant_indptr[1:])
+        descendant_indices = owners[np.argsort(closure_indices, kind='stable')]
+        return {'indptr': closure_indptr, 'indices': closure_indices, 'depth': np.array(depth, dtype=np.int16),
+                'descendant_indptr': descendant_indptr, 'descendant_indices': descendant_indices}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def ancestors(self, term):
+        """Sorted array of term and all of its ancestors"""
+        return self.indices[self.indptr[term]:self.indptr[term + 1]]
+
+    def is_a(self, term, ancestor):
+        """Whether ancestor is term itself or one of its ancestors"""
+        # on rows this short, numpy's per-call overhead dominates, so single checks bisect plain list copies instead
+        if self._lists is None:
+            self._lists = (self.indptr.tolist(), self.indices.tolist())
+        indptr, indices = self._lists
+        end = indptr[term + 1]
+        i = bisect.bisect_left(indices, ancestor, indptr[term], end)
+        return i < end and indices[i] == ancestor
+
+    def descendants(self, ancestor):
+        """Sorted array of ancestor and all of its descendants"""
+        return self.descendant_indices[self.descendant_indptr[ancestor]:self.descendant_indptr[ancestor + 1]]
+
+    def descendant_mask(self, ancestor):
+        """Boolean array over all terms of whether each is ancestor or one of its descendants"""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.descendants(ancestor)] = True
+        return mask
+
+    def is_a_many(self, terms, ancestor):
+        """Vectorized is_a for an array of terms, where -1 (such as a key missing from OntologyGraph.indices) is False"""
+        terms = np.asarray(terms)
+        return np.append(self.descendant_mask(ancestor), False)[terms]
+
+    def anchor_masks(self, anchors):
+        """uint64 array over all terms, with bit i set if the term is anchors[i] or one of its descendants"""
+        if len(anchors) > 64:
+            raise ValueError(f"At most 64 anchors fit in a mask, not {len(anchors)}")
+        masks = np.zeros(len(self), dtype=np.uint64)
+        for bit, anchor in enumerate(anchors):
+            masks[self.descendants(anchor)] |= np.uint64(1 << bit)
+        return masks
+
+    def common_ancestors(self, term1, term2):
+        return np.intersect1d(self.ancestors(term1), self.ancestors(term2), assume_unique=True)
+
+    def lowest_common_ancestors(self, term1, term2):
+        """The deepest common ancestors of two terms; more than one when several are equally deep"""
+        common = self.common_ancestors(term1, term2)
+        if not len(common):
+            return common
+        depths = self.depth[common]
+        return common[depths == depths.max()]
+
+
+def load_ancestor_closure(graph):
+    """Loads the AncestorClosure of graph, computing and saving it next to the arrays of the graph the first time"""
+    arrays = _load_derived(graph, 'closure', [], AncestorClosure.ARRAYS, lambda: AncestorClosure.compute(graph))
+    return AncestorClosure(*[arrays[name] for name in AncestorClosure.ARRAYS])
+
+
+class TermDistances(object):
+    """Shortest-path distances between the terms of an OntologyGraph that are actually compared, ignoring the direction
+    of edges.
+
+    The first time a term is used, one breadth first search from it finds its distance to every term; the searches of
+    all new terms run together in scipy's compiled csgraph code. Only the distances among the tracked terms are kept,
+    in a symmetric matrix that grows as new terms come in, so every pair costs a lookup from then on.
+
+    Attributes:
+        terms: tracked terms, in the order of the rows and columns of matrix
+        matrix: int16 distances between the tracked terms, -1 where there is no path
+    """
+
+    def __init__(self, graph, chunk_size=DISTANCE_CHUNK_SIZE):
+        self.graph = graph
+        self.chunk_size = chunk_size
+        self.terms = np.zeros(0, dtype=np.int64)
+        self.matrix = np.zeros((0, 0), dtype=np.int16)
+        self._positions = {}
+        self._adjacency = None
+
+    def add(self, terms):
+        """Starts tracking terms, computing their distances to all tracked terms"""
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import shortest_path
+
+        new = [term for term in dict.fromkeys(np.asarray(terms, dtype=np.int64).tolist()) if term not in self._positions]
+        if not new:
+            return
+        if self._adjacency is None:
+            # the parent edges alone; csgraph makes them undirected. csgraph can't use the read-only memory maps of the
+            # graph, so the matrix gets its own copy of them
+            count = len(self.graph)
+            self._adjacency = csr_matrix((np.ones(len(self.graph.parent_indices), dtype=np.int8),
+                                          np.array(self.graph.parent_indices), np.array(self.graph.parent_indptr)),
+                                         shape=(count, count))
+
+        old = len(self.terms)
+        terms = np.concatenate([self.terms, np.array(new, dtype=np.int64)])
+        rows = np.empty((len(new), len(terms)), dtype=np.int16)
+        # each search returns distances to every term, so sources are searched in chunks to bound memory
+        for start in range(0, len(new), self.chunk_size):
+            sources = new[start:start + self.chunk_size]
+            distances = shortest_path(self._adjacency, directed=False, unweighted=True, indices=sources)[:, terms]
+            distances[np.isinf(distances)] = -1
+            rows[start:start + len(sources)] = distances
+
+        matrix = np.empty((len(terms), len(terms)), dtype=np.int16)
+        matrix[:old, :old] = self.matrix
+        matrix[old:, :] = rows
+        matrix[:old, old:] = rows[:, :old].T
+        self.terms = terms
+        self.matrix = matrix
+        self._positions.update((term, old + i) for i, term in enumerate(new))
+
+    def positions(self, terms):
+        """Rows of terms in matrix, tracking any that aren't tracked yet"""
+        self.add(terms)
+        return np.fromiter((self._positions[term] for term in np.asarray(terms).tolist()), dtype=np.int64,
+                           count=len(terms))
+
+    def between(self, terms1, terms2):
+        """Matrix of the distances from each of terms1 to each of terms2, -1 where there is no path"""
+        rows, columns = self.positions(terms1), self.positions(terms2)
+        return self.matrix[np.ix_(rows, columns)]
+
+
+def obo_data_version(obo_file):
+    '''The data-version in the header of an obo file, i.e. hp/releases/2025-01-16
+    @return: the version string, or None if the file is missing or has no data-version
+    '''
+    try:
+        with open(obo_file, 'r', encoding='utf-8') as file:
+            for line in file:
+                # the header ends at the first stanza
+                if line.startswith('['):
+                    break
+                if line.startswith('data-version:'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return None
+
+
+@contextmanager
+def _file_lock(path, timeout=OBO_LOCK_TIMEOUT):
+    """Holds <path>.lock, so that only one process at a time fetches into path"""
+    lock_path = f'{path}.lock'
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                # the lock was released while it was checked
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def _copy_into(path, stream, version=None):
+    """Atomically replaces path with the content of a binary stream. If a version is given, a copy of any other
+    data-version raises a ValueError and leaves path as it was"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            shutil.copyfileobj(stream, file)
+        if version is not None and obo_data_version(tmp_path) != version:
+            raise ValueError(f"Got version {obo_data_version(tmp_path)} of {os.path.basename(path)}, but version "
+                             f"{version} is pinned")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def provision_obo(path, href, version=None, offline=False, shared=(), max_age=OBO_MAX_AGE):
+    '''Makes sure that a copy of an obo file is at path, going to the network only when there is no local copy of it
+    A copy at path that has the pinned version (or any copy when nothing is pinned) is used as it is, without a
+    request. Otherwise, a shared copy with the pinned version is copied in; failing that, the file is fetched through a
+    FetchCache, which serves it for max_age seconds and then revalidates it with a conditional request. When offline or
+    the server can't be reached, an existing copy of another version is used instead, with a warning. Processes that
+    provision the same path wait for each other.
+    @param path: where the obo file is kept
+    @param href: url the obo file is downloaded from
+    @param version: data-version to pin the file to, or None to use whichever version is already there
+    @param offline: if True, never uses the network
+    @param shared: paths of other copies of the same obo file, i.e. the ones in SHARED_OBO_DIR
+    @param max_age: seconds a downloaded file is used without revalidating it
+    @return: path
+    '''
+    logger = logging.getLogger('provision_obo')
+
+    def usable(candidate):
+        return os.path.isfile(candidate) and (version is None or obo_data_version(candidate) == version)
+
+    if usable(path):
+        return path
+
+    with _file_lock(path):
+        # another process might have provisioned the file while this one waited for the lock
+        if usable(path):
+            return path
+
+        copy = next((candidate for candidate in shared if usable(candidate)), None)
+        if copy is not None:
+            with open(copy, 'rb') as stream:
+                _copy_into(path, stream)
+            return path
+
+        if offline:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"No local copy of {os.path.basename(path)}{f' {version}' if version else ''} "
+                                        f"to use offline")
+            logger.warning(f"Using {path} {obo_data_version(path)} offline instead of the pinned {version}")
+            return path
+
+        from .fetching.FetchCache import FetchCache
+
+        cache = FetchCache(os.path.join(os.path.dirname(os.path.abspath(path)), OBO_CACHE_DIRNAME), max_age=max_age)
+        try:
+            with cache.open(href) as stream:
+                # the download only replaces the local copy once it is known to be the pinned version
+                _copy_into(path, stream, version)
+        except (urllib.error.URLError, OSError) as e:
+            if not os.path.isfile(path):
+                raise
+            logger.warning(f"Using the local copy of {path}: {e!r}")
+
+    return path
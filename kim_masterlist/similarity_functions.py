@@ -2,8 +2,11 @@ import math
 
 import networkx as nx
 import numpy as np
+import pandas as pd
+from scipy import sparse
 
 from kim_masterlist import variant_functions as vf
+from kim_masterlist.ontology import TermDistances
 
 
 ### The functions here perform variant-to-variant similarity analysis for pairs of nodes.
@@ -49,33 +52,84 @@ def variant_score_domains(n1, n2, domain):
     return score
 
 
+def _position_score(pos1, pos2, sigma):
+    if pos1 is None or pos2 is None or pd.isna(pos1) or pd.isna(pos2):
+        return 0
+    return math.exp(-0.5 * (((pos1 - pos2) / sigma) ** 2))
+
+
 def variant_aa_distance(n1, n2, sigma=5):
     '''Calculates similarity between snvs based on how far (in aa) they are
-    Currently uses a gaussian distribution
+    Currently uses a gaussian distribution over the start codons; variants without one score 0
     '''
-    # TODO: get these from the nodes
-    aa1 = 5
-    aa2 = 10
-
-    score = math.exp(-0.5 * (((aa1 - aa2) / sigma) ** 2))
-    return score
+    return _position_score(n1['all'].get('codon_start'), n2['all'].get('codon_start'), sigma)
 
 
 def variant_nt_distance(n1, n2, sigma=200):
     '''Calculates similarity between snvs based on how far (in base pairs) they are
-    Currently uses a gaussian distribution
+    Currently uses a gaussian distribution over the cdna start positions; variants without one score 0
     '''
-    # TODO: get these from the nodes
-    nt1 = 5
-    nt2 = 10
+    return _position_score(n1['all'].get('cdna_start'), n2['all'].get('cdna_start'), sigma)
 
-    score = math.exp(-0.5 * (((nt1 - nt2) / sigma) ** 2))
-    return score
+
+# distances between the ontology terms that are compared, computed once per distinct term. It is created by
+# get_obo_distances the first time a distance is needed, not on import
+OBO_DISTANCES = None
+
+
+def get_obo_distances():
+    '''The TermDistances of the ontology, shared by all distance functions
+    @return: OBO_DISTANCES
+    '''
+    global OBO_DISTANCES
+    if OBO_DISTANCES is None:
+        OBO_DISTANCES = TermDistances(vf.OBO_GRAPH)
+    return OBO_DISTANCES
 
 
-def graph_distance(id1, id2, obo):
+def _obo_terms(keys):
+    """Ontology terms of node keys (-1 if missing), and whether each key is the id of its term rather than its name"""
+    terms = vf.OBO_GRAPH.indices(keys)
+    is_id = np.array([term >= 0 and key == vf.OBO_GRAPH.id(term) for key, term in zip(keys, terms.tolist())],
+                     dtype=bool)
+    return terms, is_id
+
+
+def obo_distance_matrix(ids1, ids2):
+    '''graph_distance between every node key of ids1 and every node key of ids2
+    The networkx ontology keeps the ids and the names of terms as two unconnected copies of the ontology, so a name is
+    never connected to an id; that is kept here as well.
+    @return: float array of shape (len(ids1), len(ids2)), with nan where there is no path
+    '''
+    ids1, ids2 = list(ids1), list(ids2)
+    terms1, is_id1 = _obo_terms(ids1)
+    terms2, is_id2 = _obo_terms(ids2)
+    equal = np.equal.outer(np.array(ids1, dtype=object), np.array(ids2, dtype=object)).astype(bool)
+    # identical keys are at distance 0 without looking them up, as with networkx; any other missing key is an error
+    missing = np.logical_or.outer(terms1 < 0, terms2 < 0) & ~equal
+    if missing.any():
+        i, j = np.argwhere(missing)[0]
+        raise ValueError(f"Could not find an OBO node for {ids1[i] if terms1[i] < 0 else ids2[j]}")
+
+    distances = np.full((len(ids1), len(ids2)), np.nan)
+    rows, cols = np.flatnonzero(terms1 >= 0), np.flatnonzero(terms2 >= 0)
+    if len(rows) and len(cols):
+        found = get_obo_distances().between(terms1[rows], terms2[cols]).astype(float)
+        found[found < 0] = np.nan
+        distances[np.ix_(rows, cols)] = found
+    distances[np.not_equal.outer(is_id1, is_id2)] = np.nan
+    distances[equal] = 0
+    return distances + 1
+
+
+def graph_distance(id1, id2, obo=None):
     """Given two node ids and an obo, find their shortes distance
+    Without an obo, the distance is looked up in get_obo_distances()
     """
+    if obo is None:
+        distance = obo_distance_matrix([id1], [id2])[0, 0]
+        return None if np.isnan(distance) else int(distance)
+
     distance = None
     if id1 == id2:
         distance = 0
@@ -92,14 +146,30 @@ def graph_distance(id1, id2, obo):
     return distance
 
 
-# Note: an undirected graph is needed here for distance calculations
-def variant_obo_distance(ids1, ids2, obo, sigma=1):
+def _geometric_mean_score(all_distances, sigma):
     score = 0
-    all_distances = []
-    geo_mean = None
+    if len(all_distances) > 0:
+        geo_mean = np.exp(np.log(all_distances).mean())
+        score = math.exp(-0.5 * (((geo_mean - 1) / sigma) ** 2))
+    return score
 
+
+# Note: an undirected graph is needed here for distance calculations
+def variant_obo_distance(ids1, ids2, obo=None, sigma=1):
+    '''Scores two lists of ontology terms by the geometric mean of the distance from each term of the longer list to
+    the closest term of the shorter one. Without an obo, the distances come from get_obo_distances() as one matrix
+    '''
     longer_list = ids1 if len(ids1) >= len(ids2) else ids2
     shorter_list = ids1 if len(ids1) < len(ids2) else ids2
+
+    if obo is None:
+        if not len(shorter_list):
+            return 0
+        distances = obo_distance_matrix(longer_list, shorter_list)
+        closest = np.where(np.isnan(distances), np.inf, distances).min(axis=1)
+        return _geometric_mean_score(closest[np.isfinite(closest)], sigma)
+
+    all_distances = []
     for id1 in longer_list:
         distances = []
         for id2 in shorter_list:
@@ -110,23 +180,167 @@ def variant_obo_distance(ids1, ids2, obo, sigma=1):
         if len(distances) > 0:
             all_distances.append(min(distances))
 
-    if len(all_distances) > 0:
-        a = np.log(all_distances)
-        geo_mean = np.exp(a.sum() / len(a))
-
-    if geo_mean is not None:
-        score = math.exp(-0.5 * (((geo_mean - 1) / sigma) ** 2))
-
-    return score
+    return _geometric_mean_score(all_distances, sigma)
 
 
 def variant_hpo_distance(n1, n2, sigma=1):
     list1 = n1['all']['associatedPhenotypes']
     list2 = n2['all']['associatedPhenotypes']
-    return variant_obo_distance(list1, list2, vf.OBONET_UD, sigma=1)
+    return variant_obo_distance(list1, list2, sigma=1)
 
 
 def variant_so_distance(n1, n2, sigma=1):
     list1 = n1['all']['variantTypes']
     list2 = n2['all']['variantTypes']
-    return variant_obo_distance(list1, list2, vf.OBONET_UD, sigma=1)
+    return variant_obo_distance(list1, list2, sigma=1)
+
+
+## Batch scoring functions
+# The same scores for every pair of rows of a preprocessed variant table at once, as N x N matrices. The one-hot
+# columns of the table are named "<group>.<value>", i.e. "generalized_mutant_type.missense_variant"; a row has a value
+# when its column is at least 1. Rows are scored in chunks of SIMILARITY_CHUNK_SIZE, so only one chunk of dense
+# intermediates exists at a time. Scores can also be returned as a sparse matrix that keeps only the scores at or above
+# a threshold, which bounds memory for tens of thousands of variants. Domain scores, which are 1 for every pair of the
+# rows that affect a domain, are returned as the factor of their matrix instead.
+
+# number of rows of the table scored at a time
+SIMILARITY_CHUNK_SIZE = 1024
+
+
+def _group_columns(df, group):
+    return [col for col in df.columns if isinstance(col, str) and col.startswith(f"{group}.")]
+
+
+def _value_matrix(df, columns):
+    """Sparse boolean matrix of which rows of df have each of the one-hot columns"""
+    values = df[columns].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=float) >= 1
+    return sparse.csr_matrix(values.reshape(len(df), len(columns)))
+
+
+def _chunked_matrix(n, score_rows, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''
+    Assembles an n x n score matrix from dense chunks of its rows
+    @param score_rows: function of (start, stop) that returns the dense scores of rows start to stop
+    @param threshold: if given, scores below it are dropped and a sparse csr matrix is returned
+    @return: dense array, or sparse csr matrix with a threshold
+    '''
+    if threshold is None:
+        scores = np.empty((n, n))
+        for start in range(0, n, chunk_size):
+            scores[start:start + chunk_size] = score_rows(start, min(start + chunk_size, n))
+        return scores
+
+    chunks = []
+    for start in range(0, n, chunk_size):
+        rows = score_rows(start, min(start + chunk_size, n))
+        rows[rows < threshold] = 0
+        chunks.append(sparse.csr_matrix(rows))
+    return sparse.vstack(chunks, format='csr') if chunks else sparse.csr_matrix((n, n))
+
+
+def variant_iou_matrix(df, group, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''score_iou between every pair of rows of df, for the values of a group of one-hot columns
+    @param df: preprocessed variant table
+    @param group: prefix of the one-hot columns, i.e. "generalized_phenotype"
+    @return: dense array, or sparse csr matrix with a threshold
+    '''
+    values = _value_matrix(df, _group_columns(df, group)).astype(np.int32)
+    sizes = np.asarray(values.sum(axis=1)).ravel()
+    transposed = values.T.tocsc()
+
+    def score_rows(start, stop):
+        intersect = (values[start:stop] @ transposed).toarray()
+        union = sizes[start:stop, None] + sizes[None, :] - intersect
+        return np.divide(intersect, union, out=np.zeros(intersect.shape), where=union > 0)
+
+    return _chunked_matrix(len(df), score_rows, threshold, chunk_size)
+
+
+def variant_domain_matrix(df, domain):
+    '''variant_score_domains between every pair of rows of df: 1 where both rows affect the domain
+    Every pair of the k rows that affect a domain scores 1, so the score matrix has k * k entries, which is nearly dense
+    for a common domain. It is returned as its factor instead: the scores are affected @ affected.T, and a single row,
+    affected[i] @ affected.T, or a product with a vector only take O(n)
+    @param df: preprocessed variant table, with the region columns
+    @return: sparse csr matrix of shape (len(df), 1), which is 1 for the rows that affect the domain
+    '''
+    col = f"region.{domain}"
+    if col not in df:
+        return sparse.csr_matrix((len(df), 1), dtype=np.int8)
+    return _value_matrix(df, [col]).astype(np.int8)
+
+
+def _position_matrix(positions, sigma, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''Gaussian kernel over every pair of positions; missing positions score 0 with everything
+    '''
+    positions = np.asarray(positions, dtype=float)
+
+    def score_rows(start, stop):
+        scores = np.exp(-0.5 * ((positions[start:stop, None] - positions[None, :]) / sigma) ** 2)
+        scores[np.isnan(scores)] = 0
+        return scores
+
+    return _chunked_matrix(len(positions), score_rows, threshold, chunk_size)
+
+
+def variant_aa_distance_matrix(df, sigma=5, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''variant_aa_distance between every pair of rows of df, from their codon_start column
+    '''
+    positions = df['codon_start'] if 'codon_start' in df else np.full(len(df), np.nan)
+    return _position_matrix(positions, sigma, threshold, chunk_size)
+
+
+def variant_nt_distance_matrix(df, sigma=200, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''variant_nt_distance between every pair of rows of df, from their cdna_start column
+    '''
+    positions = df['cdna_start'] if 'cdna_start' in df else np.full(len(df), np.nan)
+    return _position_matrix(positions, sigma, threshold, chunk_size)
+
+
+def variant_obo_distance_matrix(df, group, sigma=1, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    '''variant_obo_distance between every pair of rows of df, for the ontology terms of a group of one-hot columns
+    The distances between the distinct terms of the group are computed once; each row then gets, for every term, its
+    distance to the closest of the row's own terms, and the geometric means of every pair of rows are sums over those.
+    @param df: preprocessed variant table
+    @param group: prefix of the one-hot columns whose values are ontology terms, i.e. "generalized_mutant_type"
+    @return: dense array, or sparse csr matrix with a threshold
+    '''
+    columns = _group_columns(df, group)
+    terms = [col[len(group) + 1:] for col in columns]
+    has_term = _value_matrix(df, columns).toarray()
+    term_distances = obo_distance_matrix(terms, terms)
+    term_distances[np.isnan(term_distances)] = np.inf
+
+    # closest[t, j]: distance from term t to the closest term of row j
+    closest = np.full((len(terms), len(df)), np.inf)
+    for t in range(len(terms)):
+        closest[:, has_term[:, t]] = np.minimum(closest[:, has_term[:, t]], term_distances[:, [t]])
+    found = np.isfinite(closest)
+    log_closest = np.where(found, np.log(np.where(found, closest, 1)), 0)
+
+    has_term = has_term.astype(float)
+    found = found.astype(float)
+    counts = has_term.sum(axis=1)
+
+    def scores(totals, founds):
+        geo_mean = np.exp(np.divide(totals, founds, out=np.zeros_like(totals), where=founds > 0))
+        return np.where(founds > 0, np.exp(-0.5 * (((geo_mean - 1) / sigma) ** 2)), 0)
+
+    def score_rows(start, stop):
+        rows = slice(start, stop)
+        # row i against row j, with the terms of i as the longer list, and the other way around
+        forward = scores(has_term[rows] @ log_closest, has_term[rows] @ found)
+        backward = scores((has_term @ log_closest[:, rows]).T, (has_term @ found[:, rows]).T)
+        # as in variant_obo_distance, the first list counts as the longer one when both are the same length
+        return np.where(counts[rows, None] >= counts[None, :], forward, backward)
+
+    return _chunked_matrix(len(df), score_rows, threshold, chunk_size)
+
+
+def variant_hpo_distance_matrix(df, group="phenotype", sigma=1, threshold=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    return variant_obo_distance_matrix(df, group, sigma=sigma, threshold=threshold, chunk_size=chunk_size)
+
+
+def variant_so_distance_matrix(df, group="generalized_mutant_type", sigma=1, threshold=None,
+                               chunk_size=SIMILARITY_CHUNK_SIZE):
+    return variant_obo_distance_matrix(df, group, sigma=sigma, threshold=threshold, chunk_size=chunk_size)
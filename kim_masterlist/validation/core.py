@@ -1,16 +1,38 @@
+import hashlib
+import logging
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import requests
-from lxml import html
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import litvar.utils
+from ..constants import UMD_CACHE_DIR
 from ..variant_functions import get_aa_from_predicted_consequence
 
-cdna_xpath = '/html/body/div/table[1]/tr[2]/td[1]'
-aa_xpath = '/html/body/div/table[1]/tr[2]/td[2]'
+# xpath expressions are compiled once and reused for every variant page
+cdna_xpath = etree.XPath('/html/body/div/table[1]/tr[2]/td[1]')
+aa_xpath = etree.XPath('/html/body/div/table[1]/tr[2]/td[2]')
 
-pubmed_xpath = '//td/a'
+pubmed_xpath = etree.XPath('//td/a')
+link_xpath = etree.XPath('//a/@href')
 
 base_link = 'http://www.umd.be/VHL/4DACTION'
+umd_index_link = 'http://www.umd.be/VHL/4DACTION/W_DMDT1/1'
+
+# number of variant pages requested from the UMD site at the same time
+UMD_MAX_WORKERS = 8
+# failed requests (connection errors and these status codes) are retried with exponential backoff
+UMD_RETRIES = 5
+UMD_BACKOFF_FACTOR = 0.5
+UMD_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# seconds the cached index page is used before it is downloaded again. New variants only show up in the index, so it
+# is downloaded on every run; variant pages don't change and are always read from the cache once they are there
+UMD_INDEX_MAX_AGE = 0
 
 MASTERLIST_PMID_COL = "PMID"
 MASTERLIST_HGVS_COL = "HGVS_transcript"
@@ -79,43 +101,108 @@ def compare_pmids(df_list, df_cols):
 
 
 
-def get_umd_variants():
-
-    page = requests.get('http://www.umd.be/VHL/4DACTION/W_DMDT1/1', verify=False)
-    tree = html.fromstring(page.content)
-    all_links = tree.xpath("//a")
-    variant_link_set = set()
-    for link in all_links:
-        href = link.attrib["href"]
-        if href.startswith("../../4DACTION/WV/"):
-            abslink = href.replace("../../4DACTION", base_link)
-            variant_link_set.add(abslink)
-
-    variants = []
-
-    for variant_link in variant_link_set:
-        variant = {}
-
-        v_page = requests.get(variant_link)
-        v_tree = html.fromstring(v_page.content)
-
-        cdna_ele = v_tree.xpath(cdna_xpath)
-        aa_ele = v_tree.xpath(aa_xpath)
-
-        if cdna_ele:
-            variant["Mutation Event c.DNA."] = cdna_ele[0].text
-
-        if aa_ele:
-            variant["Predicted Consequence Protein Change"] = aa_ele[0].text
-
-        pubmed_ele = v_tree.xpath(pubmed_xpath)
-        if pubmed_ele and pubmed_ele[0].text.isdecimal():
-            variant["UMD_PMID"] = str(pubmed_ele[0].text)
-
-
-        if variant:
-            variants.append(variant)
-
+def get_umd_session(max_workers=UMD_MAX_WORKERS):
+    """
+    Creates a requests session whose connection pool fits max_workers concurrent requests, and that retries failed
+    requests with exponential backoff
+    """
+    retry = Retry(total=UMD_RETRIES, backoff_factor=UMD_BACKOFF_FACTOR, status_forcelist=UMD_RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_umd_page(session, link, cache_dir=UMD_CACHE_DIR, refresh=False, max_age=None, **kwargs):
+    """
+    Gets the html of a UMD page, from the on-disk cache if it was downloaded before
+    @param session: requests session to download the page with
+    @param link: url of the page
+    @param cache_dir: directory the html of each page is cached in, keyed by the hash of its url
+    @param refresh: if True, the page is downloaded even if it is cached
+    @param max_age: if given, a cached page older than this many seconds is downloaded again. The cached page is still
+        used if that download fails
+    @return: the html content of the page, as bytes
+    """
+    cache_path = os.path.join(cache_dir, f"{hashlib.sha1(link.encode('utf-8')).hexdigest()}.html")
+    cached = os.path.isfile(cache_path)
+    if cached and not refresh and (max_age is None or time.time() - os.path.getmtime(cache_path) < max_age):
+        with open(cache_path, 'rb') as file:
+            return file.read()
+
+    try:
+        page = session.get(link, **kwargs)
+        page.raise_for_status()
+    except requests.RequestException as e:
+        if not cached or refresh:
+            raise
+        logging.getLogger("get_umd_page").warning(f"Using the cached copy of {link}: {e!r}")
+        with open(cache_path, 'rb') as file:
+            return file.read()
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(page.content)
+    os.replace(tmp_path, cache_path)
+    return page.content
+
+
+def parse_umd_variant(content):
+    """
+    Parses the cdna change, protein change and first pubmed reference out of a UMD variant page
+    @param content: html of the variant page
+    @return: dictionary of the variant's fields, empty if none were found
+    """
+    variant = {}
+    v_tree = html.fromstring(content)
+
+    cdna_ele = cdna_xpath(v_tree)
+    aa_ele = aa_xpath(v_tree)
+
+    if cdna_ele:
+        variant["Mutation Event c.DNA."] = cdna_ele[0].text
+
+    if aa_ele:
+        variant["Predicted Consequence Protein Change"] = aa_ele[0].text
+
+    pubmed_ele = pubmed_xpath(v_tree)
+    if pubmed_ele and pubmed_ele[0].text.isdecimal():
+        variant["UMD_PMID"] = str(pubmed_ele[0].text)
+
+    return variant
+
+
+def get_umd_variants(refresh=False, max_workers=UMD_MAX_WORKERS, cache_dir=UMD_CACHE_DIR):
+    """
+    Scrapes all variants from the UMD VHL database. The index page is downloaded again once it is older than
+    UMD_INDEX_MAX_AGE, so new variants are found. Variant pages are downloaded concurrently over a shared session, and
+    cached on disk so that later runs only parse them
+    @param refresh: if True, the variant pages are downloaded again instead of read from the cache
+    @param max_workers: number of variant pages requested at the same time
+    @param cache_dir: directory the html of the pages is cached in
+    @return: dataframe of the UMD variants
+    """
+    logger = logging.getLogger("get_umd_variants")
+    os.makedirs(cache_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    with get_umd_session(max_workers) as session:
+        page = get_umd_page(session, umd_index_link, cache_dir, max_age=UMD_INDEX_MAX_AGE, verify=False)
+        tree = html.fromstring(page)
+        variant_link_set = set()
+        for href in link_xpath(tree):
+            if href.startswith("../../4DACTION/WV/"):
+                abslink = href.replace("../../4DACTION", base_link)
+                variant_link_set.add(abslink)
+
+        def get_variant(variant_link):
+            return parse_umd_variant(get_umd_page(session, variant_link, cache_dir, refresh))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            variants = [variant for variant in executor.map(get_variant, sorted(variant_link_set)) if variant]
+
+    logger.info(f"Scraped {len(variant_link_set)} UMD variant pages in {time.perf_counter() - start:.2f}s")
     variant_df = pd.DataFrame.from_dict(variants)
 
     return variant_df
@@ -151,10 +238,10 @@ def create_litvar_validation_table(directory, df):
     litvar_pmid_df.to_csv(os.path.join(directory, 'litvar_pmids.csv'))
 
 
-def create_umd_validation_table(directory, df):
+def create_umd_validation_table(directory, df, refresh=False):
     umd_path = os.path.join(directory, "umd.csv")
-    if not os.path.isfile(umd_path):
-        umd_variant_df = get_umd_variants()
+    if refresh or not os.path.isfile(umd_path):
+        umd_variant_df = get_umd_variants(refresh=refresh)
         umd_variant_df.to_csv(umd_path)
 
     umd_variant_df = pd.read_csv(umd_path, dtype={"UMD_PMID": str}, index_col=False)
@@ -1,13 +1,14 @@
-import math
 import os
 import re
 
-import networkx as nx
-import obonet
+import numpy as np
+import pandas as pd
 from Bio import SeqIO
 from Bio.Data.IUPACData import protein_letters_1to3, protein_letters_3to1
 from Bio.Seq import Seq
 
+from .ontology import load_ancestor_closure, load_generalization, load_ontology, load_ontology_graph
+
 LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'lib')
 
 ### The functions here are related to variant-based analysis for each individual node.
@@ -75,6 +76,16 @@ VHL_FUNCTIONAL_REGIONS = {
 VHL_FUNCTIONAL_REGIONS['Outside of ⍺-Domain and β-Domain'] = set(range(1, 214)) - (VHL_FUNCTIONAL_REGIONS['⍺-Domain'] | VHL_FUNCTIONAL_REGIONS['β-Domain'])
 VHL_DOMAIN_NAMES = ["⍺-Domain", "β-Domain", 'Outside of ⍺-Domain and β-Domain']
 
+# region membership of every codon, as bit i for the i-th region of VHL_FUNCTIONAL_REGIONS, and the running count of
+# codons of each region before every position. Whether a range of codons [start, stop) touches a region is then just
+# a difference of two counts, for a whole column of ranges at once
+VHL_REGION_NAMES = list(VHL_FUNCTIONAL_REGIONS)
+CODON_REGION_BITS = np.zeros(max(max(codons) for codons in VHL_FUNCTIONAL_REGIONS.values()) + 1, dtype=np.uint8)
+for _bit, _codons in enumerate(VHL_FUNCTIONAL_REGIONS.values()):
+    CODON_REGION_BITS[sorted(_codons)] |= np.uint8(1 << _bit)
+CODON_REGION_PREFIX = np.zeros((len(CODON_REGION_BITS) + 1, len(VHL_REGION_NAMES)), dtype=np.int32)
+CODON_REGION_PREFIX[1:] = np.cumsum((CODON_REGION_BITS[:, None] >> np.arange(len(VHL_REGION_NAMES))) & 1, axis=0)
+
 ALPHA_LEN = len(VHL_FUNCTIONAL_REGIONS['⍺-Domain'])
 BETA_LEN = len(VHL_FUNCTIONAL_REGIONS['β-Domain'])
 CDS_LEN = len(VHL_PROTEIN)
@@ -215,35 +226,53 @@ HPO_FILENAME = 'hp.obo'
 # HPO_HREF = 'https://raw.githubusercontent.com/obophenotype/human-phenotype-ontology/master/hp.obo'
 HPO_HREF = os.path.join(LIB_DIR, 'hp.obo.txt')
 
-# gather HPO and SO into a network- node keys: id
-_g = nx.compose(obonet.read_obo(SO_HREF), obonet.read_obo(HPO_HREF))
-
-# add the id to the node attributes
-for n, d in _g.nodes(data=True):
-    d['id'] = n.casefold().strip()
-    d['name'] = d['name'].casefold().strip()
+OBO_FILES = [SO_HREF, HPO_HREF]
 
-# make a copy of merged network- node keys: term
-_h = nx.relabel_nodes(_g, {n: d['name'] for n, d in _g.nodes(data=True)})
-# combine together OBO network so that node keys: id or term
-_f = nx.compose(_g, _h)
-# casefold and strip the keys, so the result is an agglomeration of nodes:
-# SO(term) + SO(id) + HPO(term) + HPO(id), all lowercase and stripped
+# HPO and SO merged into one ontology, where every term can be looked up by its id or its name, both lowercase and
+# stripped. It is compiled once into arrays next to the obo files, which are memory mapped from then on
+OBO_GRAPH = load_ontology_graph(OBO_FILES)
 
 
-OBONET = nx.DiGraph(nx.relabel_nodes(_f, {n: n.casefold().strip() for n in _f.nodes()}))
-OBONET_UD = OBONET.to_undirected()
+def __getattr__(name):
+    # the networkx form of the ontology (OBONET, its undirected view OBONET_UD and the node key -> id map OBO_ALIASES)
+    # is only loaded when something still asks for it
+    if name in ('OBONET', 'OBONET_UD', 'OBO_ALIASES'):
+        ontology = load_ontology(OBO_FILES)
+        globals().update(OBONET=ontology.graph, OBONET_UD=ontology.undirected, OBO_ALIASES=ontology.aliases)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_valid_obo(term_or_id, obo_type='name'):
     tid = term_or_id.strip().casefold()
-    if tid in OBONET:
-        node_data = OBONET.nodes[tid][obo_type]
-        return node_data
+    if tid in OBO_GRAPH:
+        term = OBO_GRAPH.index(tid)
+        return OBO_GRAPH.id(term) if obo_type == 'id' else OBO_GRAPH.name(term)
     else:
         raise ValueError(f"Could not find an OBO node for {tid}")
 
 
+# every term with all of its ancestors, for checking whether terms are under another one
+OBO_CLOSURE = load_ancestor_closure(OBO_GRAPH)
+
+
+def is_obo_descendant(term_or_id, ancestor):
+    '''Whether a term is the ancestor term itself or is under it in the ontology
+    '''
+    return OBO_CLOSURE.is_a(OBO_GRAPH.index(get_valid_obo(term_or_id, 'id')),
+                            OBO_GRAPH.index(get_valid_obo(ancestor, 'id')))
+
+
+def obo_descendant_mask(terms, ancestor):
+    '''Vectorized is_obo_descendant for a whole column of terms
+    @param terms: iterable of term names or ids; missing values and terms that aren't in the ontology are False
+    @param ancestor: name or id of the ancestor term
+    @return: boolean array
+    '''
+    keys = [term.strip().casefold() if isinstance(term, str) else '' for term in terms]
+    return OBO_CLOSURE.is_a_many(OBO_GRAPH.indices(keys), OBO_GRAPH.index(get_valid_obo(ancestor, 'id')))
+
+
 ## Scoring functions
 # Q: hpo has a confusing hierarchy for neurendocrine neoplasms relating to the pancreas
 # (namely, Pancreatic endocrine tumor vs neoplasms and cysts of the pancreas )
@@ -302,24 +331,22 @@ SO_TERM_TYPES = {
 # TODO: this has been coded for phenotype entry, not Node
 GENERAL_HPO_NODES = [get_valid_obo(term) for term in GENERAL_HPO_TERMS]
 
+# position in GENERAL_HPO_NODES / GENERAL_SO_TERMS of the generalization of every ontology term, or -1 if it has none.
+# Computed once per ontology version, and saved with the ontology arrays
+HPO_GENERALIZATION = load_generalization(OBO_GRAPH, GENERAL_HPO_NODES)
+SO_GENERALIZATION = load_generalization(OBO_GRAPH, GENERAL_SO_TERMS)
+
 
 def generalized_vhl_phenotype(phenotype, use_abbreviation=True):
     '''Given a node, find its general disease type
     '''
-    general_pheno = None
-
     valid_hpo = get_valid_obo(phenotype)
-    for successor in nx.bfs_successors(OBONET, valid_hpo):
-        try:
-            i = GENERAL_HPO_NODES.index(successor[0])
-            general_pheno = GENERAL_HPO_NODES[i]
-            break
-        except ValueError as e:
-            pass
-
-    if general_pheno is None:
+    general = HPO_GENERALIZATION[OBO_GRAPH.index(valid_hpo)]
+    if general < 0:
         raise ValueError(f"Could not find a generalized term for {valid_hpo}")
 
+    general_pheno = GENERAL_HPO_NODES[general]
+
     if use_abbreviation:
         general_pheno = HPO_ABBREVIATIONS[general_pheno]
     return general_pheno
@@ -328,65 +355,162 @@ def generalized_vhl_phenotype(phenotype, use_abbreviation=True):
 def generalized_so_terms(so_type):
     '''Given a node, find its general so_type
     '''
-
-    general_so = None
-
     valid_so = get_valid_obo(so_type)
-    for successor in nx.bfs_successors(OBONET, valid_so):
-        try:
-            i = GENERAL_SO_TERMS.index(successor[0])
-            general_so = GENERAL_SO_TERMS[i]
-            break
-        except ValueError as e:
-            pass
-
-    if general_so is None:
+    general = SO_GENERALIZATION[OBO_GRAPH.index(valid_so)]
+    if general < 0:
         raise ValueError(f"Could not find a generalized term for {valid_so}")
 
-    return general_so
+    return GENERAL_SO_TERMS[general]
 
-def affected_domains(hgvs):
-    '''Finds the affected VHL domains for a variant
+# variants in one cell are separated by either of these
+CDNA_SEPARATOR_REGEX = re.compile('[;,]')
+# DNA_REGEX anchored to the start of the string, for the vectorized str.extract
+DNA_MATCH_PATTERN = f'^(?:{DNA_REGEX.pattern})'
+
+# typed columns of the table returned by parse_cdna
+CDNA_PARSE_COLUMNS = ['transcript', 'start', 'start_offset', 'end', 'end_offset', 'ref', 'alt', 'variant_class',
+                      'coding', 'uncertain']
+
+# every variant term parsed so far, indexed by term, so that each distinct term is only ever matched once per run
+_PARSED_CDNA_TERMS = None
+
+
+def _variant_class(type1, type2):
+    types = f"{type1 or ''}{type2 or ''}"
+    if '>' in types:
+        return 'substitution'
+    if 'del' in types and 'ins' in types:
+        return 'delins'
+    for name, variant_class in (('del', 'deletion'), ('ins', 'insertion'), ('dup', 'duplication')):
+        if name in types:
+            return variant_class
+    return None
+
+
+def _parse_cdna_terms(terms):
+    '''Matches DNA_REGEX against every term at once
+    @return: dataframe of CDNA_PARSE_COLUMNS indexed by term, with missing values for terms that don't match
+    '''
+    groups = pd.Series(terms, dtype=object).str.extract(DNA_MATCH_PATTERN)
+    groups.index = pd.Index(terms, dtype=object)
+    matched = groups['start'].notna()
+
+    def position(column):
+        return pd.to_numeric(groups[column], errors='coerce').astype('Int64')
+
+    parsed = pd.DataFrame(index=groups.index)
+    # the id group keeps the separating colon
+    parsed['transcript'] = groups['id'].str.rstrip(':').str.strip().replace('', np.nan)
+    parsed['start'] = position('start')
+    parsed['start_offset'] = position('startNonCDS')
+    parsed['end'] = position('end')
+    parsed['end_offset'] = position('stopNonCDS')
+    # the bases after del are the deleted ones; the bases after >, ins and dup, or after the ins of a delins, are added
+    deleted = groups['varType1'].fillna('').str.startswith('del')
+    parsed['ref'] = groups['ref'].where(groups['ref'].notna(), groups['alt1'].where(deleted))
+    parsed['alt'] = groups['alt2'].where(groups['alt2'].notna(), groups['alt1'].where(~deleted))
+    parsed['variant_class'] = [_variant_class(type1, type2) if match else None for type1, type2, match in
+                               zip(groups['varType1'], groups['varType2'], matched)]
+    # utr and intronic variants have an offset from a cds position
+    parsed['coding'] = matched & groups['startNonCDS'].isna() & groups['stopNonCDS'].isna()
+    parsed['uncertain'] = (groups['start'].fillna('').str.contains('?', regex=False) |
+                           groups['end'].fillna('').str.contains('?', regex=False))
+    return parsed[CDNA_PARSE_COLUMNS]
+
+
+def _parsed_cdna_terms(terms):
+    '''Rows of the parsed terms, in order, parsing the ones that haven't been parsed before
+    '''
+    global _PARSED_CDNA_TERMS
+
+    terms = pd.Index(terms, dtype=object)
+    new_terms = terms.unique() if _PARSED_CDNA_TERMS is None else \
+        terms.unique().difference(_PARSED_CDNA_TERMS.index, sort=False)
+    if len(new_terms):
+        parsed = _parse_cdna_terms(new_terms)
+        _PARSED_CDNA_TERMS = parsed if _PARSED_CDNA_TERMS is None else pd.concat([_PARSED_CDNA_TERMS, parsed])
+    return _PARSED_CDNA_TERMS.loc[terms]
+
+
+def parse_cdna(values):
+    '''Parses every variant of every hgvs cdna string of values, i.e. the Mutation Event c.DNA. or HGVS_transcript
+    columns. Each distinct string is split once, and each distinct variant term is matched against DNA_REGEX once;
+    terms that were parsed by an earlier call aren't parsed again.
+    @param values: series of strings, each holding one or more variants separated by ; or ,
+    @return: dataframe with one row per variant term of each string of values, in order, with the index of values.
+        Its columns are the stripped variant term and the typed CDNA_PARSE_COLUMNS: the transcript, the start and end
+        cds positions and their intronic/utr offsets (Int64, missing if absent or ?), the ref and alt bases, the
+        variant_class (substitution, deletion, insertion, duplication or delins), whether it is coding (no offsets)
+        and whether it is uncertain (a ? position)
     '''
-    # TODO: make this less nested
+    values = pd.Series(values, dtype=object)
+    values = values[values.map(lambda x: isinstance(x, str))]
+    codes, uniques = pd.factorize(values)
+    term_lists = pd.Series(uniques, dtype=object).str.split(CDNA_SEPARATOR_REGEX).to_numpy()
+    terms = pd.Series(term_lists[codes], index=values.index, dtype=object).explode().str.strip()
 
-    domains_affected = []
+    parsed = _parsed_cdna_terms(terms.to_numpy())
+    parsed.index = terms.index
+    parsed.insert(0, 'term', terms.to_numpy())
+    return parsed
 
-    # hgvs = node['all'].get('cdnaChange', None)
-    if hgvs is not None:
 
-        # there was a typo in Civic for VARIANT L89R(c.266T>G)
-        # ENST00000256474.2:.266T>G
-        match = DNA_REGEX.match(hgvs)
-        if match is not None:
-            var = match.groupdict()
-            # if the variant is not utr or intronic
-            if var['startNonCDS'] is None and var['stopNonCDS'] is None:
-                try:
-                    start_aa = math.floor(int(var['start']) / 3) + 1
-                    stop_aa = math.floor(int(var['end']) / 3) + 1 if var['end'] is not None else start_aa + 1
+def _codon_range(start, end):
+    '''First and one past the last codon that affected_domains counts as changed by a cds start/end position
+    '''
+    start_aa = np.floor(start / 3) + 1
+    stop_aa = np.where(np.isnan(end), start_aa + 1, np.floor(end / 3) + 1)
+    return start_aa, stop_aa
+
+
+def codon_range_regions(start_aa, stop_aa):
+    '''Which regions of VHL_FUNCTIONAL_REGIONS each range of codons [start_aa, stop_aa) overlaps
+    @param start_aa: array of first codons
+    @param stop_aa: array of codons one past the last
+    @return: boolean array of shape (len(start_aa), len(VHL_REGION_NAMES))
+    '''
+    last = len(CODON_REGION_BITS)
+    start_aa = np.clip(np.asarray(start_aa, dtype=np.int64), 0, last)
+    stop_aa = np.clip(np.asarray(stop_aa, dtype=np.int64), 0, last)
+    return CODON_REGION_PREFIX[stop_aa] - CODON_REGION_PREFIX[start_aa] > 0
 
-                    affected_aa = set(range(start_aa, stop_aa))
 
-                    for domain in VHL_FUNCTIONAL_REGIONS:
-                        # if theres overlap in aa's between the variant and each domain
-                        if len(list(VHL_FUNCTIONAL_REGIONS[domain] & affected_aa)) > 0:
-                            domains_affected.append(domain)
+def parsed_region_mask(parsed):
+    '''Regions affected by every row of a parse_cdna table, as affected_domains finds them
+    @return: boolean array of shape (len(parsed), len(VHL_REGION_NAMES))
+    '''
+    usable = (parsed['coding'] & ~parsed['uncertain'] & parsed['start'].notna()).to_numpy(dtype=bool)
+    start, stop = _codon_range(parsed['start'].to_numpy(dtype=float, na_value=np.nan),
+                               parsed['end'].to_numpy(dtype=float, na_value=np.nan))
+
+    mask = np.zeros((len(parsed), len(VHL_REGION_NAMES)), dtype=bool)
+    mask[usable] = codon_range_regions(start[usable], stop[usable])
+    return mask
+
+
+def parsed_affected_domains(parsed):
+    '''affected_domains of every row of a parse_cdna table
+    @return: series of lists of domain names, with the index of parsed
+    '''
+    names = np.array(VHL_REGION_NAMES, dtype=object)
+    return pd.Series([names[row].tolist() for row in parsed_region_mask(parsed)], index=parsed.index, dtype=object)
 
-                # couldnt cast start or end to integer
-                except ValueError as e:
-                    pass
 
-    return domains_affected
+def affected_domains(hgvs):
+    '''Finds the affected VHL domains for a variant
+    '''
+    # there was a typo in Civic for VARIANT L89R(c.266T>G)
+    # ENST00000256474.2:.266T>G
+    if hgvs is None:
+        return []
+    return parsed_affected_domains(_parsed_cdna_terms([hgvs.strip()])).iloc[0]
 
 
 def get_cdna_start(hgvs):
-    match = DNA_REGEX.match(hgvs)
+    parsed = _parsed_cdna_terms([hgvs.strip()]).iloc[0]
     cdna_start = None
-    if match is not None:
-        var = match.groupdict()
-        # if the variant is not utr or intronic
-        if var['startNonCDS'] is None and var['stopNonCDS'] is None:
-            cdna_start = int(var['start'])
+    # if the variant is not utr or intronic
+    if parsed['coding'] and not pd.isna(parsed['start']):
+        cdna_start = int(parsed['start'])
 
     return cdna_start